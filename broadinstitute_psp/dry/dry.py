@@ -83,19 +83,23 @@ def build_parser():
     return parser
 
 
-def main(args):
+def main(args, in_gct=None, write_output=True):
     """THE MAIN METHOD. Filter and normalize data and save result as a gct file.
 
     Args:
         args (argparse.Namespace object): fields as defined in build_parser()
+        in_gct (GCToo object or None): if provided, used instead of parsing
+            args.in_gct_path (which is then only used to name the output)
+        write_output (bool): whether to write the output gct and pw files;
+            if False, the caller is responsible for writing out_gct
 
     Returns:
         out_gct (GCToo object): output gct object
     """
     ### READ GCT AND CONFIG FILE
-    (in_gct, assay_type, prov_code, config_io, config_metadata, config_parameters) = (
+    (in_gct, assay_type, prov_code, config, config_io, config_metadata, config_parameters) = (
         read_dry_gct_and_config_file(
-            args.in_gct_path, args.psp_config_path, args.force_assay))
+            args.in_gct_path, args.psp_config_path, args.force_assay, in_gct))
 
     ### LOG TRANSFORM
     (l2x_gct, prov_code) = log_transform_if_needed(
@@ -119,7 +123,7 @@ def main(args):
     ### APPLY OFFSETS IF NEEDED (if P100)
     (offset_gct, dists, offsets, prov_code) = p100_calculate_dists_and_apply_offsets_if_needed(
             hist_norm_gct, assay_type, args.no_optim,
-            eval(config_parameters["offset_bounds"]), prov_code,
+            config.get_typed("parameters", "offset_bounds"), prov_code,
             config_metadata["optimization_prov_code_entry"])
 
     ### FILTER SAMPLES BY DISTANCE (if P100)
@@ -131,7 +135,10 @@ def main(args):
     ### INSERT OFFSETS AND UPDATE PROVENANCE CODE
     out_gct = insert_offsets_and_prov_code(
         filt_dist_gct, out_offsets, config_metadata["offsets_field"], prov_code,
-        config_metadata["prov_code_field"], config_metadata["prov_code_delimiter"])
+        config_metadata["prov_code_field"])
+
+    if not write_output:
+        return out_gct
 
     ### CONFIGURE OUT NAMES
     (out_gct_name, out_pw_name) = configure_out_names(
@@ -150,7 +157,7 @@ def main(args):
 
 
 # tested #
-def read_dry_gct_and_config_file(in_gct_path, config_path, forced_assay_type):
+def read_dry_gct_and_config_file(in_gct_path, config_path, forced_assay_type, in_gct=None):
     """ Read gct and config file.
 
     Uses the utility function read_gct_and_config_file from psp_utils.
@@ -162,17 +169,20 @@ def read_dry_gct_and_config_file(in_gct_path, config_path, forced_assay_type):
         in_gct_path (string): filepath to gct file
         config_path (string): filepath to config file
         forced_assay_type (string, or None)
+        in_gct (GCToo object, or None): if provided, in_gct_path is not parsed
 
     Returns:
         gct (GCToo object)
         assay_type (string)
         prov_code (list of strings)
+        config (PspConfig): for fields that aren't strings (see PspConfig.get_typed)
         config_io (dictionary)
         config_metadata (dictionary)
         config_parameters (dictionary)
     """
     # Read gct and config file
-    (gct, config_io, config_metadata, config_parameters) = psp_utils.read_gct_and_config_file(in_gct_path, config_path)
+    (gct, config_io, config_metadata, config_parameters) = psp_utils.read_gct_and_config_file(in_gct_path, config_path, in_gct)
+    config = psp_utils.read_config(config_path)
 
     # Extract the plate's provenance code
     prov_code = psp_utils.extract_prov_code(gct.col_metadata_df,
@@ -187,11 +197,11 @@ def read_dry_gct_and_config_file(in_gct_path, config_path, forced_assay_type):
         assay_type = prov_code[0]
 
     # Make sure assay_type is one of the allowed values
-    p100_assay_types = eval(config_metadata["p100_assays"])
-    gcp_assay_types = eval(config_metadata["gcp_assays"])
+    p100_assay_types = config.get_typed("metadata", "p100_assays")
+    gcp_assay_types = config.get_typed("metadata", "gcp_assays")
     assay_type_out = check_assay_type(assay_type, p100_assay_types, gcp_assay_types)
 
-    return gct, assay_type_out, prov_code, config_io, config_metadata, config_parameters
+    return gct, assay_type_out, prov_code, config, config_io, config_metadata, config_parameters
 
 
 # tested #
@@ -915,16 +925,15 @@ def remove_sample_outliers(data_df, offsets, distances, dist_sd_cutoff):
     return out_df, out_offsets
 
 
-def insert_offsets_and_prov_code(gct, offsets, offsets_field, prov_code, prov_code_field, prov_code_delimiter):
+def insert_offsets_and_prov_code(gct, offsets, offsets_field, prov_code, prov_code_field):
     """Insert offsets into output gct and update provenance code in metadata.
 
     Args:
         gct (GCToo object)
         offsets (numpy array of floats, or None): if optimization was not performed, this will be None
         offsets_field (string): name of col metadata field into which offsets will be inserted
-        prov_code (list of strings)
+        prov_code (ProvenanceCode)
         prov_code_field (string): name of col metadata field containing the provenance code
-        prov_code_delimiter (string): what string to use as delimiter in prov_code
 
     Returns:
         gct (GCToo object): updated metadata
@@ -940,7 +949,7 @@ def insert_offsets_and_prov_code(gct, offsets, offsets_field, prov_code, prov_co
         gct.col_metadata_df[offsets_field] = offsets
 
     # Convert provenance code to delimiter separated string
-    prov_code_str = prov_code_delimiter.join(prov_code)
+    prov_code_str = prov_code.to_string()
 
     # Update the provenance code in col_metadata_df
     gct.col_metadata_df.loc[:, prov_code_field] = prov_code_str
@@ -3,6 +3,7 @@ import botocore
 import argparse
 import sys
 import broadinstitute_psp.utils.lambda_utils as utils
+import broadinstitute_psp.utils.psp_utils as psp_utils
 import broadinstitute_psp.dry.dry as dry
 import broadinstitute_psp.utils.config_converter as config_converter
 
@@ -38,13 +39,25 @@ def build_parser():
     return parser
 
 def call_dry(args):
+    # Send status updates from a background thread so that a slow API doesn't
+    # stall dry; all updates are sent before returning (or raising)
+    with utils.background_status_updates():
+        return run_dry(args)
+
+
+def run_dry(args):
     s3 = boto3.resource('s3')
+
+    # The level 2 GCT is never written to disk; this path only names the output
     local_gct_path = args.config_dir + "/" + LOCAL_LEVEL_2_GCT_NAME
 
-    download_gct_from_s3(s3, args, local_gct_path)
+    level_2_content = read_gct_from_s3(s3, args)
 
+    # Parse once, then share the GCT with config_converter and dry
     try:
-        config_path = check_gct_for_custom_parameters_and_set_config_path(args, local_gct_path)
+        level_2_gct = psp_utils.parse_gct_from_bytes(
+            level_2_content, "s3://" + args.bucket_name + "/" + args.file_key)
+        config_path = check_gct_for_custom_parameters_and_set_config_path(args, level_2_gct)
 
     except Exception as error:
         level_3_message = "dry error: {}".format(error)
@@ -57,7 +70,7 @@ def call_dry(args):
     (level_3_key, config_key) = create_s3_keys(args)
 
     try:
-        level_3_gct = dry.main(dry_args)
+        level_3_gct = dry.main(dry_args, in_gct=level_2_gct, write_output=False)
         print level_3_gct
 
     except Exception as error:
@@ -67,8 +80,11 @@ def call_dry(args):
         utils.post_update_to_proteomics_clue(LEVEL_3_API_SUFFIX, args.plate_api_id, payload)
         raise Exception(error)
 
-    gct_location = args.config_dir + "/" + DRY_OUT_NAME
-    upload_file_to_s3(s3, args, gct_location, level_3_key, LEVEL_3_API_SUFFIX)
+    # Upload level 3 straight from memory
+    (config_io, _, _) = psp_utils.read_config_file(config_path)
+    level_3_buffer = psp_utils.write_gct_to_buffer(
+        level_3_gct, config_io["data_null"], config_io["filler_null"])
+    upload_to_s3(s3, args, level_3_buffer, level_3_key, LEVEL_3_API_SUFFIX)
 
     # todo: if first upload fails, will not proceed to config upload, maybe this is fine?
     upload_file_to_s3(s3, args, config_path, config_key, CONFIG_API_SUFFIX)
@@ -77,14 +93,20 @@ def call_dry(args):
     utils.post_update_to_proteomics_clue("", args.plate_api_id, dry_success_payload)
     return "Success!"
 
-def download_gct_from_s3(s3, args, local_level_2_path):
+def read_gct_from_s3(s3, args):
+    """ Read the level 2 GCT from s3 into memory.
+
+    Returns:
+        content (string): contents of the GCT
+
+    """
     try:
         print 'Reading file {} from bucket {}'.format(args.file_key, args.bucket_name)
-        s3.Bucket(args.bucket_name).download_file(args.file_key, local_level_2_path)
+        content = s3.Object(args.bucket_name, args.file_key).get()['Body'].read()
 
     except botocore.exceptions.ClientError as e:
 
-        if e.response['Error']['Code'] == "404":
+        if e.response['Error']['Code'] in ["404", "NoSuchKey"]:
             level_3_message = "The LVL2 GCT located at {} from bucket {} does not exist".format(args.file_key, args.bucket_name)
             print level_3_message
 
@@ -96,14 +118,17 @@ def download_gct_from_s3(s3, args, local_level_2_path):
         utils.post_update_to_proteomics_clue(LEVEL_3_API_SUFFIX, args.plate_api_id, payload)
         raise Exception(e)
 
+    return content
+
 
-def check_gct_for_custom_parameters_and_set_config_path(args, local_gct_path):
+def check_gct_for_custom_parameters_and_set_config_path(args, gct):
     assay = args.plate_name.split("_")[1].lower()
     config_path = args.config_dir + "/" + args.plate_name + ".cfg"
 
-    diff_params = config_converter.convert_gct_to_config(assay, local_gct_path, config_path)
+    diff_params = config_converter.convert_parsed_gct_to_config(
+        assay, gct, config_path, [args.config_dir])
     if diff_params is None:
-        config_path = args.config_dir + "/psp_production.cfg"
+        config_path = psp_utils.get_psp_production_config_path([args.config_dir])
 
     return config_path
 
@@ -119,9 +144,13 @@ def create_s3_keys(args):
     return level_3_key, config_key
 
 def upload_file_to_s3(s3, args, local_path, s3_key, api_suffix):
+    upload_to_s3(s3, args, open(local_path, 'rb'), s3_key, api_suffix)
+
+def upload_to_s3(s3, args, body, s3_key, api_suffix):
+    """ Upload body (an open file or in-memory buffer) to s3 and post its
+    location to the API. """
     try:
-        gct = open(local_path, 'rb')
-        s3.Bucket(args.bucket_name).put_object(Key=s3_key, Body=gct)
+        s3.Bucket(args.bucket_name).put_object(Key=s3_key, Body=body)
 
     except boto3.exceptions.S3UploadFailedError as error:
         error_message = "s3 upload error"
@@ -15,6 +15,7 @@ import pandas as pd
 
 import cmapPy.pandasGEXpress.GCToo as GCToo
 import broadinstitute_psp.utils.setup_logger as setup_logger
+import broadinstitute_psp.utils.psp_utils as psp_utils
 import dry
 
 # Setup logger
@@ -60,7 +61,7 @@ class TestDry(unittest.TestCase):
         e_gcp_norm_peptide = "BI10052"
 
         # Happy path
-        (out_gct, out_assay_type, out_prov_code, config_io, config_metadata,
+        (out_gct, out_assay_type, out_prov_code, config, config_io, config_metadata,
          config_parameters) = dry.read_dry_gct_and_config_file(
             input_gct_path, psp_config_path, None)
 
@@ -77,10 +78,11 @@ class TestDry(unittest.TestCase):
                          e_gcp_norm_peptide,
                          ("The expected gcp_normalization_peptide_id is {}" +
                           "").format(e_gcp_norm_peptide, config_metadata["gcp_normalization_peptide_id"]))
+        self.assertEqual(config.get_typed("parameters", "offset_bounds"), (-7, 7))
 
         # Check that force-assay works
         e_forced_assay_type = "gcp"
-        (_, out_forced_assay_type, _, _, _, _) = dry.read_dry_gct_and_config_file(
+        (_, out_forced_assay_type, _, _, _, _, _) = dry.read_dry_gct_and_config_file(
             input_gct_path, psp_config_path, "GR1")
         self.assertEqual(out_forced_assay_type, e_forced_assay_type,
                          ("The expected assay type is {}, " +
@@ -216,6 +218,15 @@ class TestDry(unittest.TestCase):
         self.assertIn("Each normalization", str(e.exception))
         logger.debug(str(e.exception))
 
+        # A probe without a norm peptide is an error, not dropped
+        row_meta4 = pd.DataFrame({"row_field1":["A"]*5, "row_field2":["B"]*5,
+                                  "norm_field":["b", "b", "b", "b", np.nan]},
+                                 index=["a", "b", "c", "k", "g"])
+        in_gct4 = GCToo.GCToo(data_df=data, row_metadata_df=row_meta4, col_metadata_df=col_meta)
+        with self.assertRaises(AssertionError) as e:
+            dry.gcp_histone_normalize_if_needed(in_gct4, "gcp", "norm_field", None, prov_code, "HPN")
+        self.assertIn("separate_field must not be NaN", str(e.exception))
+
     def test_gcp_histone_normalize(self):
         df = pd.DataFrame([[1.1, 2.0, 3.3], [4.1, 5.8, 6.0]],
                           index=["a", "b"],
@@ -556,9 +567,8 @@ class TestDry(unittest.TestCase):
         in_gct = GCToo.GCToo(data_df=data, row_metadata_df=row_meta, col_metadata_df=col_meta)
         offsets = np.array([3.0, 5.0, 8.0])
         offsets_field = "offsets"
-        prov_code = ["A", "B", "C", "D"]
+        prov_code = psp_utils.ProvenanceCode(["A", "B", "C", "D"], "+")
         prov_code_field = "col_field2"
-        prov_code_delimiter = "+"
         e_col_meta = pd.DataFrame([["cm1", "A+B+C+D", 3.0],
                                    ["cm3", "A+B+C+D", 5.0],
                                    ["cm5", "A+B+C+D", 8.0]],
@@ -566,7 +576,7 @@ class TestDry(unittest.TestCase):
                                   columns=["col_field1", "col_field2", "offsets"])
 
         out_gct = dry.insert_offsets_and_prov_code(
-            in_gct, offsets, offsets_field, prov_code, prov_code_field, prov_code_delimiter)
+            in_gct, offsets, offsets_field, prov_code, prov_code_field)
 
         self.assertTrue(np.array_equal(out_gct.col_metadata_df, e_col_meta))
 
@@ -10,7 +10,10 @@ logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
 OG_post_update = dh.utils.post_update_to_proteomics_clue
 OG_os_environ = dh.utils.os.environ
-OG_config_converter = dh.config_converter.convert_gct_to_config
+OG_config_converter = dh.config_converter.convert_parsed_gct_to_config
+OG_parse_gct_from_bytes = dh.psp_utils.parse_gct_from_bytes
+OG_read_config_file = dh.psp_utils.read_config_file
+OG_write_gct_to_buffer = dh.psp_utils.write_gct_to_buffer
 
 class TestDryHandler(unittest.TestCase):
 
@@ -27,11 +30,20 @@ class TestDryHandler(unittest.TestCase):
         dh.utils.os.environ = mock.MagicMock()
         dh.utils.os.environ.__getitem__.side_effect = get_environ_item
 
+        # GCT I/O is tested in psp_utils
+        dh.psp_utils.parse_gct_from_bytes = mock.Mock(return_value="level 2 gct")
+        dh.psp_utils.read_config_file = mock.Mock(
+            return_value=({"data_null": "NaN", "filler_null": "NA"}, {}, {}))
+        dh.psp_utils.write_gct_to_buffer = mock.Mock(return_value="level 3 buffer")
+
     @classmethod
     def tearDownClass(cls):
         dh.utils.post_update_to_proteomics_clue = OG_post_update
         dh.utils.os.environ = OG_os_environ
-        dh.config_converter.convert_gct_to_config = OG_config_converter
+        dh.config_converter.convert_parsed_gct_to_config = OG_config_converter
+        dh.psp_utils.parse_gct_from_bytes = OG_parse_gct_from_bytes
+        dh.psp_utils.read_config_file = OG_read_config_file
+        dh.psp_utils.write_gct_to_buffer = OG_write_gct_to_buffer
 
     @staticmethod
     def setup_args():
@@ -42,16 +54,23 @@ class TestDryHandler(unittest.TestCase):
                         plate_name = "test_plate_name")
 
         return args
-    def test_download_gct_from_s3(self):
+    def test_read_gct_from_s3(self):
         args = TestDryHandler.setup_args()
         s3 = mock.MagicMock()
-        s3.Bucket("test_bucket").download_file = mock.Mock(
+
+        # happy path
+        s3.Object("test_bucket", args.file_key).get = mock.Mock(
+            return_value={"Body": mock.Mock(read=mock.Mock(return_value="#1.3"))})
+        self.assertEqual(dh.read_gct_from_s3(s3, args), "#1.3")
+        s3.Object.assert_called_with("test_bucket", args.file_key)
+
+        s3.Object("test_bucket", args.file_key).get = mock.Mock(
             side_effect=ClientError({'Error': {'Code': '404', 'Message': 'Does Not Exist'}}, 'GetObject'))
 
         #unhappy path ClientError ErrorCode 404
         dh.utils.post_update_to_proteomics_clue.reset_mock()
         with self.assertRaises(Exception) as context:
-            dh.download_gct_from_s3(s3, args, "/this/dir/level4.gct")
+            dh.read_gct_from_s3(s3, args)
 
 
         dh.utils.post_update_to_proteomics_clue.assert_called_once()
@@ -60,38 +79,47 @@ class TestDryHandler(unittest.TestCase):
         self.assertEqual(expected_call, dh.utils.post_update_to_proteomics_clue.call_args)
 
         #unhappy path ClientError ErrorCode !404
-        s3.Bucket("test_bucket").download_file = mock.Mock(
+        s3.Object("test_bucket", args.file_key).get = mock.Mock(
             side_effect=ClientError({'Error': {'Code': '500', 'Message': 'Oops'}}, 'GetObject'))
         dh.utils.post_update_to_proteomics_clue.reset_mock()
 
         with self.assertRaises(Exception) as context:
-            dh.download_gct_from_s3(s3, args, "/this/dir/level4.gct")
+            dh.read_gct_from_s3(s3, args)
 
         expected_call = mock.call(dh.LEVEL_3_API_SUFFIX, args.plate_api_id,
                                   {"s3": {"message": "failed to download LVL2 GCT located at psp/level2/test_file_key.gct from bucket test_bucket"}})
         self.assertEqual(expected_call, dh.utils.post_update_to_proteomics_clue.call_args)
 
-    @mock.patch("broadinstitute_psp.dry.dry_handler.config_converter.convert_gct_to_config")
-    def test_check_gct_for_custom_parameters_and_set_config_path(self, config_converter):
+    @mock.patch("broadinstitute_psp.dry.dry_handler.psp_utils.get_psp_production_config_path",
+                return_value="/this/dir/psp_production.cfg")
+    @mock.patch("broadinstitute_psp.dry.dry_handler.config_converter.convert_parsed_gct_to_config")
+    def test_check_gct_for_custom_parameters_and_set_config_path(self, config_converter, get_config_path):
         # Setup
         args = TestDryHandler.setup_args()
-        local_gct_path = "/this/dir/level3.gct"
+        gct = "level 2 gct"
 
         # No differential params in GCT
         config_converter.return_value = None
-        config_path = dh.check_gct_for_custom_parameters_and_set_config_path(args, local_gct_path)
+        config_path = dh.check_gct_for_custom_parameters_and_set_config_path(args, gct)
         expected_config_path = "/this/dir/psp_production.cfg"
 
         self.assertEqual(config_path, expected_config_path)
+        config_converter.assert_called_once_with("plate", gct, "/this/dir/test_plate_name.cfg", ["/this/dir"])
+        get_config_path.assert_called_once_with(["/this/dir"])
 
+        # Differential params in GCT
+        config_converter.return_value = {"p100_dist_sd_cutoff": "6"}
+        config_path = dh.check_gct_for_custom_parameters_and_set_config_path(args, gct)
+        self.assertEqual(config_path, "/this/dir/test_plate_name.cfg")
 
-    @mock.patch("broadinstitute_psp.dry.dry_handler.download_gct_from_s3")
+
+    @mock.patch("broadinstitute_psp.dry.dry_handler.read_gct_from_s3")
     def test_call_dry_happy_path(self, download_gct):
         #setup
         args = TestDryHandler.setup_args()
         dh.s3 = mock.Mock()
         dh.boto3.resource = mock.Mock(return_value=dh.s3)
-        dh.config_converter.convert_gct_to_config = mock.Mock(return_value="this/dir/test_plate_name.cfg")
+        dh.config_converter.convert_parsed_gct_to_config = mock.Mock(return_value="this/dir/test_plate_name.cfg")
         dh.dry.main = mock.Mock()
         dh.open = mock.Mock(return_value="opened")
         dh.s3.Bucket("test_bucket").put_object = mock.Mock()
@@ -103,6 +131,11 @@ class TestDryHandler(unittest.TestCase):
         download_gct.assert_called_once()
         dh.dry.main.assert_called_once()
 
+        # dry gets the GCT that was parsed from s3, and doesn't write it
+        self.assertEqual(dh.dry.main.call_args[1], {"in_gct": "level 2 gct", "write_output": False})
+        dh.config_converter.convert_parsed_gct_to_config.assert_called_once()
+        self.assertEqual(dh.config_converter.convert_parsed_gct_to_config.call_args[0][1], "level 2 gct")
+
         # vars() turns the call_args into a dictionary, removing from Namespace()
         dry_call = vars(dh.dry.main.call_args[0][0])
 
@@ -110,13 +143,13 @@ class TestDryHandler(unittest.TestCase):
         self.assertEqual("/this/dir/test_plate_name.cfg", dry_call["psp_config_path"])
         self.assertEqual("/this/dir/level2.gct",dry_call["in_gct_path"])
 
+        # level 3 is uploaded from memory, only the config from file
         open_calls = dh.open.call_args_list
-        expected_open_calls = [mock.call("/this/dir/level3.dry.processed.gct", "rb"),
-                               mock.call("/this/dir/test_plate_name.cfg", "rb")]
+        expected_open_calls = [mock.call("/this/dir/test_plate_name.cfg", "rb")]
         self.assertEqual(open_calls, expected_open_calls)
 
         put_object_calls = dh.s3.Bucket("test_bucket").put_object.call_args_list
-        expected_put_objected_calls = [mock.call(Key="psp/level3/test_plate_name_LVL3.gct", Body="opened"),
+        expected_put_objected_calls = [mock.call(Key="psp/level3/test_plate_name_LVL3.gct", Body="level 3 buffer"),
                                        mock.call(Key="psp/config/test_plate_name.cfg", Body="opened")]
         self.assertEqual(put_object_calls, expected_put_objected_calls)
 
@@ -126,7 +159,7 @@ class TestDryHandler(unittest.TestCase):
                           mock.call("", args.plate_api_id, {"status":"created LVL 3 GCT"})]
         self.assertEqual(clue_posts, expected_posts)
 
-    @mock.patch("broadinstitute_psp.dry.dry_handler.download_gct_from_s3")
+    @mock.patch("broadinstitute_psp.dry.dry_handler.read_gct_from_s3")
     def test_call_dry_unhappy_path_dry_failure(self, download_gct):
         #setup
         args = TestDryHandler.setup_args()
@@ -154,7 +187,7 @@ class TestDryHandler(unittest.TestCase):
 
         self.assertEqual(expected_post, post)
 
-    @mock.patch("broadinstitute_psp.dry.dry_handler.download_gct_from_s3")
+    @mock.patch("broadinstitute_psp.dry.dry_handler.read_gct_from_s3")
     def test_call_dry_unhappy_path_s3_upload_failure(self, download_gct):
         # setup
         args = TestDryHandler.setup_args()
@@ -181,12 +214,11 @@ class TestDryHandler(unittest.TestCase):
 
         # exception itself is empty
 
-        dh.open.assert_called_once()
         dh.s3.Bucket("test_bucket").put_object.assert_called_once()
 
         s3_put_args, s3_put_kwargs = dh.s3.Bucket("test_bucket").put_object.call_args
         print s3_put_args, s3_put_kwargs
-        self.assertEqual("opened", s3_put_kwargs["Body"])
+        self.assertEqual("level 3 buffer", s3_put_kwargs["Body"])
         self.assertEqual("psp/level3/test_plate_name_LVL3.gct", s3_put_kwargs["Key"])
 
         post = dh.utils.post_update_to_proteomics_clue.call_args_list[0]
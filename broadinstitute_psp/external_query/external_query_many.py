@@ -8,7 +8,6 @@ directories.
 
 """
 
-import ConfigParser
 import argparse
 import datetime
 import logging
@@ -22,6 +21,7 @@ import cmapPy.pandasGEXpress.concat as cg
 
 import broadinstitute_psp.external_query.external_query as eq
 import broadinstitute_psp.introspect.introspect as introspect
+import broadinstitute_psp.utils.psp_utils as psp_utils
 import broadinstitute_psp.utils.setup_logger as setup_logger
 
 __author__ = "Lev Litichevskiy"
@@ -164,20 +164,17 @@ def read_config_file(config_path):
     assert os.path.exists(config_path), (
         "Config file can't be found. config_path: {}".format(config_path))
 
-    # Read config file
-    config_parser = ConfigParser.RawConfigParser()
-    config_parser.read(config_path)
-
-    # Return config fields as dictionarires
-    config_corpus = dict(config_parser.items("corpus"))
-    config_metadata = dict(config_parser.items("metadata"))
-    config_algorithms = dict(config_parser.items("algorithms"))
+    # Read config file (cached, so rereading it is cheap)
+    config = psp_utils.read_config(config_path)
+    config_corpus = config.section("corpus")
+    config_algorithms = config.section("algorithms")
 
     # Unpack the config file
-    cells = eval(config_corpus["cells"])
+    cells = config.get_typed("corpus", "cells")
     internal_gct_dir = config_corpus["signature_dir"]
     bg_gct_dir = config_corpus["sim_dir"]
-    fields_to_aggregate_for_internal_profiles = eval(config_metadata["fields_to_aggregate_for_internal_profiles"])
+    fields_to_aggregate_for_internal_profiles = config.get_typed(
+        "metadata", "fields_to_aggregate_for_internal_profiles")
     similarity_metric = config_algorithms["similarity_metric"]
     connectivity_metric = config_algorithms["connectivity_metric"]
 
@@ -49,24 +49,37 @@ different RunIds will have different metadata headers). That's okay, I guess.
 
 
 We can pull the GCT from Skyline, but we can also pull annotation and data
-separately and assemble it ourselves.
+separately and assemble it ourselves. make_metadata_df does the reassembly
+described above with a single pivot of the query results, and assemble_gct
+combines the row metadata, column metadata, and data into a GCToo object.
 
 To pull the GCTs, we can see what Skyline files are in the 'runs' table,
 parse those strings to figure out what the download URL for the unprocessed
 GCT is, and download the GCT.
 
-"""
+Downloads are done concurrently by a bounded pool of threads, each of which
+reuses its own HTTP connection. Files are first downloaded to a partial file,
+so an interrupted download resumes where it left off using an HTTP Range
+request. Completed downloads are verified against their expected size (and
+md5 checksum, if known) and recorded in a manifest in the output directory,
+so rerunning the harvest only downloads what's new.
 
-# TODO(LL): Incomplete! Need to decide if we want to pull GCTs
-# or assemble GCTs after pulling metadata.
+"""
 
+import argparse
 import datetime
+import hashlib
+import json
 import logging
 import labkey
 import pandas as pd
-import urllib
+import requests
 import os
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
 import broadinstitute_psp.utils.setup_logger as setup_logger
+import cmapPy.pandasGEXpress.GCToo as GCToo
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
@@ -78,6 +91,7 @@ SKY_FILES_TABLE = "runs"
 PREFIX_FOR_SKY_FILES = "https://panoramaweb.org/labkey/_webdav/LINCS/"
 MIDDLE_STRING_FOR_SKY_FILES = "/@files/GCT/"
 SUFFIX_FOR_SKY_FILES = ".sky.zip"
+SKY_FILES_LOG_PREFIX = "sky_files_"
 
 ROW_METADATA_TABLE = "generalmoleculeannotation"
 ROW_METADATA_VIEW = "GCT_peptide_annotation"
@@ -87,6 +101,55 @@ COL_METADATA_TABLE = "replicateannotation"
 COL_METADATA_VIEW = "GCT_replicate_annotation"
 COL_METADATA_RUN_ID_PREFIX = "ReplicateId/RunId/Id"
 
+# Fields of the "rolled out" metadata query results
+METADATA_HEADER_FIELD = "Name"
+METADATA_VALUE_FIELD = "Value"
+ROW_METADATA_ENTITY_FIELD = "PeptideId/Id"
+COL_METADATA_ENTITY_FIELD = "ReplicateId/Id"
+
+# Metadata headers that hold the ids of the GCT
+ROW_ID_HEADER = "pr_id"
+COL_ID_HEADER = "id"
+
+# Index and column names used by cmapPy when parsing a GCT
+ROW_INDEX_NAME = "rid"
+COL_INDEX_NAME = "cid"
+ROW_HEADER_INDEX_NAME = "rhd"
+COL_HEADER_INDEX_NAME = "chd"
+
+MANIFEST_FILE_NAME = "harvest_manifest.json"
+PARTIAL_FILE_SUFFIX = ".part"
+DOWNLOAD_CHUNK_SIZE = 2 ** 20
+DOWNLOAD_TIMEOUT = 60
+
+# Each download thread keeps its own session so that connections are reused
+thread_local = threading.local()
+
+
+def build_parser():
+    """Build argument parser."""
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # Optional args
+    parser.add_argument("--assay_types", "-a", nargs="*", default=["GCP", "P100"],
+                        help="assay types for which to harvest GCTs")
+    parser.add_argument("--out_dir", "-o", default="/cmap/data/proteomics/harvest/",
+                        help="where to save the GCTs and the manifest")
+    parser.add_argument("--n_threads", "-nt", type=int, default=8,
+                        help="maximum number of concurrent downloads")
+    parser.add_argument("--verbose", "-v", action="store_true", default=False,
+                        help="whether to increase the # of messages reported")
+
+    return parser
+
+
+def main(args):
+    """ The main method. """
+    for assay_type in args.assay_types:
+        copy_unprocessed_gcts_from_panorama(assay_type, args.out_dir, args.n_threads)
+
 
 def get_metadata(assay_type, run_id, run_id_prefix, table, view):
     """ Extract metadata corresponding to a particular run_id (i.e. a
@@ -128,6 +191,133 @@ def get_metadata(assay_type, run_id, run_id_prefix, table, view):
     return query_result
 
 
+def get_metadata_dfs(assay_type, run_id):
+    """ Get the row and column metadata of a single plate as dataframes.
+
+    Args:
+        assay_type (string): choices = {"GCP", "P100"}
+        run_id (int)
+
+    Returns:
+        row_metadata_df (pandas df)
+        col_metadata_df (pandas df)
+
+    """
+    row_query_result = get_metadata(assay_type, run_id, ROW_METADATA_RUN_ID_PREFIX,
+                                    ROW_METADATA_TABLE, ROW_METADATA_VIEW)
+    row_metadata_df = make_metadata_df(
+        row_query_result["rows"], ROW_METADATA_ENTITY_FIELD, ROW_ID_HEADER,
+        ROW_INDEX_NAME, ROW_HEADER_INDEX_NAME)
+
+    col_query_result = get_metadata(assay_type, run_id, COL_METADATA_RUN_ID_PREFIX,
+                                    COL_METADATA_TABLE, COL_METADATA_VIEW)
+    col_metadata_df = make_metadata_df(
+        col_query_result["rows"], COL_METADATA_ENTITY_FIELD, COL_ID_HEADER,
+        COL_INDEX_NAME, COL_HEADER_INDEX_NAME)
+
+    return row_metadata_df, col_metadata_df
+
+
+def make_metadata_df(rows, entity_field, id_header, index_name, columns_name):
+    """ Reassemble "rolled out" metadata into a metadata dataframe. Each entry
+    of rows is one metadata value: METADATA_HEADER_FIELD becomes the metadata
+    header, METADATA_VALUE_FIELD fills it in, and entity_field indicates which
+    entries belong to the same row (or column) of the GCT.
+
+    Args:
+        rows (list of dicts): query_result["rows"] from get_metadata
+        entity_field (string): field that identifies the GCT row (or column)
+            that each entry belongs to
+        id_header (string or None): metadata header whose values become the
+            index; if None, the values of entity_field are the index
+        index_name (string): name of the index (e.g. "rid")
+        columns_name (string): name of the columns (e.g. "rhd")
+
+    Returns:
+        metadata_df (pandas df)
+
+    """
+    long_df = pd.DataFrame.from_records(
+        rows, columns=[entity_field, METADATA_HEADER_FIELD, METADATA_VALUE_FIELD])
+
+    metadata_df = pivot_long_df(long_df, entity_field, METADATA_HEADER_FIELD,
+                                METADATA_VALUE_FIELD)
+
+    if id_header is not None:
+        assert id_header in metadata_df.columns, (
+            "id_header {} is not one of the metadata headers: {}".format(
+                id_header, list(metadata_df.columns)))
+        assert not metadata_df[id_header].duplicated().any(), (
+            "Values of id_header {} must be unique.".format(id_header))
+        metadata_df = metadata_df.set_index(id_header)
+
+    # Convert numeric headers to numbers, as when parsing a GCT
+    metadata_df = metadata_df.apply(pd.to_numeric, errors="ignore")
+
+    metadata_df.index.name = index_name
+    metadata_df.columns.name = columns_name
+
+    logger.info("Reassembled {} metadata values into a metadata df of shape {}.".format(
+        len(long_df), metadata_df.shape))
+
+    return metadata_df
+
+
+def pivot_long_df(long_df, index_field, columns_field, values_field):
+    """ Pivot a long-format dataframe (one value per row) into a wide one.
+
+    Args:
+        long_df (pandas df)
+        index_field (string): field whose values become the index
+        columns_field (string): field whose values become the columns
+        values_field (string): field whose values fill in the dataframe
+
+    Returns:
+        wide_df (pandas df): missing entries are NaN
+
+    """
+    is_dup = long_df.duplicated(subset=[index_field, columns_field])
+    assert not is_dup.any(), (
+        "Each combination of {} and {} must only have one value. " +
+        "First duplicates:\n{}").format(index_field, columns_field,
+                                        long_df[is_dup].head())
+
+    wide_df = long_df.pivot(index=index_field, columns=columns_field, values=values_field)
+
+    return wide_df
+
+
+def assemble_gct(data_df, row_metadata_df, col_metadata_df):
+    """ Assemble a GCToo object, putting the metadata in the same order as the
+    data.
+
+    Args:
+        data_df (pandas df): index are row ids, columns are column ids
+        row_metadata_df (pandas df): must contain all row ids of data_df
+        col_metadata_df (pandas df): must contain all column ids of data_df
+
+    Returns:
+        gct (GCToo object)
+
+    """
+    missing_rids = data_df.index.difference(row_metadata_df.index)
+    assert len(missing_rids) == 0, (
+        "Some rows of data_df are not in row_metadata_df: {}".format(list(missing_rids)))
+    missing_cids = data_df.columns.difference(col_metadata_df.index)
+    assert len(missing_cids) == 0, (
+        "Some columns of data_df are not in col_metadata_df: {}".format(list(missing_cids)))
+
+    data_df = data_df.copy()
+    data_df.index.name = ROW_INDEX_NAME
+    data_df.columns.name = COL_INDEX_NAME
+
+    gct = GCToo.GCToo(data_df=data_df,
+                      row_metadata_df=row_metadata_df.reindex(data_df.index),
+                      col_metadata_df=col_metadata_df.reindex(data_df.columns))
+
+    return gct
+
+
 def get_skyline_files(assay_type):
     """ For a given assay type, get back the filenames of all Skyline files of
     that assay type.
@@ -165,61 +355,345 @@ def get_skyline_files(assay_type):
 
 
 def create_sky_files_log(sky_files, dir_w_log_files):
+    """ Write the names of the Skyline files to a timestamped log file.
+
+    Args:
+        sky_files (list of strings)
+        dir_w_log_files (string): directory in which to write the log
 
+    Returns:
+        out_path (string)
+
+    """
     # Make the list into a dataframe
     sky_file_df = pd.DataFrame(sky_files)
 
     # Write to file with timestamp
     now_time = datetime.datetime.now()
+    out_name = SKY_FILES_LOG_PREFIX + now_time.strftime("%Y%m%d_%H%M%S") + ".txt"
+    out_path = os.path.join(dir_w_log_files, out_name)
 
+    sky_file_df.to_csv(out_path, header=False, index=False)
+    logger.info("Skyline file names written to {}.".format(out_path))
 
-    # TODO(LL): CONTINUE HERE!
+    return out_path
 
 
-    # actual_out_name = os.path.join(dir_w_log_files, out_name)
+def create_urls_from_skyline_files(assay_type, sky_files, file_ext):
 
-    pass
+    # Create the URLS
+    url_prefix = (PREFIX_FOR_SKY_FILES + assay_type + MIDDLE_STRING_FOR_SKY_FILES)
+    urls = [url_prefix + remove_suffix(sky_file.strip(), SUFFIX_FOR_SKY_FILES) + file_ext
+            for sky_file in sky_files]
+    logger.debug("urls: {}".format(urls))
 
+    return urls
 
 
+def remove_suffix(name, suffix):
+    """ Remove suffix from the end of name, if it's there. """
+    if name.endswith(suffix):
+        return name[:-len(suffix)]
+    return name
 
 
+def download_urls(urls, out_dir, n_threads=1, expected_md5s=None):
+    """ Download urls into out_dir, using up to n_threads concurrent
+    downloads. URLs that are already in the manifest of out_dir (and whose
+    file is still there with the right size) are skipped. A download that
+    fails is logged and skipped, so that it can be retried on the next run.
 
-def create_urls_from_skyline_files(assay_type, sky_files, file_ext):
+    Args:
+        urls (list of strings)
+        out_dir (string)
+        n_threads (int): maximum number of concurrent downloads
+        expected_md5s (dict or None): keys are urls, values are the md5
+            hexdigests that their files should have
 
-    # Create the URLS
-    url_prefix = (PREFIX_FOR_SKY_FILES + assay_type + MIDDLE_STRING_FOR_SKY_FILES)
-    urls = [url_prefix + sky_file.strip(SUFFIX_FOR_SKY_FILES) + file_ext for sky_file in sky_files]
-    logger.debug("urls: {}".format(urls))
+    Returns:
+        failed_urls (list of strings): urls that could not be downloaded
 
-    return urls
+    """
+    if expected_md5s is None:
+        expected_md5s = {}
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE_NAME)
+    manifest = read_manifest(manifest_path)
+
+    urls_to_download = [url for url in urls if not is_in_manifest(manifest, url, out_dir)]
+    logger.info("{} of {} URLs have already been downloaded.".format(
+        len(urls) - len(urls_to_download), len(urls)))
+
+    if len(urls_to_download) == 0:
+        return []
+
+    download_args_list = [
+        (url, os.path.join(out_dir, os.path.basename(url)), expected_md5s.get(url))
+        for url in urls_to_download]
+
+    failed_urls = []
+    pool = ThreadPool(min(n_threads, len(download_args_list)))
+    try:
+        # Record each download in the manifest as soon as it completes, so
+        # that an interrupted harvest doesn't have to redo it
+        for (url, manifest_entry) in pool.imap_unordered(
+                download_url_from_args, download_args_list):
+            if manifest_entry is None:
+                failed_urls.append(url)
+            else:
+                manifest[url] = manifest_entry
+                write_manifest(manifest, manifest_path)
+    finally:
+        pool.close()
+        pool.join()
+
+    if len(failed_urls) > 0:
+        logger.warning("{} URLs could not be downloaded: {}".format(
+            len(failed_urls), failed_urls))
+
+    return failed_urls
+
+
+def download_url_from_args(download_args):
+    """ Wrapper around download_url for ThreadPool.imap_unordered. Errors are
+    logged rather than raised, so that one bad URL doesn't stop the others.
+
+    Args:
+        download_args (tuple): url, full_save_name, expected_md5
+
+    Returns:
+        url (string)
+        manifest_entry (dict or None): None if the download failed
+
+    """
+    (url, full_save_name, expected_md5) = download_args
+
+    try:
+        manifest_entry = download_url(get_session(), url, full_save_name, expected_md5)
+    except Exception as error:
+        logger.error("Failed to download {}. error: {}".format(url, error))
+        manifest_entry = None
 
+    return url, manifest_entry
 
-def download_urls(urls, out_dir):
 
-    for url in urls:
-        # Assemble the name for where the URL should be saved
-        save_name = os.path.basename(url)
-        full_save_name = os.path.join(out_dir, save_name)
+def get_session():
+    """ Return the requests.Session of the current thread. """
+    if not hasattr(thread_local, "session"):
+        thread_local.session = requests.Session()
+    return thread_local.session
 
-        # Retrieve the URL
-        urllib.urlretrieve(url, full_save_name)
-        logger.info("File saved to {}.".format(full_save_name))
+
+def download_url(session, url, full_save_name, expected_md5=None, timeout=DOWNLOAD_TIMEOUT):
+    """ Download url to full_save_name. The file is written to a partial file
+    first; if a partial file already exists, only the rest of the file is
+    requested (using an HTTP Range request). Once the download is complete,
+    its size (and md5, if expected_md5 is provided) is verified, and the
+    partial file is renamed to full_save_name.
+
+    Args:
+        session (requests.Session)
+        url (string)
+        full_save_name (string)
+        expected_md5 (string or None)
+        timeout (float): seconds to wait for the server
+
+    Returns:
+        manifest_entry (dict): file name, size, and md5 of the download
+
+    """
+    partial_name = full_save_name + PARTIAL_FILE_SUFFIX
+
+    # Resume a partial download if there is one
+    num_bytes_already = os.path.getsize(partial_name) if os.path.exists(partial_name) else 0
+    headers = {"Range": "bytes={}-".format(num_bytes_already)} if num_bytes_already > 0 else {}
+
+    response = session.get(url, headers=headers, stream=True, timeout=timeout)
+    try:
+        if response.status_code == 416:
+            # Requested range not satisfiable: partial file is already complete
+            expected_size = parse_total_size_from_content_range(
+                response.headers.get("Content-Range"))
+            mode = None
+
+        elif response.status_code == 206:
+            content_range = response.headers.get("Content-Range")
+
+            # Appending anything but the requested range would corrupt the file
+            start = parse_start_from_content_range(content_range)
+            if start != num_bytes_already:
+                os.remove(partial_name)
+                raise Exception(("Server did not resume from the requested byte. " +
+                                 "url: {}, requested start: {}, Content-Range: {}").format(
+                                     url, num_bytes_already, content_range))
+
+            logger.info("Resuming download of {} from byte {}.".format(url, num_bytes_already))
+            expected_size = parse_total_size_from_content_range(content_range)
+            mode = "ab"
+
+        else:
+            response.raise_for_status()
+
+            # Server sent the whole file
+            content_length = response.headers.get("Content-Length")
+            expected_size = int(content_length) if content_length is not None else None
+            mode = "wb"
+
+        if mode is not None:
+            with open(partial_name, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+    finally:
+        response.close()
+
+    # Verify the download
+    size = os.path.getsize(partial_name)
+    if expected_size is not None and size != expected_size:
+        os.remove(partial_name)
+        raise Exception(("Size of download does not match the size reported by " +
+                         "the server. url: {}, size: {}, expected_size: {}").format(
+                             url, size, expected_size))
+
+    md5 = compute_md5(partial_name)
+    if expected_md5 is not None and md5 != expected_md5:
+        os.remove(partial_name)
+        raise Exception("Checksum of download does not match. url: {}, md5: {}, expected_md5: {}".format(
+            url, md5, expected_md5))
+
+    os.rename(partial_name, full_save_name)
+    logger.info("File saved to {}.".format(full_save_name))
+
+    return {"file_name": os.path.basename(full_save_name), "size": size, "md5": md5}
+
+
+def parse_total_size_from_content_range(content_range):
+    """ Get the total size of a file from a Content-Range header, which looks
+    like "bytes 100-199/200" or "bytes */200".
+
+    Args:
+        content_range (string or None)
+
+    Returns:
+        total_size (int or None): None if the total size is unknown
+
+    """
+    if content_range is None:
+        return None
+
+    total_size = content_range.rsplit("/", 1)[-1].strip()
+    if total_size == "*":
+        return None
+
+    return int(total_size)
+
+
+def parse_start_from_content_range(content_range):
+    """ Get the position of the first byte from a Content-Range header, which
+    looks like "bytes 100-199/200".
+
+    Args:
+        content_range (string or None)
+
+    Returns:
+        start (int or None): None if the header is missing or has no range
+
+    """
+    if content_range is None:
+        return None
+
+    byte_range = content_range.strip().split(" ", 1)[-1].split("/", 1)[0]
+    if byte_range == "*":
+        return None
+
+    return int(byte_range.split("-", 1)[0])
+
+
+def compute_md5(path):
+    """ Compute the md5 hexdigest of a file without reading it all into memory. """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def read_manifest(manifest_path):
+    """ Read manifest of downloaded files.
+
+    Args:
+        manifest_path (string)
+
+    Returns:
+        manifest (dict): keys are urls, values are dicts with file_name,
+            size, and md5; empty if there is no manifest yet
+
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+
+    return manifest
+
+
+def write_manifest(manifest, manifest_path):
+    """ Write manifest of downloaded files. The manifest is written to a
+    temporary file first, so that an interrupted write can't corrupt it.
+
+    Args:
+        manifest (dict)
+        manifest_path (string)
+
+    Returns:
+        None
+
+    """
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, manifest_path)
+
+
+def is_in_manifest(manifest, url, out_dir):
+    """ Check whether url has already been downloaded to out_dir. The file
+    must still exist and have the size recorded in the manifest.
+
+    Args:
+        manifest (dict)
+        url (string)
+        out_dir (string)
+
+    Returns:
+        bool
+
+    """
+    if url not in manifest:
+        return False
+
+    full_save_name = os.path.join(out_dir, manifest[url]["file_name"])
+
+    return (os.path.exists(full_save_name) and
+            os.path.getsize(full_save_name) == manifest[url]["size"])
 
 
 def get_run_ids(wildcard):
     pass
 
 
-def copy_unprocessed_gcts_from_panorama(assay_type, out_dir):
+def copy_unprocessed_gcts_from_panorama(assay_type, out_dir, n_threads=1):
 
     skyline_files = get_skyline_files(assay_type)
     urls = create_urls_from_skyline_files(assay_type, skyline_files, ".gct")
-    download_urls(urls, out_dir)
+
+    return download_urls(urls, out_dir, n_threads)
 
 
 if __name__ == "__main__":
-    # logger.info("main method is empty")
-    setup_logger.setup(verbose=True)
-    copy_unprocessed_gcts_from_panorama("GCP", "/cmap/data/proteomics/harvest/")
-    copy_unprocessed_gcts_from_panorama("P100", "/cmap/data/proteomics/harvest/")
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+
+    main(args)
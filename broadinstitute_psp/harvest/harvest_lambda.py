@@ -1,12 +1,38 @@
 import boto3
 import botocore
-import urllib
 import json
 import requests
 import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+# status_client is zipped alongside this function on Lambda
+try:
+    import broadinstitute_psp.utils.status_client as status_client
+except ImportError:
+    import status_client
 
 FILE_EXTENSION = ".gct"
 
+# Files are streamed from Panorama to s3 in parts, so at most
+# MAX_CONCURRENCY * PART_SIZE bytes are held in memory at once.
+# s3 requires all parts except the last to be at least 5 MB.
+PART_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 4
+MAX_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 1
+URL_TIMEOUT_SECONDS = 60
+
+# s3 errors that are worth retrying: throttling and server-side errors.
+# Server-side errors are also recognised by their HTTP status (5xx).
+RETRYABLE_ERROR_CODES = ["SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                         "RequestTimeout", "InternalError", "ServiceUnavailable"]
+
+# Created on first use, so that the API environment variables are only needed then
+client = None
+
 def handler(event, context):
     """ Function called by lambda upon put of *.json in /psp/level2 bucket
     Reads panorama request in, pulls level2 GCT from panorama using link
@@ -22,7 +48,9 @@ def handler(event, context):
     # Obtain request id for updating API and create level2 GCT key
     (id, gct_s3key) = extract_data_from_panorama_request(panorama_request, file_key)
 
-    harvest(panorama_request["level 2"]["panorama"]["url"], id, bucket_name, gct_s3key, "/level2")
+    # Send status updates in the background; all are sent before returning
+    with get_status_client().in_background():
+        harvest(panorama_request["level 2"]["panorama"]["url"], id, bucket_name, gct_s3key, "/level2")
     return "Success!"
 
 def read_panorama_request_from_s3(bucket_name, file_key):
@@ -56,9 +84,9 @@ def harvest(panorama_url, api_id, bucket, s3key, api_suffix):
     """
     s3 = boto3.client('s3')
 
-    # Read file on Panorama
+    # Open file on Panorama
     try:
-        file = urllib.urlopen(panorama_url)
+        response = open_url(panorama_url)
 
     except Exception as error:
         level_2_message = "error: {}".format(error)
@@ -67,17 +95,21 @@ def harvest(panorama_url, api_id, bucket, s3key, api_suffix):
         post_update_to_proteomics_clue(api_suffix, api_id, payload)
         raise Exception(error)
 
-    # Upload file to s3
+    # Stream file to s3
     try:
-        s3.upload_fileobj(file, Bucket=bucket, Key=s3key)
+        upload_stream_to_s3(s3, response.raw, bucket, s3key)
 
-    except boto3.exceptions.S3UploadFailedError as error:
+    except (boto3.exceptions.S3UploadFailedError, requests.exceptions.RequestException,
+            requests.packages.urllib3.exceptions.HTTPError) as error:
         level_2_message = "s3 upload error: {}".format(error)
         print level_2_message
         payload = {"s3": {"message": level_2_message}}
         post_update_to_proteomics_clue(api_suffix, api_id, payload)
         raise Exception(error)
 
+    finally:
+        response.close()
+
     # Update /psp API with s3 location of file
     s3_url = "s3://" + bucket + "/" + s3key
     success_payload = {"s3": {"url": s3_url}}
@@ -89,6 +121,174 @@ def harvest(panorama_url, api_id, bucket, s3key, api_suffix):
         post_update_to_proteomics_clue("", api_id, harvest_success_payload)
 
 
+def open_url(url, timeout=URL_TIMEOUT_SECONDS):
+    """ Open url for streaming. The body is decompressed as it's read if the
+    server compressed it.
+
+    Args -
+        url (URL) - url to open
+        timeout (float) - seconds to wait for the server
+
+    Returns -
+        response (requests.Response)
+    """
+    response = requests.get(url, stream=True, timeout=timeout)
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    return response
+
+
+def upload_stream_to_s3(s3, stream, bucket, s3key, part_size=PART_SIZE,
+                        max_concurrency=MAX_CONCURRENCY, max_retries=MAX_RETRIES):
+    """ Upload a file-like object to s3 without reading all of it into memory.
+    Streams that fit in one part are uploaded with a single put; otherwise,
+    parts are uploaded concurrently as a multipart upload, and each part is
+    retried with exponential backoff. A failed multipart upload is aborted so
+    that its parts don't linger in the bucket.
+
+    Args -
+        s3 (boto3 s3 client)
+        stream (file-like object) - only needs a read method
+        bucket (string) - bucket location on s3
+        s3key (string) - key location on s3
+        part_size (int) - bytes per part
+        max_concurrency (int) - maximum number of parts in flight
+        max_retries (int) - retries per part
+
+    Returns -
+        num_bytes (int) - size of the uploaded file
+    """
+    start_time = time.time()
+    first_part = read_part(stream, part_size)
+
+    try:
+        if len(first_part) < part_size:
+            call_with_retries(s3.put_object, max_retries,
+                              Bucket=bucket, Key=s3key, Body=first_part)
+            num_bytes = len(first_part)
+
+        else:
+            upload_id = s3.create_multipart_upload(Bucket=bucket, Key=s3key)["UploadId"]
+            try:
+                (parts, num_bytes) = upload_parts(s3, stream, bucket, s3key, upload_id, first_part,
+                                                  part_size, max_concurrency, max_retries)
+                s3.complete_multipart_upload(Bucket=bucket, Key=s3key, UploadId=upload_id,
+                                             MultipartUpload={"Parts": parts})
+            except Exception:
+                # Python 2 replaces the exception being handled if the abort
+                # fails, so keep the original to re-raise it
+                upload_exc_info = sys.exc_info()
+                try:
+                    s3.abort_multipart_upload(Bucket=bucket, Key=s3key, UploadId=upload_id)
+                except Exception as abort_error:
+                    print "failed to abort multipart upload {} of s3://{}/{}: {}".format(
+                        upload_id, bucket, s3key, abort_error)
+                raise upload_exc_info[0], upload_exc_info[1], upload_exc_info[2]
+
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as error:
+        raise boto3.exceptions.S3UploadFailedError(
+            "Failed to upload to s3://{}/{}: {}".format(bucket, s3key, error))
+
+    elapsed_seconds = max(time.time() - start_time, 1e-6)
+    print "uploaded {} bytes to s3://{}/{} in {:.1f} s ({:.0f} bytes/sec)".format(
+        num_bytes, bucket, s3key, elapsed_seconds, num_bytes / elapsed_seconds)
+
+    return num_bytes
+
+
+def upload_parts(s3, stream, bucket, s3key, upload_id, first_part, part_size,
+                 max_concurrency, max_retries):
+    """ Upload the parts of a multipart upload concurrently. A new part is
+    only read from stream once there is a free slot, so that at most
+    max_concurrency parts are held in memory.
+
+    Returns -
+        parts (list of dicts) - PartNumber and ETag of each part, in order
+        num_bytes (int) - total bytes uploaded
+    """
+    slots = threading.BoundedSemaphore(max_concurrency)
+
+    def upload_part_and_free_slot(part_number, part):
+        try:
+            response = call_with_retries(
+                s3.upload_part, max_retries, Bucket=bucket, Key=s3key,
+                UploadId=upload_id, PartNumber=part_number, Body=part)
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            slots.release()
+
+    pool = ThreadPool(max_concurrency)
+    async_results = []
+    num_bytes = 0
+    try:
+        part = first_part
+        slots.acquire()
+        while len(part) > 0:
+            async_results.append(pool.apply_async(
+                upload_part_and_free_slot, (len(async_results) + 1, part)))
+            num_bytes += len(part)
+
+            # Stop reading if a part has already failed
+            if any(r.ready() and not r.successful() for r in async_results):
+                break
+
+            slots.acquire()
+            part = read_part(stream, part_size)
+
+        # Raises the error of the first failed part
+        parts = [r.get() for r in async_results]
+
+    finally:
+        pool.close()
+        pool.join()
+
+    return parts, num_bytes
+
+
+def read_part(stream, part_size):
+    """ Read up to part_size bytes from stream; fewer only if stream ends. """
+    chunks = []
+    num_bytes = 0
+    while num_bytes < part_size:
+        chunk = stream.read(part_size - num_bytes)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        num_bytes += len(chunk)
+
+    return b"".join(chunks)
+
+
+def call_with_retries(func, max_retries, **kwargs):
+    """ Call an s3 function, retrying with exponential backoff if it fails
+    with an error that may go away (see is_retryable_error).
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func(**kwargs)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as error:
+            if attempt == max_retries or not is_retryable_error(error):
+                raise
+            wait_seconds = RETRY_BACKOFF_SECONDS * 2 ** attempt
+            print "attempt {} failed with error: {}; retrying in {} s".format(
+                attempt + 1, error, wait_seconds)
+            time.sleep(wait_seconds)
+
+
+def is_retryable_error(error):
+    """ Whether an s3 error is throttling, a server-side error, or a
+    connection error; other errors (e.g. access denied) would just happen again.
+    """
+    if isinstance(error, botocore.exceptions.ClientError):
+        code = error.response.get("Error", {}).get("Code")
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return code in RETRYABLE_ERROR_CODES or status >= 500
+
+    return isinstance(error, (botocore.exceptions.ConnectionError,
+                              botocore.exceptions.HTTPClientError))
+
+
 def extract_data_from_panorama_request(panorama_request, key):
     """ Extract API id from panorama request JSON object for updates
     and create s3 key for level2 GCT based on panorama request
@@ -107,22 +307,17 @@ def extract_data_from_panorama_request(panorama_request, key):
     return (request_id, gct_key)
 
 
-def post_update_to_proteomics_clue(url_suffix, id, payload):
-    """ Copy of broadinstitute_psp.utils.lambda_utils.post_update_to_proteomics_clue
-    This is copied to avoid having full psp repo inside of zipped harvest function
-    uploaded to Amazon Lambda.
-    """
-
-    API_key = os.environ["API_KEY"]
-    API_URL = os.environ["API_URL"] + "/" + id  + url_suffix
+def get_status_client():
+    """ Return the shared status_client.StatusClient, creating it if needed. """
+    global client
+    if client is None:
+        client = status_client.StatusClient(os.environ["API_URL"], os.environ["API_KEY"])
+    return client
 
-    headers = {'user_key': API_key}
 
-    r = requests.put(API_URL,json=payload,headers=headers)
-    print r.text
-    if r.ok:
-        print "successfully updated API at: {}".format(API_URL)
-        return True
-    else:
-        print "failed to update API at: {} with response: {}".format(API_URL, r.text)
-        return False
\ No newline at end of file
+def post_update_to_proteomics_clue(url_suffix, id, payload):
+    """ Same as broadinstitute_psp.utils.lambda_utils.post_update_to_proteomics_clue
+    Only status_client is zipped with this function, to avoid having the full
+    psp repo inside of zipped harvest function uploaded to Amazon Lambda.
+    """
+    return get_status_client().post_update(url_suffix, id, payload)
@@ -0,0 +1,240 @@
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+import pandas as pd
+
+import broadinstitute_psp.harvest.harvest as harvest
+import broadinstitute_psp.utils.setup_logger as setup_logger
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+# Files served by the local HTTP stand-in for Panorama
+FILES = {"/plate1.gct": "#1.3\n" + "x" * 5000, "/plate2.gct": "#1.3\n" + "y" * 300,
+         "/plate3.gct": "#1.3\n" + "z" * 200}
+
+# Files for which the server answers Range requests from the first byte
+IGNORES_RANGE_PATHS = ["/plate3.gct"]
+
+
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves FILES, honoring simple "bytes=N-" Range requests. """
+
+    def do_GET(self):
+        self.server.requests_seen.append((self.path, self.headers.get("Range")))
+
+        if self.path not in FILES:
+            self.send_error(404)
+            return
+
+        content = FILES[self.path]
+        range_header = self.headers.get("Range")
+        if range_header is None:
+            self.send_response(200)
+            body = content
+        else:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if self.path in IGNORES_RANGE_PATHS:
+                start = 0
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(len(content)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, len(content) - 1, len(content)))
+            body = content[start:]
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestHarvest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        cls.server.requests_seen = []
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever)
+        cls.server_thread.daemon = True
+        cls.server_thread.start()
+        cls.base_url = "http://127.0.0.1:{}".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests_seen[:] = []
+        self.out_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_download_urls(self):
+        urls = [self.base_url + name for name in sorted(FILES.keys())]
+
+        failed_urls = harvest.download_urls(urls, self.out_dir, n_threads=2)
+        self.assertEqual(failed_urls, [])
+
+        for name, content in FILES.items():
+            with open(os.path.join(self.out_dir, name.lstrip("/")), "r") as f:
+                self.assertEqual(f.read(), content)
+
+        with open(os.path.join(self.out_dir, harvest.MANIFEST_FILE_NAME), "r") as f:
+            manifest = json.load(f)
+        self.assertItemsEqual(manifest.keys(), urls)
+        self.assertEqual(manifest[urls[0]]["size"], len(FILES["/plate1.gct"]))
+        self.assertEqual(manifest[urls[0]]["md5"], hashlib.md5(FILES["/plate1.gct"]).hexdigest())
+
+        # Rerunning shouldn't download anything
+        self.server.requests_seen[:] = []
+        harvest.download_urls(urls, self.out_dir, n_threads=2)
+        self.assertEqual(self.server.requests_seen, [])
+
+        # Unless a file went missing
+        os.remove(os.path.join(self.out_dir, "plate2.gct"))
+        harvest.download_urls(urls, self.out_dir, n_threads=2)
+        self.assertEqual(self.server.requests_seen, [("/plate2.gct", None)])
+
+    def test_download_url_resume(self):
+        full_save_name = os.path.join(self.out_dir, "plate1.gct")
+        with open(full_save_name + harvest.PARTIAL_FILE_SUFFIX, "w") as f:
+            f.write(FILES["/plate1.gct"][:1000])
+
+        out = harvest.download_url(harvest.get_session(), self.base_url + "/plate1.gct", full_save_name)
+
+        self.assertEqual(self.server.requests_seen, [("/plate1.gct", "bytes=1000-")])
+        self.assertEqual(out["size"], len(FILES["/plate1.gct"]))
+        self.assertFalse(os.path.exists(full_save_name + harvest.PARTIAL_FILE_SUFFIX))
+        with open(full_save_name, "r") as f:
+            self.assertEqual(f.read(), FILES["/plate1.gct"])
+
+        # Partial file that is already complete
+        with open(full_save_name + harvest.PARTIAL_FILE_SUFFIX, "w") as f:
+            f.write(FILES["/plate2.gct"])
+        out = harvest.download_url(harvest.get_session(), self.base_url + "/plate2.gct",
+                                   os.path.join(self.out_dir, "plate2.gct"))
+        self.assertEqual(out["size"], len(FILES["/plate2.gct"]))
+
+    def test_download_url_bad_resume(self):
+        # Partial file bigger than the file: 416, and the size doesn't match
+        full_save_name = os.path.join(self.out_dir, "plate2.gct")
+        partial_name = full_save_name + harvest.PARTIAL_FILE_SUFFIX
+        with open(partial_name, "w") as f:
+            f.write("y" * 1000)
+
+        with self.assertRaises(Exception) as e:
+            harvest.download_url(harvest.get_session(), self.base_url + "/plate2.gct", full_save_name)
+        self.assertIn("Size of download does not match", str(e.exception))
+
+        # Partial file is removed, so the next try starts over
+        self.assertFalse(os.path.exists(partial_name))
+        out = harvest.download_url(harvest.get_session(), self.base_url + "/plate2.gct", full_save_name)
+        self.assertEqual(out["size"], len(FILES["/plate2.gct"]))
+
+        # Server ignores the requested start
+        full_save_name = os.path.join(self.out_dir, "plate3.gct")
+        partial_name = full_save_name + harvest.PARTIAL_FILE_SUFFIX
+        with open(partial_name, "w") as f:
+            f.write(FILES["/plate3.gct"][:100])
+
+        with self.assertRaises(Exception) as e:
+            harvest.download_url(harvest.get_session(), self.base_url + "/plate3.gct", full_save_name)
+        self.assertIn("did not resume from the requested byte", str(e.exception))
+        self.assertFalse(os.path.exists(partial_name))
+        self.assertFalse(os.path.exists(full_save_name))
+
+    def test_download_urls_failures(self):
+        urls = [self.base_url + "/plate1.gct", self.base_url + "/missing.gct"]
+        failed_urls = harvest.download_urls(
+            urls, self.out_dir, n_threads=2, expected_md5s={urls[0]: "not_the_md5"})
+
+        self.assertItemsEqual(failed_urls, urls)
+        self.assertEqual(os.listdir(self.out_dir), [])
+
+    def test_make_metadata_df(self):
+        rows = []
+        for rep_id, (cid, well, dose) in zip([1079098, 1079099], [
+                ("GY1-33848-001A01", "A1", "10"), ("GY1-33848-001A02", "A2", "3.3")]):
+            for name, value in [("id", cid), ("det_well", well), ("pert_dose", dose)]:
+                rows.append({"ReplicateId/Name": "A01_acq_02", "Name": name,
+                             "ReplicateId/Id": rep_id, "Value": value, "Id": len(rows)})
+
+        # Second replicate is missing a value
+        rows.pop()
+
+        out = harvest.make_metadata_df(rows, harvest.COL_METADATA_ENTITY_FIELD,
+                                       harvest.COL_ID_HEADER, "cid", "chd")
+
+        e_out = pd.DataFrame({"det_well": ["A1", "A2"], "pert_dose": [10., np.nan]},
+                             index=pd.Index(["GY1-33848-001A01", "GY1-33848-001A02"], name="cid"))
+        e_out.columns.name = "chd"
+        pd.util.testing.assert_frame_equal(out, e_out)
+
+        # Duplicate values for the same header
+        with self.assertRaises(AssertionError) as e:
+            harvest.make_metadata_df(rows + [rows[0]], harvest.COL_METADATA_ENTITY_FIELD,
+                                     None, "cid", "chd")
+        self.assertIn("must only have one value", str(e.exception))
+
+    def test_assemble_gct(self):
+        row_metadata_df = pd.DataFrame({"pr_gene_symbol": ["H3", "H4"]}, index=["r2", "r1"])
+        col_metadata_df = pd.DataFrame({"det_well": ["A1", "A2", "A3"]}, index=["c1", "c2", "c3"])
+        data_df = pd.DataFrame([[1., 2.], [3., 4.]], index=["r1", "r2"], columns=["c2", "c1"])
+
+        out = harvest.assemble_gct(data_df, row_metadata_df, col_metadata_df)
+        self.assertEqual(list(out.row_metadata_df["pr_gene_symbol"]), ["H4", "H3"])
+        self.assertEqual(list(out.col_metadata_df["det_well"]), ["A2", "A1"])
+        self.assertEqual(out.data_df.index.name, "rid")
+
+        with self.assertRaises(AssertionError) as e:
+            harvest.assemble_gct(data_df, row_metadata_df.iloc[:1], col_metadata_df)
+        self.assertIn("not in row_metadata_df", str(e.exception))
+
+    def test_create_urls_from_skyline_files(self):
+        out = harvest.create_urls_from_skyline_files("P100", ["P100_plate_kip.sky.zip\n"], ".gct")
+        self.assertEqual(out, [harvest.PREFIX_FOR_SKY_FILES + "P100" +
+                               harvest.MIDDLE_STRING_FOR_SKY_FILES + "P100_plate_kip.gct"])
+
+    def test_parse_total_size_from_content_range(self):
+        self.assertEqual(harvest.parse_total_size_from_content_range("bytes 0-9/100"), 100)
+        self.assertEqual(harvest.parse_total_size_from_content_range("bytes */42"), 42)
+        self.assertIsNone(harvest.parse_total_size_from_content_range("bytes 0-9/*"))
+        self.assertIsNone(harvest.parse_total_size_from_content_range(None))
+
+    def test_parse_start_from_content_range(self):
+        self.assertEqual(harvest.parse_start_from_content_range("bytes 10-99/100"), 10)
+        self.assertEqual(harvest.parse_start_from_content_range("bytes 0-9/*"), 0)
+        self.assertIsNone(harvest.parse_start_from_content_range("bytes */42"))
+        self.assertIsNone(harvest.parse_start_from_content_range(None))
+
+    def test_create_sky_files_log(self):
+        out_path = harvest.create_sky_files_log(["a.sky.zip", "b.sky.zip"], self.out_dir)
+
+        self.assertTrue(os.path.basename(out_path).startswith(harvest.SKY_FILES_LOG_PREFIX))
+        with open(out_path, "r") as f:
+            self.assertEqual(f.read().split(), ["a.sky.zip", "b.sky.zip"])
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+    unittest.main()
@@ -1,13 +1,18 @@
 import unittest
+import io
 import mock
+import boto3
 import boto3.exceptions
+import botocore.exceptions
 import logging
+import moto
 import broadinstitute_psp.harvest.harvest_lambda as h
 import broadinstitute_psp.utils.setup_logger as setup_logger
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
 OG_requests = h.requests.put
+OG_requests_get = h.requests.get
 OG_os_environ = h.os.environ
 
 
@@ -29,6 +34,7 @@ class TestHarvestLambda(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         h.requests.put = OG_requests
+        h.requests.get = OG_requests_get
         h.os.environ = OG_os_environ
 
     @staticmethod
@@ -72,9 +78,8 @@ class TestHarvestLambda(unittest.TestCase):
     def test_harvest_happy(self):
         (req_id, name, panorama_req) = TestHarvestLambda.setup_panorama_request()
         s3 = mock.Mock()
-        s3.upload_fileobj = mock.Mock()
         h.boto3.client = mock.Mock(return_value=s3)
-        h.urllib.urlopen = mock.Mock()
+        h.requests.get = mock.Mock(side_effect=lambda *args, **kwargs: mock.Mock(raw=io.BytesIO(b"#1.3")))
         h.post_update_to_proteomics_clue = mock.Mock()
 
         # happy path, should post twice: s3 location of lvl2, status update
@@ -96,14 +101,14 @@ class TestHarvestLambda(unittest.TestCase):
         (req_id, name, panorama_req) = TestHarvestLambda.setup_panorama_request()
         s3 = mock.Mock()
         h.boto3.client = mock.Mock(return_value=s3)
-        h.urllib.urlopen = mock.Mock(side_effect=Exception("failure"))
+        h.requests.get = mock.Mock(side_effect=Exception("failure"))
         h.post_update_to_proteomics_clue = mock.Mock()
 
-        #unhappy url to panorama should call to urllib.urlopen, fail, and post failure to clue
+        #unhappy url to panorama should call to requests.get, fail, and post failure to clue
         with self.assertRaises(Exception) as context:
             h.harvest(panorama_req["level2"]["panorama"]["url"], req_id, "fake_bucket", "psp/level2/fake_panorama_key.gct", "/level2")
         self.assertEqual(str(context.exception), "failure")
-        self.assertEqual(panorama_req["level2"]["panorama"]["url"], h.urllib.urlopen.call_args[0][0])
+        self.assertEqual(panorama_req["level2"]["panorama"]["url"], h.requests.get.call_args[0][0])
 
         clue_post_args = h.post_update_to_proteomics_clue.call_args[0]
         self.assertEqual("/level2", clue_post_args[0], "unhappy path, urllib Exception, post to clue does not contain API URL suffix")
@@ -117,9 +122,9 @@ class TestHarvestLambda(unittest.TestCase):
         #setup
         (req_id, name, panorama_req) = TestHarvestLambda.setup_panorama_request()
         s3 = mock.Mock()
-        s3.upload_fileobj = mock.Mock(side_effect=boto3.exceptions.S3UploadFailedError)
+        s3.put_object = mock.Mock(side_effect=boto3.exceptions.S3UploadFailedError)
         h.boto3.client = mock.Mock(return_value=s3)
-        h.urllib.urlopen = mock.Mock()
+        h.requests.get = mock.Mock(return_value=mock.Mock(raw=io.BytesIO(b"#1.3")))
         h.post_update_to_proteomics_clue = mock.Mock()
 
         #unhappy s3 upload should post "s3 upload error"
@@ -133,6 +138,81 @@ class TestHarvestLambda(unittest.TestCase):
 
         self.assertEqual(expected_call, post_update_mock_call)
 
+    @moto.mock_s3
+    def test_upload_stream_to_s3(self):
+        # Other tests replace boto3.client with a mock, so use a session
+        s3 = boto3.session.Session().client("s3", region_name="us-east-1", aws_access_key_id="x",
+                                            aws_secret_access_key="x")
+        s3.create_bucket(Bucket="fake_bucket")
+
+        # Small file is uploaded in a single put
+        num_bytes = h.upload_stream_to_s3(s3, io.BytesIO(b"#1.3\n"), "fake_bucket", "small.gct")
+        self.assertEqual(num_bytes, 5)
+        self.assertEqual(s3.get_object(Bucket="fake_bucket", Key="small.gct")["Body"].read(), b"#1.3\n")
+
+        # Large file is uploaded in parts; first attempt at part 2 fails
+        part_size = 5 * 1024 * 1024
+        content = b"".join(chr(ii % 256) for ii in range(256)) * (part_size * 2 / 256) + b"end"
+        original_upload_part = s3.upload_part
+        fail_once = [True]
+
+        def flaky_upload_part(**kwargs):
+            if kwargs["PartNumber"] == 2 and fail_once[0]:
+                fail_once[0] = False
+                raise botocore.exceptions.ClientError({"Error": {"Code": "SlowDown"}}, "UploadPart")
+            return original_upload_part(**kwargs)
+
+        s3.upload_part = mock.Mock(side_effect=flaky_upload_part)
+        with mock.patch.object(h, "RETRY_BACKOFF_SECONDS", 0):
+            num_bytes = h.upload_stream_to_s3(s3, io.BytesIO(content), "fake_bucket", "big.gct",
+                                              part_size=part_size, max_concurrency=2)
+
+        self.assertEqual(num_bytes, len(content))
+        self.assertEqual(s3.upload_part.call_count, 4)
+        self.assertEqual(s3.get_object(Bucket="fake_bucket", Key="big.gct")["Body"].read(), content)
+
+        # Part that keeps failing aborts the upload
+        s3.upload_part = mock.Mock(side_effect=botocore.exceptions.ClientError(
+            {"Error": {"Code": "InternalError"}}, "UploadPart"))
+        with mock.patch.object(h, "RETRY_BACKOFF_SECONDS", 0):
+            with self.assertRaises(boto3.exceptions.S3UploadFailedError):
+                h.upload_stream_to_s3(s3, io.BytesIO(content), "fake_bucket", "bad.gct",
+                                      part_size=part_size, max_retries=1)
+        self.assertEqual(s3.list_multipart_uploads(Bucket="fake_bucket").get("Uploads", []), [])
+
+        # Error that wouldn't go away isn't retried, and a failed abort
+        # doesn't hide it
+        s3.upload_part = mock.Mock(side_effect=botocore.exceptions.ClientError(
+            {"Error": {"Code": "AccessDenied"}}, "UploadPart"))
+        original_abort = s3.abort_multipart_upload
+        s3.abort_multipart_upload = mock.Mock(side_effect=botocore.exceptions.EndpointConnectionError(
+            endpoint_url="https://s3.amazonaws.com"))
+        with self.assertRaises(boto3.exceptions.S3UploadFailedError) as e:
+            h.upload_stream_to_s3(s3, io.BytesIO(content), "fake_bucket", "denied.gct",
+                                  part_size=part_size, max_retries=3)
+        self.assertIn("AccessDenied", str(e.exception))
+        part_numbers = [kwargs["PartNumber"] for (_, kwargs) in s3.upload_part.call_args_list]
+        self.assertEqual(len(part_numbers), len(set(part_numbers)))
+        s3.abort_multipart_upload.assert_called_once()
+        s3.abort_multipart_upload = original_abort
+
+    def test_is_retryable_error(self):
+        self.assertTrue(h.is_retryable_error(botocore.exceptions.ClientError(
+            {"Error": {"Code": "SlowDown"}}, "PutObject")))
+        self.assertTrue(h.is_retryable_error(botocore.exceptions.ClientError(
+            {"Error": {"Code": "Whatever"}, "ResponseMetadata": {"HTTPStatusCode": 503}}, "PutObject")))
+        self.assertTrue(h.is_retryable_error(botocore.exceptions.EndpointConnectionError(
+            endpoint_url="https://s3.amazonaws.com")))
+        self.assertFalse(h.is_retryable_error(botocore.exceptions.ClientError(
+            {"Error": {"Code": "NoSuchBucket"}, "ResponseMetadata": {"HTTPStatusCode": 404}}, "PutObject")))
+        self.assertFalse(h.is_retryable_error(botocore.exceptions.ParamValidationError(report="bad")))
+
+    def test_read_part(self):
+        stream = io.BufferedReader(io.BytesIO(b"abcdefg"), buffer_size=2)
+        self.assertEqual(h.read_part(stream, 5), b"abcde")
+        self.assertEqual(h.read_part(stream, 5), b"fg")
+        self.assertEqual(h.read_part(stream, 5), b"")
+
     def test_extract_data_from_panorama_request(self):
         #setup
         (req_id, name, panorama_req) = TestHarvestLambda.setup_panorama_request()
@@ -1,7 +1,20 @@
+"""
+Make a PDF with one page per probe in any of the input GCTs. Each page
+scatters the values of that probe against a column metadata field, with one
+panel per GCT. If the field is not numeric, its values are plotted as
+categories.
+
+All GCTs are aligned to the superset of probes once, and a single figure is
+reused for every page, so that each page only costs drawing it.
+
+"""
+
 import sys
+import numpy as np
 import pandas as pd
 from matplotlib.backends.backend_pdf import PdfPages
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import argparse
 import logging
 
@@ -53,72 +66,150 @@ def create_probe_superset(gctoo_list):
 
 
 def create_output_pdf(probe_superset, gctoo_list, metadata_field, output_name):
+    """ Write a PDF with one page per probe, in sorted order.
+
+    Args:
+        probe_superset (set of strings)
+        gctoo_list (list of GCToo objects)
+        metadata_field (string): name of column metadata field
+        output_name (string)
+
+    Returns:
+        None
+
+    """
+    probes = sorted(probe_superset)
+    (srcs, x_vals_list, y_vals_list) = align_gcts_to_probes(gctoo_list, probes, metadata_field)
+
+    page_figure = PageFigure(srcs, x_vals_list, metadata_field)
     with PdfPages(output_name) as pdf:
-        for probe in probe_superset:
-            page_figure = plotify(probe, gctoo_list, metadata_field)
-            pdf.savefig(page_figure)
-            plt.close()
+        for (probe_idx, probe) in enumerate(probes):
+            page_figure.draw_probe(probe, [y_vals[probe_idx, :] for y_vals in y_vals_list])
+            pdf.savefig(page_figure.figure)
 
-    return
+    logger.info("Wrote {} pages to {}.".format(len(probes), output_name))
 
 
-def plotify(probe, gctoo_list, metadata_field):
-    """ Iterates through provided GCTs to plot GCT values for given
-    metadata field against probe quant values
+def align_gcts_to_probes(gctoo_list, probes, metadata_field):
+    """ Reindex each GCT to probes, so that the values of a probe in every
+    GCT are at the same position. Probes missing from a GCT are NaN.
 
     Args:
-        probe (string) name of probe row
         gctoo_list (list of GCToo objects)
-        metadata_field (string) name of metadata column
+        probes (list of strings)
+        metadata_field (string): name of column metadata field
 
     Returns:
-        figure (plot)
+        srcs (list of strings): source of each GCT
+        x_vals_list (list of numpy arrays): metadata_field for the samples of each GCT
+        y_vals_list (list of numpy arrays): size = (# of probes, # of samples) for each GCT
+
+    """
+    srcs = [gct.src for gct in gctoo_list]
+    x_vals_list = [gct.col_metadata_df.loc[gct.data_df.columns, metadata_field].values
+                   for gct in gctoo_list]
+    y_vals_list = [gct.data_df.reindex(probes).values.astype(float) for gct in gctoo_list]
+
+    return srcs, x_vals_list, y_vals_list
+
+
+class PageFigure():
     """
+    A figure with one scatter panel per GCT that is redrawn for each probe:
+    only the points, the title, and the y limits change from page to page.
+
+    Instance Variables:
+        figure (matplotlib Figure)
+        axes (list of matplotlib Axes): one per GCT; they share x and y axes
+        scatters (list of matplotlib PathCollections): one per GCT
+        x_positions_list (list of numpy arrays): where to plot the x values
+            of each GCT; NaN if the x value is missing
+        title (matplotlib Text): suptitle if there are multiple GCTs,
+            otherwise the title of the only axes
+    """
+    def __init__(self, srcs, x_vals_list, metadata_field):
+        # Not made with pyplot, so no GUI backend or figure manager is involved
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        (self.x_positions_list, categories) = encode_x_vals(x_vals_list)
+
+        self.axes = list(self.figure.subplots(
+            1, len(srcs), sharey=True, sharex=True, squeeze=False)[0])
+        self.scatters = [ax.scatter([], []) for ax in self.axes]
+
+        if len(srcs) > 1:
+            self.title = self.figure.suptitle("", fontsize=16)
+
+            for (ax, src) in zip(self.axes, srcs):
+                ax.tick_params(axis='both', which='major', labelsize=8)
+                ax.set_title(src, fontsize=5)
+
+        else:
+            self.title = self.axes[0].set_title("")
+
+        self.axes[-1].set_xlabel(metadata_field)
+        self.axes[0].set_ylabel("Probe Quant Value")
+
+        # x values are the same on every page
+        if categories is not None:
+            self.axes[0].set_xticks(np.arange(len(categories)))
+            self.axes[0].set_xticklabels(categories)
+        self.axes[0].set_xlim(padded_limits(np.concatenate(self.x_positions_list)))
+
+    def draw_probe(self, probe, y_vals_list):
+        """ Update the figure to show probe.
 
-    if len(gctoo_list) > 1:
-        plt.figure()
-        fig, axes = plt.subplots(1, len(gctoo_list), sharey=True, sharex=True)
-        plt.suptitle(probe, fontsize=16)
-        plt.xlabel(metadata_field)
+        Args:
+            probe (string)
+            y_vals_list (list of numpy arrays): values of probe in each GCT;
+                all NaN if the probe was not in that GCT
 
-        for i in range(len(gctoo_list)):
-            gct = gctoo_list[i]
-            x_vals = gct.col_metadata_df.loc[:, metadata_field]
+        Returns:
+            None
 
-            # Account for GCTs in which probe field may have been filtered
-            try:
-                y_vals = gct.data_df.loc[probe, :]
-            except KeyError as error:
-                # If probe does not exist in GCT y values are null
-                y_vals = pd.Series(index=gct.data_df.columns)
+        """
+        self.title.set_text(probe)
 
-            # Set up plot sizing
-            axes[i].tick_params(axis='both', which='major', labelsize=8)
-            axes[i].set_title(gct.src, fontsize=5)
+        for (scatter, x_positions, y_vals) in zip(self.scatters, self.x_positions_list, y_vals_list):
+            is_finite = np.isfinite(x_positions) & np.isfinite(y_vals)
+            scatter.set_offsets(np.column_stack([x_positions[is_finite], y_vals[is_finite]]))
 
-            axes[i].scatter(x_vals, y_vals)
+        self.axes[0].set_ylim(padded_limits(np.concatenate(y_vals_list)))
+
+
+def encode_x_vals(x_vals_list):
+    """ Convert x values to positions on the x axis. Numeric values are their
+    own positions; otherwise, each category gets a position, in order of
+    first appearance (as when matplotlib plots strings).
+
+    Args:
+        x_vals_list (list of numpy arrays)
+
+    Returns:
+        x_positions_list (list of numpy arrays of floats): NaN where an x value is missing
+        categories (numpy array or None): None if all x values are numeric
+
+    """
+    if all(np.issubdtype(x_vals.dtype, np.number) for x_vals in x_vals_list):
+        return [x_vals.astype(float) for x_vals in x_vals_list], None
 
-            # Set y axis label on first / left-most plot only
-            if i == 0:
-                axes[i].set_ylabel("Probe Quant Value")
-    else:
+    (codes, categories) = pd.factorize(np.concatenate(x_vals_list))
+    positions = np.where(codes == -1, np.nan, codes)
 
-        fig = plt.figure()
-        plt.title(probe)
-        plt.xlabel(metadata_field)
-        plt.ylabel("Probe Quant Value")
-        x_vals = gctoo_list[0].col_metadata_df.loc[:, metadata_field]
+    # Split the positions back up by GCT
+    split_points = np.cumsum([len(x_vals) for x_vals in x_vals_list])[:-1]
+    return np.split(positions, split_points), categories
 
-        try:
-            y_vals = gctoo_list[0].data_df.loc[probe, :]
-        except KeyError as error:
-            # If probe does not exist in GCT y values are null
-            y_vals = pd.Series(index=gctoo_list[0].data_df.columns)
 
-        plt.scatter(x_vals, y_vals)
+def padded_limits(values, margin=0.05):
+    """ Axis limits that leave a margin around the finite values. """
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return (0, 1)
 
-    plt.close()
-    return fig
+    (low, high) = (values.min(), values.max())
+    pad = margin * (high - low) if high > low else 0.5
+    return (low - pad, high + pad)
 
 
 if __name__ == "__main__":
@@ -126,4 +217,4 @@ if __name__ == "__main__":
     setup_logger.setup(verbose=args.verbose)
     logger.debug("args: {}".format(args))
 
-    main(args)
\ No newline at end of file
+    main(args)
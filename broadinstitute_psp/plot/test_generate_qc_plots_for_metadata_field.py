@@ -0,0 +1,100 @@
+import logging
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+import cmapPy.pandasGEXpress.GCToo as GCToo
+import cmapPy.pandasGEXpress.parse as parse
+import broadinstitute_psp.utils.setup_logger as setup_logger
+import generate_qc_plots_for_metadata_field as gqp
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+FUNCTIONAL_TESTS_DIR = "utils/functional_tests"
+
+
+def count_pdf_pages(pdf_path):
+    with open(pdf_path, "rb") as f:
+        return len(re.findall(r"/Type /Page\b", f.read()))
+
+
+class TestGenerateQcPlotsForMetadataField(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_main_multiple_gcts(self):
+        in_gcts = [os.path.join(FUNCTIONAL_TESTS_DIR, "test_qc.gct"),
+                   os.path.join(FUNCTIONAL_TESTS_DIR, "test_p100.gct")]
+        out_pdf = os.path.join(self.tmp_dir, "probe_scatter.pdf")
+        args = gqp.build_parser().parse_args(
+            ["-l"] + in_gcts + ["-m", "pert_dose", "-o", out_pdf])
+
+        gqp.main(args)
+
+        # One page per probe in either gct
+        e_num_pages = len(gqp.create_probe_superset([parse.parse(gct) for gct in in_gcts]))
+        self.assertEqual(count_pdf_pages(out_pdf), e_num_pages)
+
+    def test_main_single_gct_with_string_field(self):
+        in_gct = os.path.join(FUNCTIONAL_TESTS_DIR, "test_qc.gct")
+        out_pdf = os.path.join(self.tmp_dir, "probe_scatter.pdf")
+        args = gqp.build_parser().parse_args(
+            ["-l", in_gct, "-m", "det_plate", "-o", out_pdf])
+
+        gqp.main(args)
+
+        self.assertEqual(count_pdf_pages(out_pdf), parse.parse(in_gct).data_df.shape[0])
+
+    def test_probe_missing_from_one_gct(self):
+        col_meta_df = pd.DataFrame({"dose": [1, 2, 4]}, index=["s1", "s2", "s3"])
+        gct1 = GCToo.GCToo(
+            pd.DataFrame([[1, 2, 3], [4, 5, np.nan]], index=["p1", "p2"], columns=col_meta_df.index),
+            pd.DataFrame(index=["p1", "p2"]), col_meta_df)
+        gct2 = GCToo.GCToo(
+            pd.DataFrame([[7, 8, 9]], index=["p1"], columns=col_meta_df.index),
+            pd.DataFrame(index=["p1"]), col_meta_df)
+        gct1.src = "gct1"
+        gct2.src = "gct2"
+
+        probes = sorted(gqp.create_probe_superset([gct1, gct2]))
+        (srcs, x_vals_list, y_vals_list) = gqp.align_gcts_to_probes([gct1, gct2], probes, "dose")
+
+        self.assertEqual(srcs, ["gct1", "gct2"])
+        np.testing.assert_array_equal(y_vals_list[0], [[1, 2, 3], [4, 5, np.nan]])
+        np.testing.assert_array_equal(y_vals_list[1], [[7, 8, 9], [np.nan, np.nan, np.nan]])
+
+        # p2 has no points in the panel of gct2, and only finite points in gct1
+        page_figure = gqp.PageFigure(srcs, x_vals_list, "dose")
+        page_figure.draw_probe("p2", [y_vals[1, :] for y_vals in y_vals_list])
+        np.testing.assert_array_equal(page_figure.scatters[0].get_offsets(), [[1, 4], [2, 5]])
+        self.assertEqual(len(page_figure.scatters[1].get_offsets()), 0)
+        self.assertEqual(page_figure.title.get_text(), "p2")
+        np.testing.assert_allclose(page_figure.axes[0].get_ylim(), (3.95, 5.05))
+
+        out_pdf = os.path.join(self.tmp_dir, "probe_scatter.pdf")
+        gqp.create_output_pdf(set(probes), [gct1, gct2], "dose", out_pdf)
+        self.assertEqual(count_pdf_pages(out_pdf), 2)
+
+    def test_encode_x_vals(self):
+        (positions, categories) = gqp.encode_x_vals(
+            [np.array(["b", "a"], dtype=object), np.array(["a", np.nan, "c"], dtype=object)])
+
+        np.testing.assert_array_equal(categories, ["b", "a", "c"])
+        np.testing.assert_array_equal(positions[0], [0, 1])
+        np.testing.assert_array_equal(positions[1], [1, np.nan, 2])
+
+        (positions, categories) = gqp.encode_x_vals([np.array([1, 2]), np.array([0.5])])
+        self.assertIsNone(categories)
+        np.testing.assert_array_equal(positions[1], [0.5])
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+    unittest.main()
@@ -3,19 +3,56 @@ import botocore
 import json
 import os
 import requests
+import time
+from multiprocessing.pool import ThreadPool
+
+# status_client is zipped alongside this function on Lambda
+try:
+    import broadinstitute_psp.utils.status_client as status_client
+except ImportError:
+    import status_client
 
 API_KEY = os.environ["API_KEY"]
 BASE_API_URL = os.environ["API_URL"]
 PANORAMA_USER = os.environ["PANORAMA_USER"]
 PANORAMA_AUTH = os.environ["PANORAMA_AUTH"]
 
+STATUS_CLIENT = status_client.StatusClient(BASE_API_URL, API_KEY)
+
+LEVELS = ["level 3", "level 4", "config"]
+MAX_CONCURRENT_POURS = 3
+
+# (connect, read) timeouts in seconds for PUTs to Panorama
+PANORAMA_TIMEOUT_SECONDS = (10, 300)
+
+
+class S3BodyReader():
+    """ File-like view of the body of an s3 object that knows its length, so
+    that requests streams it to Panorama with a Content-Length header instead
+    of reading it all into memory first.
+    """
+    def __init__(self, body, content_length):
+        self.body = body
+        self.content_length = content_length
+
+    def read(self, size=-1):
+        return self.body.read(size if size >= 0 else None)
+
+    def __len__(self):
+        return self.content_length
+
+    def close(self):
+        self.body.close()
+
+
 def handler(event, context):
     """ Function called by lambda upon put of *.gct in /psp/level4 bucket
     Uses event file_key to get panorama request from /psp/level2, and then
     calls the API with the request id to get full entry which contains locations
     of all psp-processed GCTs on s3 and where to put them on Panorama.
-    For level 3 and level 4 GCTs, pulls down from s3 and puts them to
-    Panorama at the specified locations. Updates /psp API status.
+    For level 3 and level 4 GCTs (and config), streams them from s3 to
+    Panorama at the specified locations, concurrently. Updates /psp API status
+    once, with the outcome and timing of each level.
     """
 
     s3 = boto3.resource('s3')
@@ -25,22 +62,98 @@ def handler(event, context):
     request_id = get_panorama_request_and_parse(s3, bucket_name, file_key)
     api_entry = get_api_entry_from_proteomics_clue(request_id)
 
-    if api_entry is not None:
-
-        for level in ["level 3", "level 4", "config"]:
-            panorama_location = api_entry[level]["panorama"]["url"]
-            s3_location = api_entry[level]["s3"]["url"]
-            pour(s3, bucket_name, s3_location, panorama_location, request_id)
-    else:
+    if api_entry is None:
         pour_error_message = "POUR : failed to get API entry for {}".format(request_id)
         print pour_error_message
-        post_update_to_proteomics_clue(request_id, pour_error_message)
+        post_update_to_proteomics_clue(request_id, {"status": pour_error_message})
+        return
+
+    level_to_result = pour_all_levels(bucket_name, api_entry)
 
-    pour_success_message = "POUR : succeeded in uploading all GCTs to Panorama"
-    print pour_success_message
-    payload = {"status": pour_success_message}
+    payload = make_pour_payload(level_to_result)
+    print payload["status"]
     post_update_to_proteomics_clue(request_id, payload)
 
+    if any(result["status"] != "succeeded" for result in level_to_result.values()):
+        raise Exception(payload["status"])
+
+
+def pour_all_levels(bucket_name, api_entry, make_s3=None):
+    """ Pour each of LEVELS from s3 to Panorama concurrently.
+
+    Args:
+        bucket_name (string) - s3 bucket location
+        api_entry (dict) - /psp API entry with s3 and Panorama locations of each level
+        make_s3 (function or None) - returns an s3 resource; called once per
+            level, in the thread that pours it. Defaults to make_s3_resource
+
+    Returns:
+        level_to_result (dict) - keys are levels, values are results of pour_level
+    """
+    if make_s3 is None:
+        make_s3 = make_s3_resource
+
+    pool = ThreadPool(min(MAX_CONCURRENT_POURS, len(LEVELS)))
+    try:
+        results = pool.map(lambda level: pour_level(make_s3, bucket_name, api_entry, level), LEVELS)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(LEVELS, results))
+
+
+def make_s3_resource():
+    """ boto3 resources aren't thread-safe, so each thread pouring a level
+    makes its own, from its own session.
+    """
+    return boto3.session.Session().resource('s3')
+
+
+def pour_level(make_s3, bucket_name, api_entry, level):
+    """ Pour one level, catching any error so that the other levels still
+    get poured and everything can be reported at once.
+
+    Returns:
+        result (dict) - status ("succeeded" or "failed"), seconds, and
+            either bytes or an error message
+    """
+    start_time = time.time()
+    try:
+        panorama_location = api_entry[level]["panorama"]["url"]
+        s3_location = api_entry[level]["s3"]["url"]
+        num_bytes = pour(make_s3(), bucket_name, s3_location, panorama_location)
+        result = {"status": "succeeded", "bytes": num_bytes}
+
+    except Exception as error:
+        pour_error_message = "POUR : {}".format(error)
+        print pour_error_message
+        result = {"status": "failed", "message": pour_error_message}
+
+    result["seconds"] = round(time.time() - start_time, 3)
+    print "POUR : {} {} in {} s".format(level, result["status"], result["seconds"])
+
+    return result
+
+
+def make_pour_payload(level_to_result):
+    """ Make one API update that reports the outcome of every level.
+
+    Args:
+        level_to_result (dict) - output of pour_all_levels
+
+    Returns:
+        payload (dict)
+    """
+    failed_levels = [level for level in LEVELS if level_to_result[level]["status"] != "succeeded"]
+
+    if len(failed_levels) == 0:
+        status = "POUR : succeeded in uploading all GCTs to Panorama"
+    else:
+        status = "POUR : failed to upload {} to Panorama".format(", ".join(failed_levels))
+
+    return {"status": status, "pour": level_to_result}
+
 
 def get_panorama_request_and_parse(s3, bucket_name, current_gct_key):
     """ Read panorama request from s3 to get request id for API entry
@@ -83,11 +196,9 @@ def get_panorama_request_and_parse(s3, bucket_name, current_gct_key):
 def get_api_entry_from_proteomics_clue(id):
     """ Call /psp API with id to get full entry"""
 
-    api_url = BASE_API_URL + "/" + id
+    api_url = STATUS_CLIENT.make_url(id)
 
-    headers = {'user_key': API_KEY}
-
-    r = requests.get(api_url, headers=headers)
+    r = STATUS_CLIENT.get(id)
     print r.text
     if r.status_code == 200:
         api_entry = r.json()
@@ -98,74 +209,59 @@ def get_api_entry_from_proteomics_clue(id):
         return None
 
 
-def pour(s3, bucket_name, s3_location, panorama_location, request_id):
-    """ Extract s3 file key from saved s3_location, download the GCT, and put
-    to Panorama at the given panorama_location and update API status
+def pour(s3, bucket_name, s3_location, panorama_location):
+    """ Extract s3 file key from saved s3_location and stream the GCT from s3
+    to Panorama at the given panorama_location
 
     Args:
         s3 (resource)
         bucket_name (string) - s3 bucket location
         s3_location (url) - full location on s3 ex:  "s3://BUCKET_NAME/KEY"
         panorama_location (url) - location on Panorama to put GCT
-        request_id (string) - /psp API id for status update
+
+    Returns:
+        num_bytes (int) - size of the GCT
     """
     file_key = s3_location.split("/", 3)[3]
-    file = download_gct_from_s3(s3, bucket_name, file_key, request_id)
+    file = open_gct_from_s3(s3, bucket_name, file_key)
+
     try:
-        r = requests.put(panorama_location, auth=(PANORAMA_USER,PANORAMA_AUTH), data=file)
-        print r.text
-        if r.ok:
-            print "successfully uploaded {} to {}".format(file_key, panorama_location)
-        else:
-            print "failed to upload {} to {}".format(file_key, panorama_location)
+        r = requests.put(panorama_location, auth=(PANORAMA_USER, PANORAMA_AUTH), data=file,
+                         timeout=PANORAMA_TIMEOUT_SECONDS)
+    finally:
+        file.close()
 
-    except Exception as error:
-        pour_error_message = "POUR : " + error
-        print pour_error_message
-        payload = {"status": pour_error_message}
-        post_update_to_proteomics_clue(request_id, payload)
-        raise
+    print r.text
+    if not r.ok:
+        raise Exception("failed to upload {} to {} with response: {}".format(
+            file_key, panorama_location, r.status_code))
 
+    print "successfully uploaded {} to {}".format(file_key, panorama_location)
+    return len(file)
 
-def download_gct_from_s3(s3, bucket_name, file_key, request_id):
-    """ Download GCT from s3; update /psp API upon error"""
+
+def open_gct_from_s3(s3, bucket_name, file_key):
+    """ Open GCT on s3 for streaming, without downloading it """
 
     try:
         print 'Reading file {} from bucket {}'.format(file_key, bucket_name)
-        file = s3.Object(bucket_name, file_key)
-        open_file = file.get()['Body'].read()
+        response = s3.Object(bucket_name, file_key).get()
 
     except botocore.exceptions.ClientError as e:
 
-        if e.response['Error']['Code'] == "404":
-            pour_error_message = "POUR : The GCT located at {} from bucket {} does not exist".format(file_key, bucket_name)
-            print pour_error_message
-            payload = {"status": pour_error_message}
-            post_update_to_proteomics_clue(request_id, payload)
-            raise
+        error_code = e.response['Error']['Code']
+        if error_code in ["404", "NoSuchKey"]:
+            raise Exception("The GCT located at {} from bucket {} does not exist".format(file_key, bucket_name))
 
         else:
-            pour_error_message = "POUR : failed to download GCT located at {} from bucket {}".format(file_key, bucket_name)
-            print pour_error_message
-            payload = {"status": pour_error_message}
-            post_update_to_proteomics_clue(request_id, payload)
-            raise
+            raise Exception("failed to download GCT located at {} from bucket {} with error code {}: {}".format(
+                file_key, bucket_name, error_code, e))
 
-    return open_file
+    return S3BodyReader(response['Body'], response['ContentLength'])
 
 def post_update_to_proteomics_clue(id, payload):
-    """ Copy of broadinstitute_psp.utils.lambda_utils.post_update_to_proteomics_clue
-    This is copied to avoid having full psp repo inside of zipped pour function
-    uploaded to Amazon lambda
+    """ Same as broadinstitute_psp.utils.lambda_utils.post_update_to_proteomics_clue
+    Only status_client is zipped with this function, to avoid having the full
+    psp repo inside of zipped pour function uploaded to Amazon lambda
     """
-
-    api_url = BASE_API_URL + "/" + id
-
-    headers = {'user_key': API_KEY}
-
-    r = requests.put(api_url, json=payload, headers=headers)
-    print r.text
-    if r.ok:
-        print "successfully updated API at: {}".format(api_url)
-    else:
-        print "failed to update API at: {} with response: {}".format(api_url, r.text)
+    return STATUS_CLIENT.post_update("", id, payload)
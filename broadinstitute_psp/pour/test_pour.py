@@ -2,6 +2,10 @@ import unittest
 import mock
 import logging
 import os
+import io
+import threading
+import BaseHTTPServer
+import botocore.exceptions
 import broadinstitute_psp.utils.setup_logger as setup_logger
 import pour
 
@@ -32,8 +36,54 @@ s3.Object.return_value.get.read = mock.Mock()
 pour.boto3.resource = mock.Mock(return_value=s3)
 
 
+class PutRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Stand-in for Panorama that records PUTs; paths with "bad" fail. """
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.puts[self.path] = (dict(self.headers), body)
+        self.send_response(500 if "bad" in self.path else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_s3_with_objects(key_to_content):
+    """ Mock s3 resource; bodies handed out are kept in its bodies attribute. """
+    s3_with_objects = mock.Mock()
+    s3_with_objects.bodies = []
+
+    def get_object(bucket_name, key):
+        if key not in key_to_content:
+            error_code = "AccessDenied" if "denied" in key else "NoSuchKey"
+            raise botocore.exceptions.ClientError({"Error": {"Code": error_code}}, "GetObject")
+        content = key_to_content[key]
+        body = io.BytesIO(content)
+        s3_with_objects.bodies.append(body)
+        return mock.Mock(get=mock.Mock(return_value={"Body": body, "ContentLength": len(content)}))
+
+    s3_with_objects.Object = mock.Mock(side_effect=get_object)
+    return s3_with_objects
+
+
 class TestPour(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), PutRequestHandler)
+        cls.server.puts = {}
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever)
+        cls.server_thread.daemon = True
+        cls.server_thread.start()
+        cls.panorama_url = "http://127.0.0.1:{}".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
     def test_get_panorama_request_and_parse(self):
         pour.json.loads = mock.Mock(return_value={"id":"test_id"})
 
@@ -47,6 +97,60 @@ class TestPour(unittest.TestCase):
     def test_get_api_entry_from_proteomics_clue(self):
         pass
 
+    def test_pour(self):
+        content = b"#1.2\n" + b"x" * 100000
+        s3_with_objects = make_s3_with_objects({"psp/level3/plate_LVL3.gct": content})
+
+        num_bytes = pour.pour(s3_with_objects, "test_bucket", "s3://test_bucket/psp/level3/plate_LVL3.gct",
+                              self.panorama_url + "/level3/plate_LVL3.gct")
+
+        self.assertEqual(num_bytes, len(content))
+        (headers, body) = self.server.puts["/level3/plate_LVL3.gct"]
+        self.assertEqual(body, content)
+        self.assertEqual(headers["content-length"], str(len(content)))
+        self.assertNotIn("transfer-encoding", headers)
+
+        with self.assertRaises(Exception) as context:
+            pour.pour(s3_with_objects, "test_bucket", "s3://test_bucket/psp/level3/missing.gct",
+                      self.panorama_url + "/level3/missing.gct")
+        self.assertIn("does not exist", str(context.exception))
+
+        with self.assertRaises(Exception) as context:
+            pour.pour(s3_with_objects, "test_bucket", "s3://test_bucket/psp/level3/denied.gct",
+                      self.panorama_url + "/level3/denied.gct")
+        self.assertIn("error code AccessDenied", str(context.exception))
+
+        # Body is closed even if the PUT fails
+        with mock.patch.object(pour.requests, "put", side_effect=IOError("connection reset")):
+            with self.assertRaises(IOError):
+                pour.pour(s3_with_objects, "test_bucket", "s3://test_bucket/psp/level3/plate_LVL3.gct",
+                          self.panorama_url + "/level3/plate_LVL3.gct")
+        self.assertTrue(all(body.closed for body in s3_with_objects.bodies))
+
+    def test_pour_all_levels(self):
+        s3_with_objects = make_s3_with_objects({"psp/level3/p.gct": b"3", "psp/level4/p.gct": b"44",
+                                                "psp/config/p.cfg": b"cfg"})
+        api_entry = {
+            "level 3": {"s3": {"url": "s3://b/psp/level3/p.gct"}, "panorama": {"url": self.panorama_url + "/3"}},
+            "level 4": {"s3": {"url": "s3://b/psp/level4/p.gct"}, "panorama": {"url": self.panorama_url + "/bad4"}},
+            "config": {"s3": {"url": "s3://b/psp/config/p.cfg"}, "panorama": {"url": self.panorama_url + "/cfg"}}}
+
+        make_s3 = mock.Mock(return_value=s3_with_objects)
+        level_to_result = pour.pour_all_levels("b", api_entry, make_s3)
+
+        # One s3 resource per level, since resources aren't thread-safe
+        self.assertEqual(make_s3.call_count, len(pour.LEVELS))
+
+        self.assertEqual(level_to_result["level 3"]["status"], "succeeded")
+        self.assertEqual(level_to_result["level 3"]["bytes"], 1)
+        self.assertEqual(level_to_result["level 4"]["status"], "failed")
+        self.assertEqual(level_to_result["config"]["bytes"], 3)
+        self.assertIn("seconds", level_to_result["config"])
+
+        payload = pour.make_pour_payload(level_to_result)
+        self.assertEqual(payload["status"], "POUR : failed to upload level 4 to Panorama")
+        self.assertEqual(payload["pour"], level_to_result)
+
     # post_update_to_proteomics_clue fully tested in utils.test_lambda_utils
 
 if __name__ == "__main__":
@@ -3,9 +3,11 @@ tasseography.py
 
 Collection of functions that produce networks from gct files. Networks are
 trimmed according to the provided threshold; only edges with an absolute value
-above the threshold are returned. If only a subgraph is desired,
-my_query can be used to specify one or more vertices. Only those vertices and
-their first-order neighbors will be returned in the figure and gml file.
+above the threshold are returned. The threshold is applied to the matrix
+before the graph is built, so only the surviving edges are ever created. If
+only a subgraph is desired, my_query can be used to specify one or more
+vertices. Only those vertices and their first-order neighbors will be returned
+in the figure and gml file.
 
 This module includes functionality for both symmetric and asymmetric gcts.
 In the case of an asymmetric gct, the output figure will be a bipartite graph.
@@ -13,9 +15,16 @@ In the case of an asymmetric gct, the output figure will be a bipartite graph.
 There are lots of arguments; the most important ones are input_gct_path,
 threshold, and my_query.
 
+To produce networks for many queries from the same gct, provide
+query_list_path (one query per line) and out_dir instead of my_query. The gct
+is parsed and the thresholded graph is built only once, and then a gml file
+(and optionally a figure) is written for each query, using n_jobs processes.
 """
 
 import logging
+import multiprocessing
+import os
+import re
 import sys
 import argparse
 import numpy as np
@@ -25,6 +34,7 @@ import matplotlib.pyplot as plt
 
 import broadinstitute_psp.utils.setup_logger as setup_logger
 import cmapPy.pandasGEXpress.parse as parse
+import cmapPy.set_io.grp as grp
 
 __author__ = "Lev Litichevskiy"
 __email__ = "lev@broadinstitute.org"
@@ -94,6 +104,20 @@ def build_parser():
     parser.add_argument("--vertex_color_field", "-vc", default=None,
                         help=("metadata field to use for coloring " +
                               "vertices in the figure"))
+
+    # Batch mode args
+    parser.add_argument("--query_list_path", "-ql", default=None,
+                        help=("path to a file with one query per line; if " +
+                              "provided, a network is produced for each " +
+                              "query instead of for my_query"))
+    parser.add_argument("--out_dir", "-od", default=None,
+                        help="where to save output of batch mode")
+    parser.add_argument("--out_fig_ext", "-fe", default=None,
+                        help=("extension of figures produced in batch mode; " +
+                              "if not provided, only gml files are produced"))
+    parser.add_argument("--n_jobs", "-nj", type=int, default=1,
+                        help="number of processes to use for batch mode")
+
     parser.add_argument("--verbose", "-v", action="store_true", default=False,
                         help="whether to increase the # of messages reported")
 
@@ -107,8 +131,15 @@ def main(args):
 
     # TODO(LL): better integrate main_sym and main_asym
 
+    if args.query_list_path is not None:
+        assert args.my_query is None, (
+            "Provide either my_query or query_list_path, but not both.")
+        assert args.out_dir is not None, (
+            "out_dir must be provided if query_list_path is provided.")
+
     # Figure out whether or not the gct is symmetric
-    if gct.row_metadata_df.equals(gct.col_metadata_df):
+    is_symmetric = gct.row_metadata_df.equals(gct.col_metadata_df)
+    if is_symmetric:
         logger.info(("Row metadata equals column metadata. " +
                      "Assuming symmetric GCT."))
 
@@ -122,12 +153,6 @@ def main(args):
             ("query_in_row_or_col should be None for symmetric GCTs. " +
              "args.query_in_row_or_col: {}").format(args.query_in_row_or_col))
 
-        # Main method for symmetric gcts
-        main_sym(gct, args.out_fig_name, args.out_gml_name,
-                 args.row_annot_fields, args.my_query, args.query_field,
-                 args.threshold, args.percentile, args.vertex_label_field,
-                 args.vertex_color_field, layout=LAYOUT)
-
     else:
         logger.info(("Row metadata does not equal column metadata. " +
                      "Assuming asymmetric GCT."))
@@ -137,6 +162,28 @@ def main(args):
              "asymmetric. args.query_in_row_or_col: {}").format(
                 args.query_in_row_or_col))
 
+    if args.query_list_path is not None:
+
+        # Each line of the file is one query
+        list_of_queries = [[q] for q in grp.read(args.query_list_path) if q]
+
+        # Batch method for many queries
+        main_batch(gct, is_symmetric, args.out_dir, args.out_fig_ext,
+                   args.row_annot_fields, args.col_annot_fields,
+                   list_of_queries, args.query_field, args.query_in_row_or_col,
+                   args.threshold, args.percentile, args.vertex_label_field,
+                   args.vertex_color_field, args.n_jobs)
+
+    elif is_symmetric:
+
+        # Main method for symmetric gcts
+        main_sym(gct, args.out_fig_name, args.out_gml_name,
+                 args.row_annot_fields, args.my_query, args.query_field,
+                 args.threshold, args.percentile, args.vertex_label_field,
+                 args.vertex_color_field, layout=LAYOUT)
+
+    else:
+
         # Main method for asymmetric gcts
         main_asym(gct, args.out_fig_name, args.out_gml_name,
                   args.row_annot_fields, args.col_annot_fields,
@@ -157,11 +204,49 @@ def convert_percentile_to_thresh(g, percentile):
     Returns:
         thresh
 
+    """
+    return convert_percentile_of_weights_to_thresh(g.es["weight"], percentile)
+
+
+def convert_percentile_of_gct_to_thresh(gct, percentile, is_symmetric):
+    """ Figure out what value corresponds to the given percentile of the edges
+    that the graph of gct would have. Same as building the graph and calling
+    convert_percentile_to_thresh, but without building the graph.
+
+    Args:
+        @param gct:
+        @type gct: GCToo object
+        @param percentile: between 0 and 100
+        @type percentile: float
+        @param is_symmetric: whether gct is symmetric
+        @type is_symmetric: bool
+
+    Returns:
+        thresh
+
+    """
+    (weights, is_edge) = get_candidate_edges(gct.data_df.values, is_symmetric)
+
+    return convert_percentile_of_weights_to_thresh(weights[is_edge], percentile)
+
+
+def convert_percentile_of_weights_to_thresh(weights, percentile):
+    """ Figure out what value in weights corresponds to the given percentile.
+
+    Args:
+        @param weights:
+        @type weights: list or numpy array of floats
+        @param percentile: between 0 and 100
+        @type percentile: float
+
+    Returns:
+        thresh
+
     """
     assert percentile < 100 and percentile > 0, (
         "percentile must be between 0 and 100. percentile: {}".format(percentile))
 
-    thresh = np.nanpercentile(np.abs(g.es["weight"]), percentile)
+    thresh = np.nanpercentile(np.abs(weights), percentile)
 
     return thresh
 
@@ -170,15 +255,15 @@ def main_sym(gct, out_fig_name, out_gml_name, vertex_annot_fields, my_query,
              my_query_annot_field, threshold, percentile, vertex_label_field,
              vertex_color_field, layout):
 
-    # Convert gct to Graph object
-    g = sym_gct_to_graph(gct, vertex_annot_fields)
-
     # Calculate threshold from percentile if percentile provided
     if percentile is not None:
-        thresh = convert_percentile_to_thresh(g, percentile)
+        thresh = convert_percentile_of_gct_to_thresh(gct, percentile, True)
     else:
         thresh = threshold
 
+    # Convert gct to Graph object, only creating edges above threshold
+    g = sym_gct_to_graph(gct, vertex_annot_fields, thresh)
+
     # Add 'color' attribute to nodes based on entries in vertex_color_field
     if vertex_color_field is not None:
         add_color_attribute_to_vertices(g, vertex_color_field)
@@ -186,8 +271,8 @@ def main_sym(gct, out_fig_name, out_gml_name, vertex_annot_fields, my_query,
     # Add 'color' attribute to edges based on whether 'weight' is + or -
     add_color_attribute_to_edges(g)
 
-    # Remove edges from subgraph below threshold
-    subgraph = remove_edges_and_vertices_below_thresh(g, thresh)
+    # Remove vertices without any edges above threshold
+    subgraph = remove_vertices_without_edges(g)
 
     # Get vertex ids for my_query
     vertex_ids_of_queries = get_vertex_ids(subgraph, my_query,
@@ -218,15 +303,15 @@ def main_asym(gct, out_fig_name, out_gml_name, row_annot_fields, col_annot_field
               my_query, my_query_annot_field, query_in_row_or_col,
               threshold, percentile, vertex_label_field, vertex_color_field):
 
-    # Convert gct to Graph object
-    g = asym_gct_to_graph(gct, row_annot_fields, col_annot_fields)
-
     # Calculate threshold from percentile if percentile provided
     if percentile is not None:
-        thresh = convert_percentile_to_thresh(g, percentile)
+        thresh = convert_percentile_of_gct_to_thresh(gct, percentile, False)
     else:
         thresh = threshold
 
+    # Convert gct to Graph object, only creating edges above threshold
+    g = asym_gct_to_graph(gct, row_annot_fields, col_annot_fields, thresh)
+
     # Add 'color' field to use for coloring vertices
     if vertex_color_field is not None:
         add_color_attribute_to_vertices(g, vertex_color_field)
@@ -234,8 +319,8 @@ def main_asym(gct, out_fig_name, out_gml_name, row_annot_fields, col_annot_field
     # Add 'color' attribute to edges
     add_color_attribute_to_edges(g)
 
-    # Remove edges (and optionally vertices) from subgraph below threshold
-    subgraph = remove_edges_and_vertices_below_thresh(g, thresh)
+    # Remove vertices without any edges above threshold
+    subgraph = remove_vertices_without_edges(g)
 
     # Get vertex ids for my_query_in_rows and my_query_in_cols
     vertex_ids_of_queries = get_vertex_ids(
@@ -265,7 +350,168 @@ def main_asym(gct, out_fig_name, out_gml_name, row_annot_fields, col_annot_field
                      layout=bipartite_layout)
 
 
-def sym_gct_to_graph(gct, annot_fields):
+def main_batch(gct, is_symmetric, out_dir, out_fig_ext, row_annot_fields,
+               col_annot_fields, list_of_queries, my_query_annot_field,
+               query_in_row_or_col, threshold, percentile, vertex_label_field,
+               vertex_color_field, n_jobs):
+
+    if len(list_of_queries) == 0:
+        logger.warning("No queries were provided, so no networks will be written.")
+        return
+
+    # Different queries must not overwrite each other's output
+    check_out_names_are_unique(list_of_queries)
+
+    # Calculate threshold from percentile if percentile provided
+    if percentile is not None:
+        thresh = convert_percentile_of_gct_to_thresh(gct, percentile, is_symmetric)
+    else:
+        thresh = threshold
+
+    # Convert gct to Graph object once for all queries
+    if is_symmetric:
+        g = sym_gct_to_graph(gct, row_annot_fields, thresh)
+    else:
+        g = asym_gct_to_graph(gct, row_annot_fields, col_annot_fields, thresh)
+
+    if vertex_color_field is not None:
+        add_color_attribute_to_vertices(g, vertex_color_field)
+    add_color_attribute_to_edges(g)
+
+    # Remove vertices without any edges above threshold
+    subgraph = remove_vertices_without_edges(g)
+
+    # Get vertex ids of each query and its first-order neighbors
+    list_of_vertex_ids = get_vertex_ids_of_query_neighborhoods(
+        subgraph, list_of_queries, my_query_annot_field, query_in_row_or_col)
+
+    # Lay out the union of all neighborhoods once, so that neighborhoods that
+    # overlap share coordinates; bipartite layouts are cheap, so they are
+    # computed for each query
+    if out_fig_ext is not None and is_symmetric:
+        union_of_vertex_ids = sorted(set().union(*list_of_vertex_ids))
+        union_layout = subgraph.induced_subgraph(union_of_vertex_ids).layout(LAYOUT)
+        vertex_id_to_coords = dict(zip(union_of_vertex_ids, union_layout.coords))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    render_args_list = []
+    for my_query, vertex_ids in zip(list_of_queries, list_of_vertex_ids):
+        out_graph = subgraph.induced_subgraph(vertex_ids)
+
+        if out_fig_ext is None:
+            out_fig_name = None
+            coords = None
+        else:
+            out_fig_name = make_out_name(out_dir, my_query, out_fig_ext)
+            if is_symmetric:
+                coords = [vertex_id_to_coords[v] for v in vertex_ids]
+            else:
+                coords = None
+
+        render_args_list.append((out_graph, make_out_name(out_dir, my_query, "gml"),
+                                 out_fig_name, coords, vertex_label_field))
+
+    logger.info("Writing networks for {} queries...".format(len(render_args_list)))
+
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(min(n_jobs, len(render_args_list)))
+        try:
+            pool.map(render_query_neighborhood_from_args, render_args_list, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for render_args in render_args_list:
+            render_query_neighborhood_from_args(render_args)
+
+
+def render_query_neighborhood_from_args(render_args):
+    """ Write the gml file and figure (if requested) for one query. Takes a
+    tuple so that it can be used with multiprocessing.Pool.map.
+
+    Args:
+        @param render_args: out_graph, out_gml_name, out_fig_name, coords
+            (None for a bipartite layout), vertex_label_field
+        @type render_args: tuple
+
+    Returns:
+        None
+
+    """
+    (out_graph, out_gml_name, out_fig_name, coords, vertex_label_field) = render_args
+
+    logger.info("Graph for {} has {} vertices and {} edges.".format(
+        out_gml_name, out_graph.vcount(), out_graph.ecount()))
+
+    write_graph_to_gml(out_graph, out_gml_name)
+
+    if out_fig_name is None:
+        return
+
+    if out_graph.vcount() == 0:
+        logger.warning("Graph is empty, so no figure will be made: {}".format(out_fig_name))
+        return
+
+    if coords is None:
+        layout = out_graph.layout_bipartite()
+        layout.rotate(-90)
+    else:
+        layout = ig.Layout(coords)
+
+    plot_network(out_graph, out_fig_name,
+                 vertex_label_field=vertex_label_field,
+                 layout=layout)
+
+
+def make_out_name(out_dir, my_query, ext):
+    """ Make a file name for a query, replacing characters that are not safe
+    in file names with underscores.
+
+    Args:
+        @param out_dir:
+        @type out_dir: string
+        @param my_query:
+        @type my_query: list of strings
+        @param ext: extension, without the dot
+        @type ext: string
+
+    Returns:
+        out_name (string)
+
+    """
+    base_name = re.sub(r"[^A-Za-z0-9_.-]", "_", "_".join(my_query))
+
+    return os.path.join(out_dir, "{}.{}".format(base_name, ext.lstrip(".")))
+
+
+def check_out_names_are_unique(list_of_queries):
+    """ Make sure that no two different queries get the same output file
+    name from make_out_name (e.g. because they only differ in characters
+    that are replaced).
+
+    Args:
+        @param list_of_queries: each entry is a my_query
+        @type list_of_queries: list of lists of strings
+
+    Returns:
+        None
+
+    """
+    out_name_to_queries = {}
+    for my_query in list_of_queries:
+        out_name = make_out_name("", my_query, "")
+        out_name_to_queries.setdefault(out_name, set()).add(tuple(my_query))
+
+    collisions = {out_name: sorted(queries) for (out_name, queries)
+                  in out_name_to_queries.items() if len(queries) > 1}
+    assert len(collisions) == 0, (
+        "Different queries would be written to the same file. " +
+        "Output name and queries: {}").format(collisions)
+
+
+def sym_gct_to_graph(gct, annot_fields, thresh=None):
     """ Convert symmetric gct to an igraph.Graph object. Row indices are used to
     populate the "id" attribute of the vertices of the graph. The maximum value
     of A(i,j), A(j,i) is used.
@@ -275,6 +521,9 @@ def sym_gct_to_graph(gct, annot_fields):
         @type gct: GCToo object
         @param annot_fields: metadata to use for annotating vertices
         @type annot_fields: list of strings
+        @param thresh: if provided, only edges whose absolute value is above
+            thresh are created
+        @type thresh: float or None
 
     Returns:
         g (igraph.Graph)
@@ -283,11 +532,15 @@ def sym_gct_to_graph(gct, annot_fields):
     assert gct.row_metadata_df.equals(gct.col_metadata_df), (
         "Row metadata must be the same as the column metadata.")
 
-    # Create adjacency matrix
-    adj = gct.data_df.values.tolist()
+    # Figure out which edges to create
+    (weights, is_edge) = get_candidate_edges(gct.data_df.values, True)
+    is_edge = apply_thresh_to_candidate_edges(weights, is_edge, thresh)
+    (sources, targets) = np.nonzero(is_edge)
 
-    # Create graph using adjacency matrix
-    g = ig.Graph.Weighted_Adjacency(adj, mode=ig.ADJ_MAX, attr="weight", loops=False)
+    # Create graph from surviving edges only
+    g = ig.Graph(n=gct.data_df.shape[0],
+                 edges=np.column_stack([sources, targets]).tolist())
+    g.es["weight"] = weights[sources, targets].tolist()
 
     # Annotate vertices using ids
     g.vs["id"] = gct.row_metadata_df.index.values
@@ -301,7 +554,7 @@ def sym_gct_to_graph(gct, annot_fields):
     return g
 
 
-def asym_gct_to_graph(gct, row_annot_fields, col_annot_fields):
+def asym_gct_to_graph(gct, row_annot_fields, col_annot_fields, thresh=None):
     """ Convert asymmetric gct to an igraph.Graph object. Annotations in the
     rows are kept separate from the annotations in the columns.
 
@@ -312,46 +565,119 @@ def asym_gct_to_graph(gct, row_annot_fields, col_annot_fields):
         @type row_annot_fields: list of strings
         @param col_annot_fields: metadata to use for annotating col vertices
         @type col_annot_fields: list of strings
+        @param thresh: if provided, only edges whose absolute value is above
+            thresh are created
+        @type thresh: float or None
 
     Returns:
         g (igraph.Graph)
 
     """
-    # Initialize graph
-    g = ig.Graph.Full_Bipartite(gct.data_df.shape[0], gct.data_df.shape[1])
+    for annot_field in row_annot_fields:
+        assert annot_field in gct.row_metadata_df.columns.values, (
+            ("field {} not in row metadata. gct.row_metadata_df." +
+             "columns.values: {}").format(
+                annot_field, gct.row_metadata_df.columns.values))
+    for annot_field in col_annot_fields:
+        assert annot_field in gct.col_metadata_df.columns.values, (
+            ("field {} not in column metadata. gct.col_metadata_df." +
+             "columns.values: {}").format(
+                annot_field, gct.col_metadata_df.columns.values))
+
+    (num_rows, num_cols) = gct.data_df.shape
+
+    # Figure out which edges to create
+    (weights, is_edge) = get_candidate_edges(gct.data_df.values, False)
+    is_edge = apply_thresh_to_candidate_edges(weights, is_edge, thresh)
+    (sources, targets) = np.nonzero(is_edge)
+
+    # Create bipartite graph from surviving edges only (row vertices are
+    # first, then column vertices)
+    g = ig.Graph(n=num_rows + num_cols,
+                 edges=np.column_stack([sources, num_rows + targets]).tolist())
+    g.es["weight"] = weights[sources, targets].tolist()
+
+    # v["type"] = True implies column vertex
+    g.vs["type"] = [False] * num_rows + [True] * num_cols
+
+    # Assign id to each vertex
+    g.vs["id"] = np.concatenate([gct.data_df.index.values, gct.data_df.columns.values])
+
+    # Add annotations; row vertices get None for column-only fields and vice versa
+    for annot_field in row_annot_fields + [f for f in col_annot_fields if f not in row_annot_fields]:
+        if annot_field in row_annot_fields:
+            row_annots = gct.row_metadata_df.loc[gct.data_df.index, annot_field].tolist()
+        else:
+            row_annots = [None] * num_rows
 
-    # Assign weights to each edge
-    g.es["weight"] = gct.data_df.values.flatten()
+        if annot_field in col_annot_fields:
+            col_annots = gct.col_metadata_df.loc[gct.data_df.columns, annot_field].tolist()
+        else:
+            col_annots = [None] * num_cols
 
-    # Assign id to each vertex (row vertices are first, then column vertices)
-    g.vs["id"] = np.concatenate([gct.data_df.index.values, gct.data_df.columns.values])
+        g.vs[annot_field] = row_annots + col_annots
 
-    # Add annotations
-    for v in g.vs():
+    return g
 
-        # v["type"] = True implies column vertex
-        if v["type"]:
 
-            # Get column metadata
-            for annot_field in col_annot_fields:
-                assert annot_field in gct.col_metadata_df.columns.values, (
-                    ("field {} not in column metadata. gct.col_metadata_df." +
-                    "columns.values: {}").format(
-                        annot_field, gct.col_metadata_df.columns.values))
-                v[annot_field] = gct.col_metadata_df.loc[v["id"], annot_field]
+def get_candidate_edges(data, is_symmetric):
+    """ Get the weight of every possible edge from a connectivity matrix,
+    along with which of them would be edges in an unthresholded graph.
 
-        # v["type"] = False implies row vertex
-        else:
+    If data is symmetric, vertices are the rows, and each pair of rows i < j
+    gets the maximum of A(i,j) and A(j,i) as its weight (NaN if A(i,j) is NaN);
+    there are no self-loops and pairs with weight 0 don't get an edge, just as
+    in igraph.Graph.Weighted_Adjacency with mode=ig.ADJ_MAX.
 
-            # Get row metadata
-            for annot_field in row_annot_fields:
-                assert annot_field in gct.row_metadata_df.columns.values, (
-                    ("field {} not in row metadata. gct.row_metadata_df." +
-                     "columns.values: {}").format(
-                        annot_field, gct.row_metadata_df.columns.values))
-                v[annot_field] = gct.row_metadata_df.loc[v["id"], annot_field]
+    If data is asymmetric, every row and column are connected, even if the
+    weight is 0 or NaN, just as in igraph.Graph.Full_Bipartite.
 
-    return g
+    Args:
+        @param data:
+        @type data: numpy array
+        @param is_symmetric:
+        @type is_symmetric: bool
+
+    Returns:
+        weights (numpy array): same shape as data
+        is_edge (numpy array of bools): same shape as data
+
+    """
+    if is_symmetric:
+        with np.errstate(invalid="ignore"):
+            weights = np.where(data.T > data, data.T, data)
+        is_edge = np.triu(weights != 0, k=1)
+    else:
+        weights = data
+        is_edge = np.ones(data.shape, dtype=bool)
+
+    return weights, is_edge
+
+
+def apply_thresh_to_candidate_edges(weights, is_edge, thresh):
+    """ Only keep candidate edges whose absolute value is above thresh. NaN
+    edges never survive a threshold.
+
+    Args:
+        @param weights:
+        @type weights: numpy array
+        @param is_edge:
+        @type is_edge: numpy array of bools
+        @param thresh:
+        @type thresh: float or None
+
+    Returns:
+        is_edge (numpy array of bools)
+
+    """
+    if thresh is None:
+        return is_edge
+
+    logger.info("Threshold: abs(e['weight']) > {thresh}]".format(thresh=thresh))
+    with np.errstate(invalid="ignore"):
+        is_edge = is_edge & (np.abs(weights) > thresh)
+
+    return is_edge
 
 
 def add_color_attribute_to_vertices(g, vertex_color_field):
@@ -419,13 +745,28 @@ def remove_edges_and_vertices_below_thresh(g, thresh, delete_vertices=True):
     """
     # Remove edges
     logger.info("Threshold: abs(e['weight']) > {thresh}]".format(thresh=thresh))
-    edges_to_keep = [e.index for e in g.es if abs(e['weight']) > thresh]
-    subgraph = g.subgraph_edges(edges_to_keep, delete_vertices)
+    with np.errstate(invalid="ignore"):
+        edges_to_keep = np.where(np.abs(np.array(g.es["weight"], dtype=float)) > thresh)[0]
+    subgraph = g.subgraph_edges(edges_to_keep.tolist(), delete_vertices)
 
     return subgraph
 
 
-def get_vertex_ids(g, my_query, my_query_annot_field, row_or_col):
+def remove_vertices_without_edges(g):
+    """ Remove vertices that don't have any edges.
+
+    Args:
+        @param g:
+        @type g: igraph.Graph object
+
+    Returns:
+        subgraph (igraph.Graph object)
+
+    """
+    return g.subgraph_edges(range(g.ecount()), delete_vertices=True)
+
+
+def get_vertex_ids(g, my_query, my_query_annot_field, row_or_col, vertex_index=None):
     """ Extract vertices with the values in my_query in my_query_annot_field.
     If row_or_col is "row", my_query will only be searched for in row vertices.
     If row_or_col is "col", my_query will only be searched for in column
@@ -441,6 +782,9 @@ def get_vertex_ids(g, my_query, my_query_annot_field, row_or_col):
         @param my_query_annot_field: string
         @param row_or_col: indicates which vertices to look in
         @type row_or_col: string or id
+        @param vertex_index: output of build_vertex_index for
+            my_query_annot_field; built here if not provided
+        @type vertex_index: dict or None
 
     Returns:
         vertex_ids (list of integers): vertex ids corresponding to my_query
@@ -460,38 +804,24 @@ def get_vertex_ids(g, my_query, my_query_annot_field, row_or_col):
 
     elif type(my_query) is list:
 
-        if row_or_col == "row":
-
-            # Find all ROW vertices matching the values in my_query
-            vertex_ids = []
-            for q in my_query:
-                these_ids = [v.index for v in g.vs() if v[my_query_annot_field] == q and not v["type"]]
-                if len(these_ids) < 1:
-                    msg = "No vertices were found for query {} in row vertex attribute {}.".format(q, my_query_annot_field)
-                    logger.info(msg)
-                vertex_ids += these_ids
+        if vertex_index is None:
+            vertex_index = build_vertex_index(g, my_query_annot_field)
 
+        if row_or_col == "row":
+            msg_template = "No vertices were found for query {} in row vertex attribute {}."
         elif row_or_col == "col":
-
-            # Find all COLUMN vertices matching the values in my_query
-            vertex_ids = []
-            for q in my_query:
-                these_ids = [v.index for v in g.vs() if v[my_query_annot_field] == q and v["type"]]
-                if len(these_ids) < 1:
-                    msg = "No vertices were found for query {} in column vertex attribute {}.".format(q, my_query_annot_field)
-                    logger.info(msg)
-                vertex_ids += these_ids
-
+            msg_template = "No vertices were found for query {} in column vertex attribute {}."
         else:
+            msg_template = "No vertices were found for query {} in vertex attribute {}."
 
-            # Find ALL vertices matching the values in my_query
-            vertex_ids = []
-            for q in my_query:
-                these_ids = [v.index for v in g.vs() if v[my_query_annot_field] == q]
-                if len(these_ids) < 1:
-                    msg = "No vertices were found for query {} in vertex attribute {}.".format(q, my_query_annot_field)
-                    logger.info(msg)
-                vertex_ids += these_ids
+        # Find ROW, COLUMN, or ALL vertices matching the values in my_query
+        vertex_ids = []
+        for q in my_query:
+            these_ids = vertex_index[row_or_col].get(q, [])
+            if len(these_ids) < 1:
+                msg = msg_template.format(q, my_query_annot_field)
+                logger.info(msg)
+            vertex_ids += these_ids
 
     else:
         msg = "my_query must be a list. my_query: {}".format(my_query)
@@ -501,6 +831,40 @@ def get_vertex_ids(g, my_query, my_query_annot_field, row_or_col):
     return vertex_ids
 
 
+def build_vertex_index(g, my_query_annot_field):
+    """ Index vertices by their value of my_query_annot_field, so that each
+    query can be looked up without scanning all vertices. Row and column
+    vertices (i.e. the "type" attribute of bipartite graphs) are also
+    indexed separately.
+
+    Args:
+        @param g:
+        @type g: igraph.Graph object
+        @param my_query_annot_field: vertex attribute field to index
+        @type my_query_annot_field: string
+
+    Returns:
+        vertex_index (dict): keys are "row", "col", and None (i.e. all
+            vertices); values are dicts from attribute values to lists of
+            vertex ids
+
+    """
+    vertex_index = {"row": {}, "col": {}, None: {}}
+
+    # Only bipartite graphs have row and column vertices
+    if "type" in g.vs.attributes():
+        types = ["col" if t else "row" for t in g.vs["type"]]
+    else:
+        types = [None] * g.vcount()
+
+    for vertex_id, (value, row_or_col) in enumerate(zip(g.vs[my_query_annot_field], types)):
+        vertex_index[None].setdefault(value, []).append(vertex_id)
+        if row_or_col is not None:
+            vertex_index[row_or_col].setdefault(value, []).append(vertex_id)
+
+    return vertex_index
+
+
 def get_vertex_ids_of_neighbors(g, vertex_ids_of_queries):
     """ Return first-order neighbors for the provided vertex_ids. Result
     will include the input vertex_ids in addition to the neighbors.
@@ -519,11 +883,68 @@ def get_vertex_ids_of_neighbors(g, vertex_ids_of_queries):
     list_of_lists_of_neighbors = g.neighborhood(vertex_ids_of_queries)
 
     # Convert the list of lists to a set
-    vertex_ids_of_neighbors = set([vertex_id for sublist in list_of_lists_of_neighbors for vertex_id in sublist])
+    vertex_ids_of_neighbors = set()
+    for sublist in list_of_lists_of_neighbors:
+        vertex_ids_of_neighbors.update(sublist)
 
     return vertex_ids_of_neighbors
 
 
+def get_vertex_ids_of_query_neighborhoods(g, list_of_queries, my_query_annot_field, row_or_col):
+    """ Return the vertex ids of each query and its first-order neighbors.
+    The vertex index is built once for all queries, so each neighborhood only
+    costs as much as the degree of its vertices.
+
+    Args:
+        @param g:
+        @type g: igraph.Graph object
+        @param list_of_queries: each entry is a my_query (see get_vertex_ids)
+        @type list_of_queries: list of lists of strings
+        @param my_query_annot_field: vertex attribute field in which to look for queries
+        @type my_query_annot_field: string
+        @param row_or_col: indicates which vertices to look in
+        @type row_or_col: string or None
+
+    Returns:
+        list_of_vertex_ids (list of sorted lists of integers): one per query
+
+    """
+    vertex_index = build_vertex_index(g, my_query_annot_field)
+
+    list_of_vertex_ids = []
+    for my_query in list_of_queries:
+        vertex_ids_of_queries = get_vertex_ids(
+            g, my_query, my_query_annot_field, row_or_col, vertex_index)
+        list_of_vertex_ids.append(sorted(get_vertex_ids_of_neighbors(
+            g, vertex_ids_of_queries)))
+
+    return list_of_vertex_ids
+
+
+def get_query_neighborhoods(g, list_of_queries, my_query_annot_field, row_or_col):
+    """ Extract the subgraph made up of each query and its first-order
+    neighbors (see get_vertex_ids_of_query_neighborhoods).
+
+    Args:
+        @param g:
+        @type g: igraph.Graph object
+        @param list_of_queries: each entry is a my_query (see get_vertex_ids)
+        @type list_of_queries: list of lists of strings
+        @param my_query_annot_field: vertex attribute field in which to look for queries
+        @type my_query_annot_field: string
+        @param row_or_col: indicates which vertices to look in
+        @type row_or_col: string or None
+
+    Returns:
+        out_graphs (list of igraph.Graph objects): one per query
+
+    """
+    list_of_vertex_ids = get_vertex_ids_of_query_neighborhoods(
+        g, list_of_queries, my_query_annot_field, row_or_col)
+
+    return [g.induced_subgraph(vertex_ids) for vertex_ids in list_of_vertex_ids]
+
+
 def plot_network(g, out_fig_name, vertex_label_field, layout="fr"):
     """ Plot network.
 
@@ -3,6 +3,8 @@ import unittest
 import igraph as ig
 import numpy as np
 import os
+import shutil
+import tempfile
 import pandas as pd
 import tasseography
 
@@ -94,6 +96,40 @@ class TestTasseography(unittest.TestCase):
         os.remove(out_fig_name)
         os.remove(out_gml_name)
 
+    def test_main_batch(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            tasseography.main_batch(
+                self.sym_gct, True, tmp_dir, None, ["cell_id", "pert_type"],
+                ["cell_id", "pert_type"], [["great"], ["bad"], ["so so"]],
+                "pert_type", None, 0.5, None, "pert_type", None, 2)
+
+            self.assertItemsEqual(os.listdir(tmp_dir), ["great.gml", "bad.gml", "so_so.gml"])
+            out = ig.Graph.Read_GML(os.path.join(tmp_dir, "great.gml"))
+            self.assertEqual(out.vcount(), 2)
+            self.assertSequenceEqual(out.es["weight"], [0.6])
+            self.assertEqual(ig.Graph.Read_GML(os.path.join(tmp_dir, "bad.gml")).vcount(), 0)
+
+            # No queries: nothing to write
+            tasseography.main_batch(
+                self.sym_gct, True, os.path.join(tmp_dir, "empty"), None, ["cell_id", "pert_type"],
+                ["cell_id", "pert_type"], [], "pert_type", None, 0.5, None, "pert_type", None, 2)
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, "empty")))
+
+            # Queries that would overwrite each other's output
+            with self.assertRaises(AssertionError) as e:
+                tasseography.main_batch(
+                    self.sym_gct, True, tmp_dir, None, ["cell_id", "pert_type"],
+                    ["cell_id", "pert_type"], [["so so"], ["so/so"]],
+                    "pert_type", None, 0.5, None, "pert_type", None, 2)
+            self.assertIn("same file", str(e.exception))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_make_out_name(self):
+        out = tasseography.make_out_name("out", ["BRD-K1234/5", "x y"], ".png")
+        self.assertEqual(out, os.path.join("out", "BRD-K1234_5_x_y.png"))
+
     def test_sym_gct_to_graph(self):
         logger.debug("self.sym_gct:\n{}".format(self.sym_gct))
 
@@ -127,6 +163,44 @@ class TestTasseography(unittest.TestCase):
         # Use numpy testing to get around NaN
         np.testing.assert_array_equal(out.es["weight"], self.asym_g.es["weight"])
 
+    def test_gct_to_graph_with_thresh(self):
+        np.random.seed(7)
+        data = np.random.uniform(-1, 1, (8, 8))
+        data[2, 5] = np.nan
+        data[1, 4] = 0
+        data[4, 1] = 0
+        ids = ["v{}".format(ii) for ii in range(8)]
+        meta_df = pd.DataFrame({"cell_id": ["A375"] * 8}, index=ids)
+        sym_gct = GCToo.GCToo(pd.DataFrame(data, index=ids, columns=ids), meta_df, meta_df)
+
+        # Unthresholded graph should be the same as from Weighted_Adjacency
+        e_g = ig.Graph.Weighted_Adjacency(data.tolist(), mode=ig.ADJ_MAX, attr="weight", loops=False)
+        g = tasseography.sym_gct_to_graph(sym_gct, ["cell_id"])
+        self.assertSequenceEqual(g.get_edgelist(), e_g.get_edgelist())
+        np.testing.assert_array_equal(g.es["weight"], e_g.es["weight"])
+
+        # Thresholding before building should be the same as after
+        for is_symmetric, gct in [(True, sym_gct), (False, self.asym_gct)]:
+            if is_symmetric:
+                full_g = tasseography.sym_gct_to_graph(gct, ["cell_id"])
+            else:
+                full_g = tasseography.asym_gct_to_graph(gct, ["pert_time"], ["cell_id"])
+
+            thresh = tasseography.convert_percentile_of_gct_to_thresh(gct, 60, is_symmetric)
+            self.assertAlmostEqual(thresh, tasseography.convert_percentile_to_thresh(full_g, 60))
+
+            e_out = tasseography.remove_edges_and_vertices_below_thresh(full_g, thresh)
+            if is_symmetric:
+                g = tasseography.sym_gct_to_graph(gct, ["cell_id"], thresh)
+            else:
+                g = tasseography.asym_gct_to_graph(gct, ["pert_time"], ["cell_id"], thresh)
+            out = tasseography.remove_vertices_without_edges(g)
+
+            self.assertLess(g.ecount(), full_g.ecount())
+            self.assertSequenceEqual(out.vs["id"], e_out.vs["id"])
+            self.assertSequenceEqual(out.get_edgelist(), e_out.get_edgelist())
+            self.assertSequenceEqual(out.es["weight"], e_out.es["weight"])
+
     def test_add_color_attribute_to_vertices(self):
         g_copy = self.sym_g.copy()
         tasseography.add_color_attribute_to_vertices(g_copy, "cell_id")
@@ -191,6 +265,27 @@ class TestTasseography(unittest.TestCase):
         out2 = tasseography.get_vertex_ids(self.asym_g, ["A375"], "cell_id", "col")
         self.assertItemsEqual(out2, [4])
 
+    def test_build_vertex_index(self):
+        out = tasseography.build_vertex_index(self.asym_g, "pert_time")
+        self.assertEqual(out[None], {"3h": [0, 3], "1h": [1], "2h": [2], "6h": [4]})
+        self.assertEqual(out["row"], {"3h": [0], "1h": [1], "2h": [2]})
+        self.assertEqual(out["col"], {"3h": [3], "6h": [4]})
+
+        out2 = tasseography.build_vertex_index(self.sym_g, "cell_id")
+        self.assertEqual(out2, {"row": {}, "col": {}, None: {"A375": [0, 1, 2]}})
+
+        out3 = tasseography.get_vertex_ids(self.asym_g, ["3h", "10h"], "pert_time", "col", out)
+        self.assertItemsEqual(out3, [3])
+
+    def test_get_query_neighborhoods(self):
+        g = tasseography.remove_edges_and_vertices_below_thresh(self.asym_g, 0.3)
+        out = tasseography.get_query_neighborhoods(g, [["A"], ["o", "k"], ["Z"]], "id", None)
+
+        self.assertEqual(len(out), 3)
+        self.assertSequenceEqual(out[0].vs["id"], ["A", "k"])
+        self.assertSequenceEqual(out[1].vs["id"], ["A", "B", "C", "o", "k"])
+        self.assertEqual(out[2].vcount(), 0)
+
     def test_get_vertex_ids_of_neighbors(self):
 
         out = tasseography.get_vertex_ids_of_neighbors(self.sym_g, [0])
@@ -64,10 +64,11 @@ def build_parser():
     return parser
 
 
-def main(args):
-    # Read gct and config file
+def main(args, in_gct=None, write_output=True):
+    # Read gct and config file; in_gct, if provided, was already parsed
+    # (e.g. from memory by tear_handler), so args.in_gct_path is not read
     (in_gct, config_io, config_metadata, _) = (
-        psp_utils.read_gct_and_config_file(args.in_gct_path, args.psp_config_path))
+        psp_utils.read_gct_and_config_file(args.in_gct_path, args.psp_config_path, in_gct))
 
     # Extract provenance code
     prov_code = psp_utils.extract_prov_code(
@@ -84,11 +85,12 @@ def main(args):
 
     # Reinsert provenance code
     out_gct.col_metadata_df = insert_prov_code(
-        out_gct.col_metadata_df, prov_code,
-        config_metadata["prov_code_delimiter"],
-        config_metadata["prov_code_field"])
+        out_gct.col_metadata_df, prov_code, config_metadata["prov_code_field"])
+
+    # Write output gct, unless the caller will write it
+    if not write_output:
+        return out_gct
 
-    # Write output gct
     write_output_gct(out_gct, out_gct_name, config_io["data_null"], config_io["filler_null"])
     return out_gct
 
@@ -470,21 +472,20 @@ def row_median_normalize(data_df, divide_by_mad):
     return out_df
 
 
-def insert_prov_code(col_metadata_df, prov_code, prov_code_delimiter, prov_code_field):
+def insert_prov_code(col_metadata_df, prov_code, prov_code_field):
     """ Update provenance code in col_metadata_df.
 
     Args:
         col_metadata_df (pandas df)
-        prov_code (list of strings)
+        prov_code (ProvenanceCode)
         prov_code_field (string): name of col metadata field containing the provenance code
-        prov_code_delimiter (string): what string to use as delimiter in prov_code
 
     Returns:
         gct (GCToo object): updated metadata
 
     """
     # Convert provenance code to delimiter separated string
-    prov_code_str = prov_code_delimiter.join(prov_code)
+    prov_code_str = prov_code.to_string()
 
     # Update the provenance code in col_metadata_df
     col_metadata_df.loc[:, prov_code_field] = prov_code_str
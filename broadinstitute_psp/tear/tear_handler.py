@@ -3,6 +3,7 @@ import argparse
 import boto3
 import botocore
 import broadinstitute_psp.utils.lambda_utils as utils
+import broadinstitute_psp.utils.psp_utils as psp_utils
 import broadinstitute_psp.tear.tear as tear
 
 FILE_EXTENSION = ".gct"
@@ -34,21 +35,32 @@ def build_tear_handler_parser():
     return parser
 
 def call_tear(args):
+    # Send status updates from a background thread so that a slow API doesn't
+    # stall tear; all updates are sent before returning (or raising)
+    with utils.background_status_updates():
+        return run_tear(args)
+
+
+def run_tear(args):
     s3 = boto3.resource('s3')
 
     local_config_path = args.config_dir + "/"+ args.plate_name + ".cfg"
+
+    # GCTs are never written to disk; these paths only name the output
     local_level_3_gct_path = args.config_dir + "/" + LOCAL_LEVEL_3_GCT_NAME
     local_level_4_gct_path = args.config_dir + "/" + LOCAL_LEVEL_4_GCT_NAME
 
     (level_4_key, config_key) = create_s3keys(args)
 
-    download_file_from_s3(s3, args, args.file_key, local_level_3_gct_path, LEVEL_4_API_SUFFIX)
+    level_3_content = read_file_from_s3(s3, args, args.file_key, LEVEL_4_API_SUFFIX)
     download_file_from_s3(s3, args, config_key, local_config_path, CONFIG_API_SUFFIX)
 
     tear_args = tear.build_parser().parse_args(["-i", local_level_3_gct_path, "-psp_config_path", local_config_path, "-o",local_level_4_gct_path , "-v"])
 
     try:
-        level_4_gct = tear.main(tear_args)
+        level_3_gct = psp_utils.parse_gct_from_bytes(
+            level_3_content, "s3://" + args.bucket_name + "/" + args.file_key)
+        level_4_gct = tear.main(tear_args, in_gct=level_3_gct, write_output=False)
         print level_4_gct
 
     except Exception as error:
@@ -58,9 +70,13 @@ def call_tear(args):
         utils.post_update_to_proteomics_clue(LEVEL_4_API_SUFFIX, args.plate_api_id, payload)
         raise Exception(error)
 
+    # Upload level 4 straight from memory
+    (config_io, _, _) = psp_utils.read_config_file(local_config_path)
+    level_4_buffer = psp_utils.write_gct_to_buffer(
+        level_4_gct, config_io["data_null"], config_io["filler_null"])
+
     try:
-        gct = open(local_level_4_gct_path, 'rb')
-        s3.Bucket(args.bucket_name).put_object(Key=level_4_key, Body=gct)
+        s3.Bucket(args.bucket_name).put_object(Key=level_4_key, Body=level_4_buffer)
 
     except boto3.exceptions.S3UploadFailedError as error:
         level_4_message = "s3 upload error"
@@ -77,24 +93,43 @@ def call_tear(args):
     utils.post_update_to_proteomics_clue("", args.plate_api_id, tear_success_payload)
     return "Success!"
 
+def read_file_from_s3(s3, args, s3key, api_suffix):
+    """ Read a file from s3 into memory.
+
+    Returns:
+        content (string): contents of the file
+
+    """
+    try:
+        print 'Reading file {} from bucket {}'.format(s3key, args.bucket_name)
+        return s3.Object(args.bucket_name, s3key).get()['Body'].read()
+
+    except botocore.exceptions.ClientError as e:
+        post_s3_read_error(args, e, s3key, api_suffix)
+
+
 def download_file_from_s3(s3, args, s3key, local_path, api_suffix):
     try:
         print 'Reading file {} from bucket {}'.format(s3key, args.bucket_name)
         s3.Bucket(args.bucket_name).download_file(s3key, local_path)
 
     except botocore.exceptions.ClientError as e:
+        post_s3_read_error(args, e, s3key, api_suffix)
+
 
-        if e.response['Error']['Code'] == "404":
-            error_message = "Tear: The file located at {} from bucket {} does not exist".format(s3key, args.bucket_name)
-            print error_message
+def post_s3_read_error(args, e, s3key, api_suffix):
+    """ Post a failed s3 read to the API, then raise. """
+    if e.response['Error']['Code'] in ["404", "NoSuchKey"]:
+        error_message = "Tear: The file located at {} from bucket {} does not exist".format(s3key, args.bucket_name)
+        print error_message
 
-        else:
-            error_message = "Tear: failed to download file located at {} from bucket {}".format(s3key, args.bucket_name)
-            print error_message
+    else:
+        error_message = "Tear: failed to download file located at {} from bucket {}".format(s3key, args.bucket_name)
+        print error_message
 
-        payload = {"s3": {"message": error_message}}
-        utils.post_update_to_proteomics_clue(api_suffix, args.plate_api_id, payload)
-        raise Exception(e)
+    payload = {"s3": {"message": error_message}}
+    utils.post_update_to_proteomics_clue(api_suffix, args.plate_api_id, payload)
+    raise Exception(e)
 
 def create_s3keys(args):
     filename = args.plate_name + "_LVL4" + FILE_EXTENSION
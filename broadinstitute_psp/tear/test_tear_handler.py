@@ -10,6 +10,9 @@ logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
 OG_post_updates = th.utils.post_update_to_proteomics_clue
 OG_os_environ = th.utils.os.environ
+OG_parse_gct_from_bytes = th.psp_utils.parse_gct_from_bytes
+OG_read_config_file = th.psp_utils.read_config_file
+OG_write_gct_to_buffer = th.psp_utils.write_gct_to_buffer
 
 class TestTearHandler(unittest.TestCase):
 
@@ -27,10 +30,19 @@ class TestTearHandler(unittest.TestCase):
         th.utils.os.environ = mock.MagicMock()
         th.utils.os.environ.__getitem__.side_effect = get_environ_item
 
+        # GCT I/O is tested in psp_utils
+        th.psp_utils.parse_gct_from_bytes = mock.Mock(return_value="level 3 gct")
+        th.psp_utils.read_config_file = mock.Mock(
+            return_value=({"data_null": "NaN", "filler_null": "NA"}, {}, {}))
+        th.psp_utils.write_gct_to_buffer = mock.Mock(return_value="level 4 buffer")
+
     @classmethod
     def tearDownClass(cls):
         th.utils.post_update_to_proteomics_clue = OG_post_updates
         th.utils.os.environ = OG_os_environ
+        th.psp_utils.parse_gct_from_bytes = OG_parse_gct_from_bytes
+        th.psp_utils.read_config_file = OG_read_config_file
+        th.psp_utils.write_gct_to_buffer = OG_write_gct_to_buffer
 
     @staticmethod
     def setup_args():
@@ -71,14 +83,36 @@ class TestTearHandler(unittest.TestCase):
                                   {"s3": {"message": "Tear: failed to download file located at psp/level3/test_file_key.gct from bucket test_bucket"}})
         self.assertEqual(expected_call, th.utils.post_update_to_proteomics_clue.call_args)
 
+    def test_read_file_from_s3(self):
+        args = TestTearHandler.setup_args()
+        th.utils.post_update_to_proteomics_clue.reset_mock()
+        s3 = mock.MagicMock()
+
+        # happy path
+        s3.Object("test_bucket", args.file_key).get = mock.Mock(
+            return_value={"Body": mock.Mock(read=mock.Mock(return_value="#1.3"))})
+        self.assertEqual(th.read_file_from_s3(s3, args, args.file_key, "/level4"), "#1.3")
+        s3.Object.assert_called_with("test_bucket", args.file_key)
+        th.utils.post_update_to_proteomics_clue.assert_not_called()
+
+        # unhappy path, boto3 resources report a missing key as NoSuchKey
+        s3.Object("test_bucket", args.file_key).get = mock.Mock(
+            side_effect=ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Does Not Exist'}}, 'GetObject'))
+        with self.assertRaises(Exception):
+            th.read_file_from_s3(s3, args, args.file_key, "/level4")
+
+        expected_call = mock.call(th.LEVEL_4_API_SUFFIX, args.plate_api_id,
+                                  {"s3":{"message":"Tear: The file located at psp/level3/test_file_key.gct from bucket test_bucket does not exist" }})
+        self.assertEqual(expected_call, th.utils.post_update_to_proteomics_clue.call_args)
+
+    @mock.patch("broadinstitute_psp.tear.tear_handler.read_file_from_s3")
     @mock.patch("broadinstitute_psp.tear.tear_handler.download_file_from_s3")
-    def test_call_tear_happy_path(self, download_file):
+    def test_call_tear_happy_path(self, download_file, read_file):
         #setup
         args = TestTearHandler.setup_args()
         th.s3 = mock.Mock()
         th.boto3.resource = mock.Mock(return_value=th.s3)
         th.tear.main = mock.Mock()
-        th.open = mock.Mock(return_value="opened")
         th.s3.Bucket("test_bucket").put_object = mock.Mock()
 
         # happy path should call all mocks, post twice to proteomics clue
@@ -86,14 +120,15 @@ class TestTearHandler(unittest.TestCase):
         th.call_tear(args)
 
         th.boto3.resource.assert_called_once()
-        download_file_calls = download_file.call_args_list
-        expected_download_file_calls = [
-            mock.call(th.s3, args, "psp/level3/test_file_key.gct", "/this/dir/level3.gct", "/level4"),
-            mock.call(th.s3, args, "psp/config/test_plate_name.cfg", "/this/dir/test_plate_name.cfg", "/configObj")]
-        self.assertEqual(download_file_calls, expected_download_file_calls)
+        read_file.assert_called_once_with(th.s3, args, "psp/level3/test_file_key.gct", "/level4")
+        download_file.assert_called_once_with(
+            th.s3, args, "psp/config/test_plate_name.cfg", "/this/dir/test_plate_name.cfg", "/configObj")
 
         th.tear.main.assert_called_once()
 
+        # tear gets the GCT that was parsed from s3, and doesn't write it
+        self.assertEqual(th.tear.main.call_args[1], {"in_gct": "level 3 gct", "write_output": False})
+
         # vars() turns the call_args into a dictionary, removing from Namespace()
         tear_call = vars(th.tear.main.call_args[0][0])
 
@@ -102,11 +137,10 @@ class TestTearHandler(unittest.TestCase):
         self.assertEqual("/this/dir/test_plate_name.cfg", tear_call["psp_config_path"])
         self.assertEqual("/this/dir/level3.gct",tear_call["in_gct_path"])
 
-        th.open.assert_called_once()
         th.s3.Bucket("test_bucket").put_object.assert_called_once()
 
         s3_put_args, s3_put_kwargs = th.s3.Bucket("test_bucket").put_object.call_args
-        self.assertEqual("opened", s3_put_kwargs["Body"])
+        self.assertEqual("level 4 buffer", s3_put_kwargs["Body"])
         self.assertEqual("psp/level4/test_plate_name_LVL4.gct", s3_put_kwargs["Key"])
 
         clue_posts = th.utils.post_update_to_proteomics_clue.call_args_list
@@ -114,8 +148,9 @@ class TestTearHandler(unittest.TestCase):
                         mock.call("", args.plate_api_id, {"status":"created LVL 4 GCT"})]
         self.assertEqual(clue_posts, expected_posts)
 
+    @mock.patch("broadinstitute_psp.tear.tear_handler.read_file_from_s3")
     @mock.patch("broadinstitute_psp.tear.tear_handler.download_file_from_s3")
-    def test_call_tear_unhappy_path_tear_failure(self, download_file):
+    def test_call_tear_unhappy_path_tear_failure(self, download_file, read_file):
         #setup
         args = TestTearHandler.setup_args()
         th.s3 = mock.Mock()
@@ -129,11 +164,9 @@ class TestTearHandler(unittest.TestCase):
         self.assertEqual(str(context.exception[0]), "failure")
         th.boto3.resource.assert_called_once()
 
-        download_file_calls = download_file.call_args_list
-        expected_download_file_calls = [
-            mock.call(th.s3, args, "psp/level3/test_file_key.gct", "/this/dir/level3.gct", "/level4"),
-            mock.call(th.s3, args, "psp/config/test_plate_name.cfg", "/this/dir/test_plate_name.cfg", "/configObj")]
-        self.assertEqual(download_file_calls, expected_download_file_calls)
+        read_file.assert_called_once_with(th.s3, args, "psp/level3/test_file_key.gct", "/level4")
+        download_file.assert_called_once_with(
+            th.s3, args, "psp/config/test_plate_name.cfg", "/this/dir/test_plate_name.cfg", "/configObj")
 
         th.tear.main.assert_called_once()
 
@@ -149,14 +182,14 @@ class TestTearHandler(unittest.TestCase):
 
         self.assertEqual(expected_post, post)
 
+    @mock.patch("broadinstitute_psp.tear.tear_handler.read_file_from_s3")
     @mock.patch("broadinstitute_psp.tear.tear_handler.download_file_from_s3")
-    def test_call_tear_unhappy_path_s3_upload_failure(self, download_file):
+    def test_call_tear_unhappy_path_s3_upload_failure(self, download_file, read_file):
         # setup
         args = TestTearHandler.setup_args()
         th.s3 = mock.Mock(name="s3 mock")
         th.boto3.resource = mock.Mock(return_value=th.s3)
         th.tear.main = mock.Mock(name="tear main mock")
-        th.open = mock.Mock(name="open mock", return_value="opened")
         th.s3.Bucket("test_bucket").put_object = mock.Mock(side_effect=S3UploadFailedError)
         th.utils.post_update_to_proteomics_clue.reset_mock()
 
@@ -167,11 +200,9 @@ class TestTearHandler(unittest.TestCase):
         self.assertEqual(S3UploadFailedError, type(context.exception[0]))
 
         th.boto3.resource.assert_called_once()
-        download_file_calls = download_file.call_args_list
-
-        expected_download_file_calls = [mock.call(th.s3, args, "psp/level3/test_file_key.gct", "/this/dir/level3.gct", "/level4"),
-                                        mock.call(th.s3, args, "psp/config/test_plate_name.cfg", "/this/dir/test_plate_name.cfg", "/configObj")]
-        self.assertEqual(download_file_calls, expected_download_file_calls)
+        read_file.assert_called_once_with(th.s3, args, "psp/level3/test_file_key.gct", "/level4")
+        download_file.assert_called_once_with(
+            th.s3, args, "psp/config/test_plate_name.cfg", "/this/dir/test_plate_name.cfg", "/configObj")
 
         th.tear.main.assert_called_once()
 
@@ -183,12 +214,11 @@ class TestTearHandler(unittest.TestCase):
         self.assertEqual("/this/dir/level3.gct", tear_call["in_gct_path"])
 
 
-        th.open.assert_called_once()
         th.s3.Bucket("test_bucket").put_object.assert_called_once()
 
         s3_put_args, s3_put_kwargs = th.s3.Bucket("test_bucket").put_object.call_args
         print s3_put_args, s3_put_kwargs
-        self.assertEqual("opened", s3_put_kwargs["Body"])
+        self.assertEqual("level 4 buffer", s3_put_kwargs["Body"])
         self.assertEqual("psp/level4/test_plate_name_LVL4.gct", s3_put_kwargs["Key"])
 
         post = th.utils.post_update_to_proteomics_clue.call_args_list[0]
@@ -0,0 +1,174 @@
+"""
+compile_gmt.py
+
+Compile a GMT file into a binary file that loads without any text parsing.
+In a compiled GMT, set membership is integer-encoded: the unique set members
+are stored once, and each set is a slice of an array of member codes
+(i.e. compressed sparse row format).
+
+evaluate_sets accepts either a GMT file or a compiled GMT for its set
+definitions; compiling is worthwhile for large set libraries that are used
+over and over.
+
+"""
+
+import logging
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+
+import cmapPy.pandasGEXpress.setup_GCToo_logger as setup_logger
+import cmapPy.set_io.gmt as gmt
+
+__author__ = "Lev Litichevskiy"
+__email__ = "lev@broadinstitute.org"
+
+COMPILED_GMT_SUFFIX = ".npz"
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+class CompiledGmt():
+    """
+    Set definitions with integer-encoded membership.
+
+    Instance Variables:
+        set_names (numpy array of strings): one name per set
+        members (numpy array of strings): unique set members across all sets
+        offsets (numpy array of integers): length is # of sets + 1; the
+            members of set ii are members[member_codes[offsets[ii]:offsets[ii + 1]]]
+        member_codes (numpy array of integers): positions in members
+    """
+    def __init__(self, set_names, members, offsets, member_codes):
+        assert len(offsets) == len(set_names) + 1, (
+            "offsets must have one more entry than set_names. " +
+            "len(offsets): {}, len(set_names): {}").format(len(offsets), len(set_names))
+        assert offsets[-1] == len(member_codes), (
+            "The last offset must be len(member_codes). " +
+            "offsets[-1]: {}, len(member_codes): {}").format(offsets[-1], len(member_codes))
+
+        self.set_names = np.asarray(set_names)
+        self.members = np.asarray(members)
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.member_codes = np.asarray(member_codes, dtype=int)
+
+    def __len__(self):
+        return len(self.set_names)
+
+
+def build_parser():
+    """Build argument parser."""
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    # Required args
+    parser.add_argument("--in_gmt_path", "-i", required=True,
+                        help="path to input GMT")
+    parser.add_argument("--out_name", "-o", required=True,
+                        help="what to name the compiled GMT; must end in " + COMPILED_GMT_SUFFIX)
+
+    # Optional args
+    parser.add_argument("--verbose", "-v", action="store_true", default=False,
+                        help="whether to increase the # of messages reported")
+
+    return parser
+
+
+def main(args):
+    """ The main method. """
+    compiled_gmt = compile_gmt(gmt.read(args.in_gmt_path))
+    write(compiled_gmt, args.out_name)
+
+
+def compile_gmt(this_gmt):
+    """ Convert a GMT object into a CompiledGmt.
+
+    Args:
+        this_gmt (GMT object): list of dicts, as returned by cmapPy.set_io.gmt.read
+
+    Returns:
+        compiled_gmt (CompiledGmt)
+
+    """
+    set_names = [g[gmt.SET_IDENTIFIER_FIELD] for g in this_gmt]
+    set_sizes = [len(g[gmt.SET_MEMBERS_FIELD]) for g in this_gmt]
+
+    all_entries = []
+    for g in this_gmt:
+        all_entries.extend(g[gmt.SET_MEMBERS_FIELD])
+
+    # Encode all entries at once
+    (member_codes, members) = pd.factorize(pd.Series(all_entries, dtype=object))
+
+    offsets = np.zeros(len(set_names) + 1, dtype=int)
+    offsets[1:] = np.cumsum(set_sizes)
+
+    logger.info("Compiled {} sets with {} unique members.".format(
+        len(set_names), len(members)))
+
+    return CompiledGmt(set_names, np.asarray(members, dtype=str), offsets, member_codes)
+
+
+def write(compiled_gmt, out_name):
+    """ Write a CompiledGmt to file.
+
+    Args:
+        compiled_gmt (CompiledGmt)
+        out_name (string): must end in COMPILED_GMT_SUFFIX
+
+    Returns:
+        None
+
+    """
+    assert out_name.endswith(COMPILED_GMT_SUFFIX), (
+        "out_name must end in {}. out_name: {}".format(COMPILED_GMT_SUFFIX, out_name))
+
+    # Fixed-width string arrays, so that no pickling is needed to read them back
+    np.savez(out_name,
+             set_names=compiled_gmt.set_names.astype(str),
+             members=compiled_gmt.members.astype(str),
+             offsets=compiled_gmt.offsets,
+             member_codes=compiled_gmt.member_codes)
+
+
+def read(compiled_gmt_path):
+    """ Read a CompiledGmt from file.
+
+    Args:
+        compiled_gmt_path (string)
+
+    Returns:
+        compiled_gmt (CompiledGmt)
+
+    """
+    with np.load(compiled_gmt_path, allow_pickle=False) as npz:
+        compiled_gmt = CompiledGmt(npz["set_names"], npz["members"],
+                                   npz["offsets"], npz["member_codes"])
+
+    return compiled_gmt
+
+
+def read_set_definitions(path):
+    """ Read set definitions from either a GMT or a compiled GMT, depending on
+    the extension of path.
+
+    Args:
+        path (string)
+
+    Returns:
+        compiled_gmt (CompiledGmt)
+
+    """
+    if path.endswith(COMPILED_GMT_SUFFIX):
+        return read(path)
+    else:
+        return compile_gmt(gmt.read(path))
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+
+    main(args)
@@ -4,7 +4,8 @@ evaluate_sets.py
 Evaluate sets within a similarity matrix. Sets can be replicates corresponding
 to the same perturbation, or compounds corresponding to the same mechanism of
 action, or something else. Sets can be provided in a GMT file, or they can be
-constructed from the metadata using the match_fields argument. If constructed
+constructed from the metadata using the match_fields argument. Large GMTs can
+be compiled ahead of time with compile_gmt.py. If constructed
 from the metadata, each sample in the dataset can correspond to only one set,
 but this restriction does not apply if using set definitions from a GMT file.
 Finally, metadata can be embedded into a GCT(X) file or provided separately.
@@ -16,6 +17,20 @@ distribution greater than the aggregated similarity. The empirical null is
 constructed by picking samples at random from the similarity matrix. The q-value
 is computed using the Benjamini-Hochberg correction.
 
+Null distributions depend only on the similarity matrix (and subset), the set
+size, the aggregation method, the null size, and the random seed. If a null
+cache directory and a random seed are provided, null distributions are read
+from and added to a cache, so later runs on the same similarity matrix (e.g.
+with a different GMT) only compute nulls for set sizes not seen before.
+
+For very large similarity matrices, approximate mode avoids evaluating null
+sets in the matrix altogether. A bounded reservoir of pairwise similarities is
+sampled in one pass over the GCTX, and the null for each set size is modeled
+by aggregating similarities drawn from the reservoir as if they were
+independent. Because the null is then a Monte Carlo estimate, each p-value is
+reported with a confidence interval (pval_lower, pval_upper); the interval
+reflects Monte Carlo error only, not the independence approximation.
+
 --------------------------------------------------------------------------------
 
 For the following examples, running evaluate_sets from the command line will
@@ -58,7 +73,7 @@ WITHIN PYTHON (check argparse defaults for desired args values):
         external_metadata_id_field = args.external_metadata_id_field,
         aggregation_method = args.aggregation_method,
         null_size = args.null_size,
-        sets_per_chunk = args.sets_per_chunk,
+        sims_per_pass = args.sims_per_pass,
         low_memory_mode = args.low_memory_mode,
         max_set_size = args.max_set_size
     )
@@ -99,7 +114,7 @@ WITHIN PYTHON (check argparse defaults for desired args values):
         external_metadata_id_field = args.external_metadata_id_field,
         aggregation_method = args.aggregation_method,
         null_size = args.null_size,
-        sets_per_chunk = args.sets_per_chunk,
+        sims_per_pass = args.sims_per_pass,
         low_memory_mode = args.low_memory_mode,
         max_set_size = args.max_set_size
     )
@@ -139,6 +154,8 @@ COMMAND LINE:
                                         - MCF7 at 24H
                                     would have its own evaluate_sets calculation,
                                     with combination-specific sets and null.
+        -nj 4                     # evaluate up to 4 combinations at a time,
+                                    each in its own worker process
 
 WITHIN PYTHON (check argparse defaults for desired args values):
     # run evaluate_sets and get result record list
@@ -151,9 +168,10 @@ WITHIN PYTHON (check argparse defaults for desired args values):
         external_metadata_id_field = args.external_metadata_id_field,
         aggregation_method = args.aggregation_method,
         null_size = args.null_size,
-        sets_per_chunk = args.sets_per_chunk,
+        sims_per_pass = args.sims_per_pass,
         low_memory_mode = args.low_memory_mode,
-        max_set_size = args.max_set_size
+        max_set_size = args.max_set_size,
+        n_jobs = 4                                   # -nj from command line example
     )
 
     # Because subsetting occurred on cell lines A549 and MCF7 and timepoints
@@ -181,17 +199,21 @@ import logging
 import argparse
 import os
 import sys
+import hashlib
+import json
 import pandas as pd
 import numpy as np
-import random
 import statsmodels.sandbox.stats.multicomp as multicomp
+import statsmodels.stats.proportion as proportion
 import itertools
+import multiprocessing
 
 import cmapPy.pandasGEXpress.setup_GCToo_logger as setup_logger
 import cmapPy.pandasGEXpress.GCToo as GCToo
 import cmapPy.pandasGEXpress.parse as cpp
 import cmapPy.pandasGEXpress.write_gctx as wgx
-import cmapPy.set_io.gmt as gmt
+
+import broadinstitute_psp.tools.compile_gmt as compile_gmt
 
 __author__ = "Lev Litichevskiy, Andrew Yang"
 __email__ = "lev@broadinstitute.org"
@@ -201,11 +223,30 @@ SEPARATOR = ":"
 AGG_SIM_COLUMN_NAME = "agg_sim"
 SET_SIZE_COLUMN_NAME = "set_size"
 PVAL_COLUMN_NAME = "pval"
+PVAL_LOWER_COLUMN_NAME = "pval_lower"
+PVAL_UPPER_COLUMN_NAME = "pval_upper"
 QVAL_COLUMN_NAME = "qval"
 NAN_STR = "NaN"
 TEXT_FILE_OUT_NAME = "eval_sets.tsv"
 NULL_DIST_OUT_NAME = "null_dists_n{n_cols}x{n_rows}{subset_fname_suffix}.gctx"
 YAML_FILE_OUT_NAME = "eval_sets.yml"
+NULL_CACHE_FILE_NAME = "null_cache_{key}.gctx"
+
+# Upper bound on the number of similarities gathered at once when evaluating
+# null sets in batches; bounds the size of the 3-D gather array
+NULL_BATCH_MAX_ELEMENTS = 2 ** 24
+
+# Seeded null sets are drawn in blocks of this many sets, each block from its
+# own random state, so that the first n null sets are the same no matter how
+# many are drawn; this is what lets a cache of fewer nulls be extended
+NULL_SEED_BLOCK_SIZE = 1000
+
+# Defaults for low-memory mode and for the largest set to evaluate
+DEFAULT_SIMS_PER_PASS = 2 ** 22
+DEFAULT_MAX_SET_SIZE = 200
+
+# Confidence level of the p-value bounds reported in approximate mode
+PVAL_BOUNDS_ALPHA = 0.05
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
@@ -256,6 +297,65 @@ class SimMatResultRecord():
         self.nulls_gct = None
 
 
+class SetIndex():
+    """
+    Set definitions compiled into integer positions in a similarity matrix,
+    in compressed sparse row format. Sets are resolved to positions once, and
+    every evaluator works directly from the positions, so sample ids are
+    never looked up again.
+
+    Instance Variables:
+        set_names (numpy array): one name per set
+        offsets (numpy array of integers): length is # of sets + 1; the
+            members of set ii are positions[offsets[ii]:offsets[ii + 1]]
+        positions (numpy array of integers): positions in sample_ids
+        sample_ids (pandas Index): ids of the similarity matrix that
+            positions refer to
+    """
+    def __init__(self, set_names, offsets, positions, sample_ids):
+        self.set_names = np.asarray(set_names)
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.positions = np.asarray(positions, dtype=int)
+        self.sample_ids = sample_ids
+
+    def __len__(self):
+        return len(self.set_names)
+
+    def set_sizes(self):
+        return np.diff(self.offsets)
+
+    def subset(self, set_bool):
+        """ Return a new SetIndex with only the sets where set_bool is True. """
+        set_sizes = self.set_sizes()
+        new_offsets = np.zeros(set_bool.sum() + 1, dtype=int)
+        new_offsets[1:] = np.cumsum(set_sizes[set_bool])
+        return SetIndex(self.set_names[set_bool], new_offsets,
+                        self.positions[np.repeat(set_bool, set_sizes)],
+                        self.sample_ids)
+
+    def index_sets_by_size(self):
+        """ Group sets by size.
+
+        Returns:
+            set_size_to_sets (dict): keys are set sizes, values are tuples of
+                (set names, integer array of positions with one row per set)
+        """
+        set_sizes = self.set_sizes()
+        set_size_to_sets = {}
+        for set_size in np.unique(set_sizes):
+            which_sets = np.where(set_sizes == set_size)[0]
+            index_sets = self.positions[
+                self.offsets[which_sets][:, np.newaxis] + np.arange(set_size)]
+            set_size_to_sets[int(set_size)] = (self.set_names[which_sets], index_sets)
+        return set_size_to_sets
+
+    def to_dict(self):
+        """ Return a dict where keys are set names and values are sets of sample ids. """
+        return {set_name: set(self.sample_ids[self.positions[start:stop]])
+                for set_name, start, stop in zip(
+                    self.set_names, self.offsets[:-1], self.offsets[1:])}
+
+
 def build_parser():
     """Build argument parser."""
     class RawDescriptionArgumentDefaultsHelpFormatter(argparse.ArgumentDefaultsHelpFormatter,
@@ -294,6 +394,22 @@ def build_parser():
               "matrices so each subsetted result is computed with a distinct "
               "subsetted null. Results are then collated into a single result "
               "with additional columns annotating these subsetted fields"))
+    parser.add_argument("--n_jobs", "-nj", default=1, type=int,
+        help=("number of worker processes to use for evaluating subsetted "
+              "similarity matrices in parallel; only used with subset_fields"))
+    parser.add_argument("--approximate", "-ap", action="store_true", default=False,
+        help=("whether to model null distributions from a reservoir of "
+              "pairwise similarities sampled in one pass over the GCTX; "
+              "p-values are reported with confidence bounds"))
+    parser.add_argument("--null_cache_dir", "-nc", default=None,
+        help=("directory in which to cache null distributions; nulls are "
+              "reused by later runs on the same similarity matrix (and "
+              "subset) with the same aggregation_method and random_seed; "
+              "only nulls for new set sizes are computed, and cached nulls "
+              "are extended if null_size is larger than before; "
+              "requires random_seed"))
+    parser.add_argument("--random_seed", "-rs", default=None, type=int,
+                        help="seed for picking null sets at random")
     parser.add_argument("--verbose", "-v", action="store_true", default=False,
                         help="whether to increase the # of messages reported")
 
@@ -304,8 +420,20 @@ def build_parser():
     parser.add_argument("--low_memory_mode", "-lm", default=False,
                         action="store_true", help=argparse.SUPPRESS)
 
-    # For low-memory mode, how many sets to read from the GCTX at once
-    parser.add_argument("--sets_per_chunk", "-spc", default=100, type=int,
+    # For low-memory mode, how many similarities to gather from the GCTX in
+    # one pass over the file; the file is read once per pass, so fewer,
+    # larger passes mean less I/O
+    parser.add_argument("--sims_per_pass", "-spp", default=DEFAULT_SIMS_PER_PASS, type=int,
+                        help=argparse.SUPPRESS)
+
+    # Deprecated: number of sets to evaluate at a time in low-memory mode;
+    # converted to sims_per_pass (see get_sims_per_pass_from_sets_per_chunk)
+    parser.add_argument("--sets_per_chunk", "-spc", default=None, type=int,
+                        help=argparse.SUPPRESS)
+
+    # For approximate mode, number of pairwise similarities to keep in the
+    # reservoir from which null distributions are modeled
+    parser.add_argument("--reservoir_size", "-rsz", default=10 ** 6, type=int,
                         help=argparse.SUPPRESS)
 
     # Number of times to randomly sample for the null distribution
@@ -314,7 +442,7 @@ def build_parser():
 
     # For efficiency, exclude sets above a certain size (e.g. positive and
     # negative controls
-    parser.add_argument("--max_set_size", "-mss", default=200, type=int,
+    parser.add_argument("--max_set_size", "-mss", default=DEFAULT_MAX_SET_SIZE, type=int,
                         help=argparse.SUPPRESS)
 
     return parser
@@ -342,10 +470,16 @@ def eval_sets_main(args):
         match_fields=args.match_fields,
         aggregation_method=args.aggregation_method,
         null_size=args.null_size,
-        sets_per_chunk=args.sets_per_chunk,
+        sims_per_pass=args.sims_per_pass,
         low_memory_mode=args.low_memory_mode,
         max_set_size=args.max_set_size,
-        subset_fields=args.subset_fields
+        subset_fields=args.subset_fields,
+        random_seed=args.random_seed,
+        null_cache_dir=args.null_cache_dir,
+        n_jobs=args.n_jobs,
+        approximate=args.approximate,
+        reservoir_size=args.reservoir_size,
+        sets_per_chunk=args.sets_per_chunk
     )
 
     results_df = collate_results_dfs(sim_mat_result_record_list,
@@ -417,8 +551,11 @@ def evaluate_sets_on_all_sim_mats(ds, set_definitions,
                                   external_metadata_id_field,
                                   external_metadata_path, match_fields,
                                   subset_fields, aggregation_method,
-                                  null_size, sets_per_chunk,
-                                  low_memory_mode, max_set_size):
+                                  null_size, sims_per_pass=DEFAULT_SIMS_PER_PASS,
+                                  low_memory_mode=False, max_set_size=DEFAULT_MAX_SET_SIZE,
+                                  random_seed=None, null_cache_dir=None,
+                                  n_jobs=1, approximate=False,
+                                  reservoir_size=10 ** 6, sets_per_chunk=None):
     """ Top-level function for evaluating sets, with or without subsetting input GCT(X)
     Args:
         ds (string): path to input GCT(X)
@@ -431,16 +568,33 @@ def evaluate_sets_on_all_sim_mats(ds, set_definitions,
         subset_fields (list of strings): metadata field(s) to use for subsetting ds
         aggregation_method (string): how to aggregate the self sims
         null_size (integer): number of times to randomly sample for the null dist
-        sets_per_chunk (integer): number of sets to evaluate at a time in low-
-            memory mode
+        sims_per_pass (integer): maximum number of similarities to gather in
+            one pass over ds in low-memory mode; ds is read once per pass
         low_memory_mode (bool)
         max_set_size (integer): for efficiency, exclude sets above this size
+        random_seed (integer): seed for picking null sets; if None, null sets
+            are not reproducible
+        null_cache_dir (string): directory in which to cache null
+            distributions; if None, nulls are not cached
+        n_jobs (integer): number of worker processes to use for evaluating
+            subsetted similarity matrices; each worker reads only its own
+            slice of ds
+        approximate (bool): whether to model null distributions from a
+            reservoir of pairwise similarities
+        reservoir_size (integer): number of pairwise similarities in the
+            reservoir in approximate mode
+        sets_per_chunk (integer): deprecated; if not None, replaces
+            sims_per_pass (see get_sims_per_pass_from_sets_per_chunk)
 
     Returns:
         sim_mat_result_record_list (list of SimMatResultRecord): list of
             similarity matrix result records, with all attributes set.
             If no subsetting, this will be a list of a single SimMatResultRecord.
     """
+    if sets_per_chunk is not None:
+        sims_per_pass = get_sims_per_pass_from_sets_per_chunk(
+            sets_per_chunk, max_set_size, aggregation_method)
+
     # input similarity matrix must be square.
     n_cid = len(cpp.parse(ds, col_meta_only=True))
     n_rid = len(cpp.parse(ds, row_meta_only=True))
@@ -459,16 +613,63 @@ def evaluate_sets_on_all_sim_mats(ds, set_definitions,
         external_metadata_path,
         external_metadata_id_field)
 
-    for record in sim_mat_result_record_list:
-        if len(sim_mat_result_record_list) > 1:
-            logger.info("Evaluating sets, subsetted on: {}".format(record.subset_field_combo))
-        record.results_df, record.nulls_gct = evaluate_sets_on_single_sim_mat(
-            ds, set_definitions, aggregation_method, null_size, sets_per_chunk,
-            low_memory_mode, max_set_size, record, meta_df)
+    # Each record only needs the metadata of its own samples
+    eval_args_list = [
+        (ds, set_definitions, aggregation_method, null_size, sims_per_pass,
+         low_memory_mode, max_set_size, record,
+         meta_df[meta_df.index.isin(record.sample_ids)],
+         random_seed, null_cache_dir, approximate, reservoir_size)
+        for record in sim_mat_result_record_list]
+
+    n_workers = min(n_jobs, len(sim_mat_result_record_list))
+    if n_workers > 1:
+        logger.info("Evaluating {} subsetted similarity matrices with {} workers.".format(
+            len(sim_mat_result_record_list), n_workers))
+
+        # Reseed each worker so that unseeded nulls differ between workers
+        pool = multiprocessing.Pool(n_workers, initializer=np.random.seed)
+        try:
+            results = pool.map(evaluate_sets_on_single_sim_mat_from_args,
+                               eval_args_list, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        results = [evaluate_sets_on_single_sim_mat_from_args(eval_args)
+                   for eval_args in eval_args_list]
+
+    for record, (results_df, nulls_df) in zip(sim_mat_result_record_list, results):
+        record.results_df = results_df
+        record.nulls_gct = GCToo.GCToo(nulls_df)
 
     return sim_mat_result_record_list
 
 
+def evaluate_sets_on_single_sim_mat_from_args(eval_args):
+    """ Call evaluate_sets_on_single_sim_mat with a tuple of arguments. This
+    is a module-level function so that it can be sent to worker processes.
+    GCToo objects hold a logger, which cannot be pickled, so the data_df of
+    the nulls GCToo is returned instead.
+
+    Args:
+        eval_args (tuple): positional arguments of
+            evaluate_sets_on_single_sim_mat
+
+    Returns:
+        results_df (pandas df)
+        nulls_df (pandas df): data_df of nulls_gct
+
+    """
+    record = eval_args[7]
+    if record.subset_field_combo != "":
+        logger.info("Evaluating sets, subsetted on: {}".format(record.subset_field_combo))
+
+    results_df, nulls_gct = evaluate_sets_on_single_sim_mat(*eval_args)
+
+    return results_df, nulls_gct.data_df
+
+
 def get_col_meta(ds, external_metadata_id_field, external_metadata_path,
                  match_fields):
     """ Get column metadata for input similarity matrix.
@@ -646,8 +847,10 @@ def get_subset_ids(subset_combo, subset_fields, meta_df,
 
 
 def evaluate_sets_on_single_sim_mat(ds, set_definitions, aggregation_method,
-                                null_size, sets_per_chunk, low_memory_mode,
-                                max_set_size, sim_mat_result_record, meta_df):
+                                null_size, sims_per_pass, low_memory_mode,
+                                max_set_size, sim_mat_result_record, meta_df,
+                                random_seed=None, null_cache_dir=None,
+                                approximate=False, reservoir_size=10 ** 6):
     """ Evaluate sets in a single similarity matrix. Return aggregated
     similarity, p-value, q-value, and n for each set in the similarity matrix.
     Also return the aggregated similarities for null distributions.
@@ -657,17 +860,23 @@ def evaluate_sets_on_single_sim_mat(ds, set_definitions, aggregation_method,
         set_definitions (string)
         aggregation_method (string)
         null_size (integer)
-        sets_per_chunk (integer)
+        sims_per_pass (integer)
         low_memory_mode (bool)
         max_set_size (integer)
         sim_mat_result_record (SimMatResultRecord)
         meta_df (pandas df)
+        random_seed (integer)
+        null_cache_dir (string)
+        approximate (bool)
+        reservoir_size (integer)
 
     Returns:
         results_df (pandas df): index is set names, columns are the following:
             agg_sim: aggregated similarity
             set_size: number of samples in this set
             pval: p-value for this set
+            pval_lower, pval_upper: confidence bounds on the p-value (only
+                in approximate mode)
             qval: q-value for this set
         nulls_gct (GCToo object): # rows = # of null iterations, # columns =
             # of unique real set sizes
@@ -677,7 +886,16 @@ def evaluate_sets_on_single_sim_mat(ds, set_definitions, aggregation_method,
     # Subset metadata to sample ids
     meta_df = meta_df[meta_df.index.isin(sim_mat_result_record.sample_ids)]
 
-    if low_memory_mode:
+    if approximate and str.lower(os.path.splitext(ds)[1]) == ".gct":
+        logger.warning(
+            ("Approximate mode requires a GCTX, rather than GCT, file. " +
+             "Will compute exact null distributions."))
+        approximate = False
+
+    if approximate:
+        gct = None
+
+    elif low_memory_mode:
         if str.lower(os.path.splitext(ds)[1]) == ".gct":
             logger.warning(
                 ("No point in running in low-memory mode if using a GCT, " +
@@ -694,42 +912,109 @@ def evaluate_sets_on_single_sim_mat(ds, set_definitions, aggregation_method,
 
     # Read in GMT file if provided
     if set_definitions is not None:
-        set_to_samples_dict_tmp = make_sets_from_gmt(set_definitions, meta_df, MATCH_FIELD_NAME)
+        real_sets_tmp = make_sets_from_gmt(set_definitions, meta_df, MATCH_FIELD_NAME)
 
     else:
-        # Return a dictionary mapping sets to the samples comprising the sets
-        set_to_samples_dict_tmp = make_sets_from_meta_df(meta_df, MATCH_FIELD_NAME)
+        # Return the positions of the samples comprising each set
+        real_sets_tmp = make_sets_from_meta_df(meta_df, MATCH_FIELD_NAME)
 
     # Remove sets over a certain size
-    set_to_samples_dict = remove_big_sets(set_to_samples_dict_tmp, max_set_size)
+    real_sets = remove_big_sets(real_sets_tmp, max_set_size)
 
     # Get unique set sizes; need this for making nulls
-    unique_set_sizes = set([len(set_samples) for set_samples in set_to_samples_dict.itervalues()])
+    unique_set_sizes = set([int(set_size) for set_size in real_sets.set_sizes()])
 
-    # Make nulls by picking random sets
-    null_set_to_samples_dict = make_null_sets(
-        meta_df, unique_set_sizes, null_size)
     logger.info("There are {} sets corresponding to {} unique set sizes.".format(
-        len(set_to_samples_dict), len(null_set_to_samples_dict)))
-
-    # If in low-memory mode, evaluate chunks of sets at a time
+        len(real_sets), len(unique_set_sizes)))
+
+    if approximate:
+        if null_cache_dir is not None:
+            logger.warning("Null distributions are not cached in approximate mode.")
+
+        return evaluate_sets_approximately(
+            ds, real_sets, unique_set_sizes, aggregation_method, null_size,
+            sims_per_pass, reservoir_size, random_seed)
+
+    # Reuse null distributions from the cache if possible
+    null_cache_path = None
+    cached_null_dict = {}
+    if null_cache_dir is not None:
+        if random_seed is None:
+            logger.warning("Null distributions are only cached if random_seed is set.")
+        else:
+            null_cache_path = get_null_cache_path(
+                null_cache_dir, ds, sim_mat_result_record.sample_ids,
+                aggregation_method, random_seed)
+            cached_null_dict = read_null_cache(null_cache_path)
+
+    # The cache holds the same number of nulls for every set size. If that is
+    # fewer than null_size, all cached nulls are extended; nulls for new set
+    # sizes are made as long as the cache so that they can be added to it
+    num_cached_nulls = len(cached_null_dict.values()[0]) if cached_null_dict else 0
+    set_sizes_to_compute = unique_set_sizes.difference(cached_null_dict.keys())
+    set_sizes_to_extend = set(cached_null_dict.keys()) if num_cached_nulls < null_size else set()
+    logger.info("{} of {} null distributions must be computed; {} cached ones must be extended.".format(
+        len(set_sizes_to_compute), len(unique_set_sizes), len(set_sizes_to_extend)))
+
+    # Make nulls by picking random positions in the similarity matrix
+    null_set_to_indices_dict = make_null_set_indices(
+        len(meta_df), set_sizes_to_compute, max(null_size, num_cached_nulls), random_seed)
+    if set_sizes_to_extend:
+        null_set_to_indices_dict.update(make_null_set_indices(
+            len(meta_df), set_sizes_to_extend, null_size, random_seed,
+            first_null=num_cached_nulls))
+
+    # If in low-memory mode, read the GCTX in blocks while evaluating sets
     if low_memory_mode:
         logger.info("Running in low-memory mode.")
 
-        # Evaluate chunks of null sets
-        set_size_to_agg_sim_dict = evaluate_chunks_of_null_sets(
-            ds, null_set_to_samples_dict, aggregation_method, sets_per_chunk)
+        logger.info("Evaluating null sets...")
+        new_null_dict = evaluate_index_sets_from_gctx(
+            ds, meta_df.index, null_set_to_indices_dict, aggregation_method,
+            sims_per_pass)
 
-        # Evaluate chunks of real sets
-        results_df = evaluate_chunks_of_real_sets(
-            ds, set_to_samples_dict, set_size_to_agg_sim_dict,
-            aggregation_method, sets_per_chunk)
+    # Otherwise, evaluate all null sets at once
+    else:
+        # Null set positions refer to meta_df; convert them to positions in data_df
+        data_df_positions = gct.data_df.index.get_indexer(meta_df.index)
+        for set_size, index_sets in null_set_to_indices_dict.iteritems():
+            null_set_to_indices_dict[set_size] = data_df_positions[index_sets]
+
+        logger.info("Evaluating null sets...")
+        new_null_dict = evaluate_null_set_indices(
+            gct.data_df, null_set_to_indices_dict, aggregation_method)
+
+    # Extend the cache with any new set sizes
+    if null_cache_path is not None:
+        # Use the precision of the cache so that results don't depend on
+        # whether nulls came from the cache
+        for set_size in new_null_dict.keys():
+            new_null_dict[set_size] = new_null_dict[set_size].astype(np.float32)
+            if set_size in set_sizes_to_extend:
+                new_null_dict[set_size] = np.concatenate(
+                    [cached_null_dict[set_size], new_null_dict[set_size]])
+
+        if len(new_null_dict) > 0:
+            cached_null_dict.update(new_null_dict)
+            write_null_cache(null_cache_path, cached_null_dict)
+
+    # The cache may hold more than null_size nulls
+    set_size_to_agg_sim_dict = {}
+    for set_size in unique_set_sizes:
+        if set_size in new_null_dict:
+            set_size_to_agg_sim_dict[set_size] = new_null_dict[set_size][:null_size]
+        else:
+            set_size_to_agg_sim_dict[set_size] = cached_null_dict[set_size][:null_size]
+
+    # Evaluate real sets
+    if low_memory_mode:
+        results_df = evaluate_real_sets_from_gctx(
+            ds, real_sets, set_size_to_agg_sim_dict, aggregation_method,
+            sims_per_pass)
 
-    # Otherwise, evaluate all sets at once
     else:
-        # TODO: evaluate_all_sets will be reorganized to act on gctoo (no dicts)
-        results_df, set_size_to_agg_sim_dict = evaluate_all_sets(
-            gct.data_df, set_to_samples_dict, null_set_to_samples_dict, aggregation_method)
+        results_df = evaluate_real_sets(
+            gct.data_df, real_sets, set_size_to_agg_sim_dict, aggregation_method)
 
     # Return null distributions as GCToo object
     nulls_gct = null_dict_to_gctoo(set_size_to_agg_sim_dict)
@@ -737,6 +1022,195 @@ def evaluate_sets_on_single_sim_mat(ds, set_definitions, aggregation_method,
     return results_df, nulls_gct
 
 
+def evaluate_sets_approximately(ds, real_sets, unique_set_sizes,
+                                aggregation_method, null_size, sims_per_pass,
+                                reservoir_size, random_seed):
+    """ Evaluate sets against null distributions modeled from a reservoir of
+    pairwise similarities, rather than from null sets in the matrix.
+
+    Args:
+        ds (string): path to GCTX
+        real_sets (SetIndex)
+        unique_set_sizes (set of integers)
+        aggregation_method (string)
+        null_size (integer): number of aggregated similarities to model
+            per set size
+        sims_per_pass (integer): maximum number of similarities to read or
+            draw at once
+        reservoir_size (integer)
+        random_seed (integer)
+
+    Returns:
+        results_df (pandas df): see evaluate_sets_on_single_sim_mat
+        nulls_gct (GCToo object)
+
+    """
+    if random_seed is None:
+        rand_state = np.random
+    else:
+        rand_state = np.random.RandomState(random_seed)
+
+    logger.info("Running in approximate mode.")
+    reservoir = build_sim_reservoir(ds, real_sets.sample_ids, reservoir_size,
+                                    sims_per_pass, rand_state)
+    assert len(reservoir) > 0, "Similarity matrix has no non-NaN similarities."
+
+    logger.info("Modeling null distributions from {} similarities...".format(
+        len(reservoir)))
+    set_size_to_agg_sim_dict = {}
+    for set_size in unique_set_sizes:
+        set_size_to_agg_sim_dict[set_size] = model_null_from_reservoir(
+            reservoir, set_size, int(null_size), aggregation_method,
+            rand_state)
+
+    results_df = evaluate_real_sets_from_gctx(
+        ds, real_sets, set_size_to_agg_sim_dict, aggregation_method,
+        sims_per_pass)
+
+    (pval_lower, pval_upper) = compute_pval_bounds(
+        results_df[PVAL_COLUMN_NAME].values, int(null_size), PVAL_BOUNDS_ALPHA)
+    results_df.insert(results_df.columns.get_loc(PVAL_COLUMN_NAME) + 1,
+                      PVAL_LOWER_COLUMN_NAME, pval_lower)
+    results_df.insert(results_df.columns.get_loc(PVAL_LOWER_COLUMN_NAME) + 1,
+                      PVAL_UPPER_COLUMN_NAME, pval_upper)
+
+    nulls_gct = null_dict_to_gctoo(set_size_to_agg_sim_dict)
+
+    return results_df, nulls_gct
+
+
+def build_sim_reservoir(ds, sample_ids, reservoir_size, max_block_elements,
+                        rand_state):
+    """ Sample pairwise similarities uniformly at random from the upper
+    triangle of the (possibly subsetted) similarity matrix, reading the GCTX
+    in blocks of columns and keeping at most reservoir_size similarities in
+    memory (reservoir sampling). NaNs are skipped.
+
+    Args:
+        ds (string): path to GCTX
+        sample_ids (pandas Index)
+        reservoir_size (integer)
+        max_block_elements (integer): maximum number of elements to read
+            from ds at once
+        rand_state (numpy RandomState)
+
+    Returns:
+        reservoir (numpy array): at most reservoir_size similarities
+
+    """
+    row_positions = cpp.parse(ds, row_meta_only=True).index.get_indexer(sample_ids)
+    col_positions = cpp.parse(ds, col_meta_only=True).index.get_indexer(sample_ids)
+    assert (row_positions >= 0).all() and (col_positions >= 0).all(), (
+        "All sample ids must be in both the rows and the columns of {}".format(ds))
+
+    # Order samples as they are stored, so that each block is contiguous
+    sample_order = np.argsort(col_positions)
+    ordered_rows = row_positions[sample_order]
+    ordered_cols = col_positions[sample_order]
+
+    # parse returns rows sorted by position; this puts them back in sample order
+    sorted_ridx = np.sort(ordered_rows)
+    rows_in_sample_order = np.searchsorted(sorted_ridx, ordered_rows)
+
+    num_samples = len(sample_ids)
+    reservoir = np.empty(reservoir_size)
+    num_seen = 0
+
+    cols_per_block = max(1, max_block_elements // num_samples)
+    for start in xrange(0, num_samples, cols_per_block):
+        stop = min(start + cols_per_block, num_samples)
+        block = cpp.parse(ds, ridx=sorted_ridx.tolist(),
+                          cidx=ordered_cols[start:stop].tolist()).data_df.values
+        block = block[rows_in_sample_order, :]
+
+        # Keep the upper triangle: sample i < sample j
+        upper = np.arange(num_samples)[:, np.newaxis] < np.arange(start, stop)[np.newaxis, :]
+        block_vals = block[upper]
+        block_vals = block_vals[~np.isnan(block_vals)]
+
+        num_seen = update_reservoir(reservoir, num_seen, block_vals, rand_state)
+
+    return reservoir[:min(num_seen, reservoir_size)]
+
+
+def update_reservoir(reservoir, num_seen, new_vals, rand_state):
+    """ Add new_vals to a reservoir sample (Algorithm R), in place.
+
+    Args:
+        reservoir (numpy array): modified in place
+        num_seen (integer): number of values seen before new_vals
+        new_vals (numpy array)
+        rand_state (numpy RandomState)
+
+    Returns:
+        num_seen (integer): number of values seen, including new_vals
+
+    """
+    reservoir_size = len(reservoir)
+
+    # Fill the reservoir first
+    num_to_fill = max(0, min(reservoir_size - num_seen, len(new_vals)))
+    reservoir[num_seen:num_seen + num_to_fill] = new_vals[:num_to_fill]
+    num_seen += num_to_fill
+    new_vals = new_vals[num_to_fill:]
+
+    if len(new_vals) > 0:
+        # The kth value seen replaces a random slot with probability
+        # reservoir_size / k
+        slots = np.floor(rand_state.rand(len(new_vals)) *
+                         np.arange(num_seen + 1, num_seen + len(new_vals) + 1)).astype(int)
+        is_kept = slots < reservoir_size
+
+        # If a slot is picked more than once, the last value wins
+        (kept_slots, last_picks) = np.unique(slots[is_kept][::-1], return_index=True)
+        reservoir[kept_slots] = new_vals[is_kept][::-1][last_picks]
+        num_seen += len(new_vals)
+
+    return num_seen
+
+
+def model_null_from_reservoir(reservoir, set_size, null_size, aggregation_method,
+                              rand_state):
+    """ Model the null distribution of the aggregated similarity of a set of
+    size set_size by aggregating similarities drawn at random from the
+    reservoir. Drawn similarities are treated as independent, which ignores
+    that similarities within a real set share samples.
+
+    Args:
+        reservoir (numpy array)
+        set_size (integer)
+        null_size (integer)
+        aggregation_method (string)
+        rand_state (numpy RandomState)
+
+    Returns:
+        agg_sims (numpy array): null_size aggregated similarities
+
+    """
+    (triu_rows, triu_cols) = np.triu_indices(set_size, k=1)
+    num_pairs = len(triu_rows)
+
+    agg_sims = np.full(null_size, np.nan)
+    sets_per_batch = max(1, NULL_BATCH_MAX_ELEMENTS // (set_size ** 2))
+
+    for start in xrange(0, null_size, sets_per_batch):
+        num_sets = min(sets_per_batch, null_size - start)
+        draws = reservoir[rand_state.randint(0, len(reservoir), size=(num_sets, num_pairs))]
+
+        # median_of_medians needs whole (symmetric) submatrices
+        if aggregation_method == "median_of_medians":
+            gathered = np.empty((num_sets, set_size, set_size))
+            gathered[:, triu_rows, triu_cols] = draws
+            gathered[:, triu_cols, triu_rows] = draws
+        else:
+            gathered = draws
+
+        agg_sims[start:start + num_sets] = aggregate_gathered_sims(
+            gathered, aggregation_method)
+
+    return agg_sims
+
+
 def make_sets_from_meta_df(meta_df, match_field):
     """ Create sets using metadata from the GCT(X).
 
@@ -745,103 +1219,137 @@ def make_sets_from_meta_df(meta_df, match_field):
         match_field (string): which field to use for creating sets
 
     Returns:
-        set_to_samples_dict (dict): keys are set names, values
-            are sample identifiers
+        set_index (SetIndex): positions refer to meta_df.index
 
     """
+    # Encode the value of match_field of each sample
+    (codes, set_names) = pd.factorize(meta_df[match_field])
+    is_coded = codes >= 0
 
-    # Get indices corresponding to each set
-    dict_of_indices = meta_df.groupby(match_field).indices
-
-    # Convert into dict where keys are set names, values are the sample identifiers
-    set_to_samples_dict = {}
-    for k, v in dict_of_indices.iteritems():
+    # Group samples with the same value
+    positions = np.argsort(codes, kind="mergesort")[(~is_coded).sum():]
+    set_sizes = np.bincount(codes[is_coded], minlength=len(set_names))
+    offsets = np.zeros(len(set_names) + 1, dtype=int)
+    offsets[1:] = np.cumsum(set_sizes)
+    set_index = SetIndex(np.asarray(set_names), offsets, positions, meta_df.index)
 
-        if len(v) > 1:
-            set_to_samples_dict[k] = set(meta_df.index[v])
-        else:
-            logger.debug("Set {} only has 1 element. Ignoring...".format(k))
+    is_big_enough = set_sizes > 1
+    if not is_big_enough.all():
+        logger.debug("{} sets only have 1 element. Ignoring...".format(
+            (~is_big_enough).sum()))
+        set_index = set_index.subset(is_big_enough)
 
-    assert len(set_to_samples_dict) > 0, "No sets were created!"
+    assert len(set_index) > 0, "No sets were created!"
 
-    return set_to_samples_dict
+    return set_index
 
 
 def make_sets_from_gmt(path_to_gmt, meta_df, match_field):
-    """ Get set definitions from the GMT file. Then use meta_df to create a
-    mapping between set names and the ids of samples belonging to that set.
-    Note that multiple samples can map to the same set member (i.e. an
-    individual item from the GMT file), so we need to go through each
-    set_member to get what samples it corresponds to.
+    """ Get set definitions from the GMT file (or compiled GMT; see
+    compile_gmt.py). Then use meta_df to get the positions of the samples
+    belonging to each set. Note that multiple samples can map to the same set
+    member (i.e. an individual item from the GMT file), so each set member is
+    expanded into the positions of all of its samples.
 
     Args:
-        path_to_gmt (string): path to GMT file
+        path_to_gmt (string): path to GMT or compiled GMT file
         meta_df (pandas df): metadata, either external or embedded
         match_field (string): metadata field in meta_df to use
             for matching to GMT set members
 
     Returns:
-        set_to_samples_dict (dict): keys are sets, values are set (i.e. unique
-            lists) of sample ids
+        set_index (SetIndex): positions refer to meta_df.index
     """
     assert os.path.exists(path_to_gmt)
-    this_gmt = gmt.read(path_to_gmt)
-
-    # Mess with gmt to make it a simple dictionary
-    set_to_set_members_dict = {}
-    for g in this_gmt:
-        set_to_set_members_dict[g["head"]] = g["entry"]
-
-    # Multiple samples can map to the same set member, so we need to go through
-    # each set_member to get what samples it corresponds to
-    set_to_samples_dict = {}
-    for this_set, set_members in set_to_set_members_dict.items():
-
-        all_samples_in_this_set = []
-        for set_member in set_members:
-
-            # If set_member not present in meta_df, skip it
-            if not any(meta_df[match_field] == set_member):
-                msg = ("set_member {} from set {} not present in meta_df. " +
-                       "Skipping...").format(set_member, this_set)
-                logger.warning(msg)
-                continue
-
-            # If set_member is present, add its samples to the growing list of
-            # samples for this set
-            samples_for_this_set_member = meta_df.index[meta_df[match_field] == set_member].tolist()
-            all_samples_in_this_set.extend(samples_for_this_set_member)
-
-        # Only include the set if it has more than one sample
-        if len(all_samples_in_this_set) > 1:
-            # Store list of samples as a set for faster access later
-            set_to_samples_dict[this_set] = set(all_samples_in_this_set)
-        else:
-            msg = "set {} has fewer than 2 elements. Skipping...".format(this_set)
-            logger.warning(msg)
+    compiled_gmt = compile_gmt.read_set_definitions(path_to_gmt)
+    num_sets = len(compiled_gmt)
+
+    # Which set member each sample corresponds to (-1 if none)
+    sample_member_codes = pd.Index(compiled_gmt.members).get_indexer(
+        meta_df[match_field].values)
+    is_coded = sample_member_codes >= 0
+
+    # Group samples by set member
+    member_samples = np.argsort(sample_member_codes, kind="mergesort")[(~is_coded).sum():]
+    member_counts = np.bincount(sample_member_codes[is_coded],
+                                minlength=len(compiled_gmt.members))
+    member_starts = np.cumsum(member_counts) - member_counts
+
+    # If set_member not present in meta_df, skip it
+    entry_counts = member_counts[compiled_gmt.member_codes]
+    if (entry_counts == 0).any():
+        missing_members = compiled_gmt.members[compiled_gmt.member_codes[entry_counts == 0]]
+        msg = ("{} set members are not present in meta_df. " +
+               "Skipping them. First few: {}").format(
+                   len(missing_members), list(missing_members[:5]))
+        logger.warning(msg)
+
+    # Expand each set member into the positions of its samples
+    entry_offsets = np.cumsum(entry_counts) - entry_counts
+    within_entry = np.arange(entry_counts.sum()) - np.repeat(entry_offsets, entry_counts)
+    positions = member_samples[
+        np.repeat(member_starts[compiled_gmt.member_codes], entry_counts) + within_entry]
+
+    entry_set_ids = np.repeat(np.arange(num_sets), np.diff(compiled_gmt.offsets))
+    set_sizes = np.bincount(entry_set_ids, weights=entry_counts,
+                            minlength=num_sets).astype(int)
+    offsets = np.zeros(num_sets + 1, dtype=int)
+    offsets[1:] = np.cumsum(set_sizes)
+    set_index = SetIndex(compiled_gmt.set_names, offsets, positions, meta_df.index)
+
+    # Only include sets that have more than one sample
+    is_big_enough = set_sizes > 1
+    if not is_big_enough.all():
+        msg = "{} sets have fewer than 2 elements. Skipping them. First few: {}".format(
+            (~is_big_enough).sum(), list(compiled_gmt.set_names[~is_big_enough][:5]))
+        logger.warning(msg)
+        set_index = set_index.subset(is_big_enough)
+
+    assert len(set_index) > 0, "No sets were created!"
+
+    return set_index
+
+
+def make_set_index_from_dict(set_to_samples_dict, sample_ids):
+    """ Create a SetIndex from a dict of sets of sample ids.
+
+    Args:
+        set_to_samples_dict (dict): keys are set names, values are sets (i.e.
+            unique lists) of sample ids
+        sample_ids (pandas Index): ids that the positions should refer to
+
+    Returns:
+        set_index (SetIndex)
+
+    """
+    set_names = sorted(set_to_samples_dict.keys())
+    set_sizes = [len(set_to_samples_dict[set_name]) for set_name in set_names]
+
+    all_samples = []
+    for set_name in set_names:
+        all_samples.extend(set_to_samples_dict[set_name])
 
-    assert len(set_to_samples_dict) > 0, "No sets were created!"
+    positions = sample_ids.get_indexer(all_samples)
+    assert (positions >= 0).all(), "All set members must be in sample_ids."
 
-    return set_to_samples_dict
+    offsets = np.zeros(len(set_names) + 1, dtype=int)
+    offsets[1:] = np.cumsum(set_sizes)
+
+    return SetIndex(set_names, offsets, positions, sample_ids)
 
 
 def remove_big_sets(sets, max_set_size):
     """ Remove sets above max_set_size.
 
     Args:
-        sets (dict): keys are set names, values are sets (i.e. unique lists)
-            of sample ids
+        sets (SetIndex)
         max_set_size (int): maximum set size
 
     Returns:
-        sets_clean (dict)
+        sets_clean (SetIndex)
 
     """
-    sets_clean = {}
-
-    for k, v in sets.iteritems():
-        if len(v) <= max_set_size:
-            sets_clean[k] = v
+    sets_clean = sets.subset(sets.set_sizes() <= max_set_size)
 
     if len(sets_clean) != len(sets):
         num_removed = len(sets) - len(sets_clean)
@@ -851,37 +1359,114 @@ def remove_big_sets(sets, max_set_size):
     return sets_clean
 
 
-def make_null_sets(meta_df, unique_set_sizes, null_size):
-    """ Randomly pick samples from meta_df to create null sets. Create N=null_size
-    sets for each unique set size.
+def make_null_set_indices(num_samples, unique_set_sizes, null_size, random_seed=None,
+                          first_null=0):
+    """ Randomly pick positions in the similarity matrix to create null sets.
+    Create N=null_size sets for each unique set size. Each null set is a row of
+    integer positions rather than a set of sample ids, so that null sets can
+    be evaluated in batches.
 
     Args:
-        meta_df (pandas df): metadata about samples
+        num_samples (integer): number of samples to pick from
         unique_set_sizes (list of integers): the unique set sizes in these data
         null_size (integer): number of times to randomly sample
+        random_seed (integer): if not None, the null sets of each size are
+            drawn in blocks of NULL_SEED_BLOCK_SIZE sets, each from a random
+            state seeded with (random_seed, set_size, block number), so they
+            do not depend on what other set sizes are present or on null_size
+        first_null (integer): only return null sets first_null onwards, e.g.
+            to extend a cache of first_null null sets
 
     Returns:
-        null_set_to_samples_dict (dict): keys are unique_set_sizes, values are
-            lists of sets (i.e. unique lists) of sample_ids
+        null_set_to_indices_dict (dict): keys are unique_set_sizes, values are
+            integer arrays of shape (null_size - first_null, set_size); no
+            position is repeated within a row
 
     """
-    # Get sample identifiers
-    samples = meta_df.index.values
-
-    # For each unique_set_size, pick that many samples randomly and do it N=null_size times
-    null_set_to_samples_dict = {}
+    null_set_to_indices_dict = {}
+    num_nulls = int(null_size) - first_null
 
     logger.info("Creating null sets...")
     for set_size in unique_set_sizes:
-        this_list = [None] * null_size
+        if random_seed is None:
+            null_set_to_indices_dict[set_size] = draw_random_index_sets(
+                num_samples, set_size, num_nulls)
+            continue
+
+        first_block = first_null // NULL_SEED_BLOCK_SIZE
+        stop_block = -(-int(null_size) // NULL_SEED_BLOCK_SIZE)
+        blocks = [np.empty((0, set_size), dtype=int)]
+        for block_num in xrange(first_block, stop_block):
+            rand_state = np.random.RandomState([random_seed, set_size, block_num])
+            blocks.append(draw_random_index_sets(
+                num_samples, set_size, NULL_SEED_BLOCK_SIZE, rand_state))
+
+        skip = first_null - first_block * NULL_SEED_BLOCK_SIZE
+        null_set_to_indices_dict[set_size] = np.concatenate(blocks)[skip:skip + num_nulls]
+
+    return null_set_to_indices_dict
+
+
+def draw_random_index_sets(num_samples, set_size, num_sets, rand_state=None):
+    """ Draw num_sets random sets of set_size distinct positions out of
+    range(num_samples).
+
+    Small sets are drawn with replacement and rows that happen to contain
+    duplicates are redrawn; large sets are drawn by taking the positions of
+    the set_size smallest values in rows of random numbers.
+
+    Args:
+        num_samples (integer)
+        set_size (integer)
+        num_sets (integer)
+        rand_state (numpy RandomState): if None, numpy's global random state
+            is used
+
+    Returns:
+        index_sets (numpy array of integers): shape (num_sets, set_size)
 
-        for ii in xrange(int(null_size)):
-            these_random_samples = random.sample(samples, set_size)
-            this_list[ii] = set(these_random_samples)
+    """
+    if rand_state is None:
+        rand_state = np.random
+
+    assert set_size <= num_samples, (
+        "Cannot pick sets of {} samples out of {} samples.".format(
+            set_size, num_samples))
+
+    # Duplicates are rare when set_size ** 2 is small relative to num_samples
+    if set_size ** 2 <= num_samples:
+        index_sets = rand_state.randint(0, num_samples, size=(num_sets, set_size))
+        rows_to_redraw = rows_with_duplicates(index_sets)
+        while rows_to_redraw.any():
+            index_sets[rows_to_redraw, :] = rand_state.randint(
+                0, num_samples, size=(rows_to_redraw.sum(), set_size))
+            rows_to_redraw = rows_with_duplicates(index_sets)
+
+    else:
+        index_sets = np.empty((num_sets, set_size), dtype=int)
+        rows_per_batch = max(1, NULL_BATCH_MAX_ELEMENTS // num_samples)
+        for start in xrange(0, num_sets, rows_per_batch):
+            stop = min(start + rows_per_batch, num_sets)
+            random_keys = rand_state.rand(stop - start, num_samples)
+            index_sets[start:stop, :] = np.argpartition(
+                random_keys, set_size - 1, axis=1)[:, :set_size]
+
+    return index_sets
+
+
+def rows_with_duplicates(index_sets):
+    """ Return a boolean array indicating which rows of index_sets contain
+    a repeated value.
+
+    Args:
+        index_sets (2-D numpy array of integers)
 
-        null_set_to_samples_dict[set_size] = this_list
+    Returns:
+        has_duplicates (numpy array of bools)
 
-    return null_set_to_samples_dict
+    """
+    sorted_index_sets = np.sort(index_sets, axis=1)
+    return (sorted_index_sets[:, 1:] == sorted_index_sets[:, :-1]).any(axis=1)
 
 
 def evaluate_all_sets(data_df, real_sets, null_sets, aggregation_method):
@@ -890,10 +1475,10 @@ def evaluate_all_sets(data_df, real_sets, null_sets, aggregation_method):
 
     Args:
         data_df (pandas df)
-        real_sets (dict): keys are set names, values are sets (i.e. unique
-            lists) of sample ids in data_df
-        null_sets (dict): keys are fake set names, values are lists of sets
-            (i.e. unique lists) of sample ids in data_df
+        real_sets (SetIndex): sample ids must be in data_df
+        null_sets (dict): keys are set sizes, values are integer arrays of
+            positions in data_df, one row per null set
+            (see make_null_set_indices)
         aggregation_method (string): how to aggregate the self sims
 
     Returns:
@@ -907,73 +1492,96 @@ def evaluate_all_sets(data_df, real_sets, null_sets, aggregation_method):
 
 
     """
-    # Initialize output
-    results_df = pd.DataFrame(np.nan, index=real_sets.keys(),
-                              columns=[AGG_SIM_COLUMN_NAME, SET_SIZE_COLUMN_NAME, PVAL_COLUMN_NAME])
-
     # Evaluate null sets (slowest part)
     logger.info("Evaluating null sets...")
-    set_size_to_agg_sim_dict = evaluate_null_sets(data_df, null_sets, aggregation_method)
+    set_size_to_agg_sim_dict = evaluate_null_set_indices(data_df, null_sets, aggregation_method)
 
-    # Evaluate each real set
-    logger.info("Evaluating {} real sets...".format(len(real_sets)))
-    for set_name, set_elements in real_sets.iteritems():
+    results_df = evaluate_real_sets(data_df, real_sets, set_size_to_agg_sim_dict,
+                                    aggregation_method)
 
-        (this_agg_sim, this_n, this_pval) = evaluate_one_set(
-            data_df, set_elements, set_size_to_agg_sim_dict,
-            aggregation_method)
+    return results_df, set_size_to_agg_sim_dict
 
-        # Insert into output df
-        results_df.loc[set_name, :] = [this_agg_sim, this_n, this_pval]
 
-    # Compute q-values
-    results_df[QVAL_COLUMN_NAME] = convert_to_qvals(results_df[PVAL_COLUMN_NAME].values)
+def evaluate_real_sets(data_df, real_sets, null_dict, aggregation_method):
+    """ Evaluate all real sets against null distributions that have already
+    been computed. Sets of the same size are evaluated together (see
+    get_agg_sims_of_index_sets).
 
-    # Sort by the index
-    results_df.sort_index(axis=0, inplace=True)
+    Args:
+        data_df (pandas df)
+        real_sets (SetIndex): sample ids must be in data_df
+        null_dict (dict): keys are set sizes, values are
+            arrays of aggregated similarities
+        aggregation_method (string): how to aggregate the self sims
 
-    return results_df, set_size_to_agg_sim_dict
+    Returns:
+        results_df (pandas df): see evaluate_all_sets
+
+    """
+    sim_matrix = get_sim_matrix(data_df)
+
+    # Positions in real_sets refer to real_sets.sample_ids
+    data_df_positions = data_df.index.get_indexer(real_sets.sample_ids)
+
+    logger.info("Evaluating {} real sets...".format(len(real_sets)))
+    set_size_to_sets = real_sets.index_sets_by_size()
+    set_size_to_agg_sims = {}
+    for set_size, (_, index_sets) in set_size_to_sets.iteritems():
+        set_size_to_agg_sims[set_size] = get_agg_sims_of_index_sets(
+            sim_matrix, data_df_positions[index_sets], aggregation_method)
 
+    return make_results_df(set_size_to_sets, set_size_to_agg_sims, null_dict)
 
-def evaluate_one_set(data_df, set_elements, null_dict, aggregation_method):
-    """ Compute similarity, n, and p-value for one set. Null similarities must
-    be provided.
+
+def make_results_df(set_size_to_sets, set_size_to_agg_sims, null_dict):
+    """ Compute p-values and q-values of real sets and put all results into
+    one dataframe.
 
     Args:
-        data_df (pandas df)
-        set_elements (list): ids in data_df
+        set_size_to_sets (dict): see SetIndex.index_sets_by_size
+        set_size_to_agg_sims (dict): keys are set sizes, values are arrays of
+            aggregated similarities of real sets, in the same order as the
+            set names in set_size_to_sets
         null_dict (dict): keys are set sizes, values are
             arrays of aggregated similarities
-        aggregation_method (string): how to aggregate the self sims
 
     Returns:
-        this_agg_sim (float)
-        this_n (int)
-        this_pval (float)
+        results_df (pandas df): see evaluate_all_sets
 
     """
-    # Get set size
-    this_n = int(len(set_elements))
+    list_of_dfs = []
+    for set_size, (set_names, _) in set_size_to_sets.iteritems():
+        assert set_size in null_dict.keys()
+        agg_sims = set_size_to_agg_sims[set_size]
+        pvals = [compute_pval(this_agg_sim, null_dict[set_size]) for this_agg_sim in agg_sims]
+
+        this_df = pd.DataFrame({AGG_SIM_COLUMN_NAME: agg_sims,
+                                SET_SIZE_COLUMN_NAME: float(set_size),
+                                PVAL_COLUMN_NAME: pvals},
+                               index=set_names,
+                               columns=[AGG_SIM_COLUMN_NAME, SET_SIZE_COLUMN_NAME, PVAL_COLUMN_NAME])
+        list_of_dfs.append(this_df)
 
-    # Compute aggregated similarity
-    this_agg_sim = get_agg_sim(data_df, set_elements, aggregation_method)
+    results_df = pd.concat(list_of_dfs, axis=0)
 
-    # Compute p-value
-    assert this_n in null_dict.keys()
-    null_sims =  null_dict[this_n]
-    this_pval = compute_pval(this_agg_sim, null_sims)
+    # Compute q-values
+    results_df[QVAL_COLUMN_NAME] = convert_to_qvals(results_df[PVAL_COLUMN_NAME].values)
 
-    return this_agg_sim, this_n, this_pval
+    # Sort by the index
+    results_df.sort_index(axis=0, inplace=True)
+
+    return results_df
 
 
-def evaluate_null_sets(data_df, null_sets, aggregation_method):
+def evaluate_null_set_indices(data_df, null_sets, aggregation_method):
     """ Return aggregated similarity for null sets in a dictionary, where keys
-    are unique set sizes and values are arrays of aggregated sims.
+    are unique set sizes and values are arrays of aggregated sims. All null
+    sets of a given size are evaluated together (see get_agg_sims_of_index_sets).
 
     Args:
         data_df (pandas df)
-        null_sets (dict): keys are set sizes, values are lists of sets (i.e.
-            unique lists) containing sample ids
+        null_sets (dict): keys are set sizes, values are integer arrays of
+            positions in data_df, one row per null set
         aggregation_method (string): how to aggregated extracted similarities
 
     Returns:
@@ -981,177 +1589,210 @@ def evaluate_null_sets(data_df, null_sets, aggregation_method):
             arrays of aggregated similarities
 
     """
+    sim_matrix = get_sim_matrix(data_df)
+
     # Initialize output
     set_size_to_agg_sim_dict = {}
 
-    for set_size, list_of_sets in null_sets.iteritems():
-        these_sims = [get_agg_sim(data_df, s, aggregation_method) for s in list_of_sets]
-        set_size_to_agg_sim_dict[set_size] = np.array(these_sims)
+    for set_size, index_sets in null_sets.iteritems():
+        set_size_to_agg_sim_dict[set_size] = get_agg_sims_of_index_sets(
+            sim_matrix, index_sets, aggregation_method)
 
     return set_size_to_agg_sim_dict
 
 
-def evaluate_chunks_of_real_sets(ds, real_sets, null_dict, aggregation_method, sets_per_chunk):
-    """ Evaluate all real sets, chunks at a time. This is used in low-memory mode.
+def get_sim_matrix(data_df):
+    """ Return the values of data_df as a float array whose columns are in the
+    same order as its rows, so that a position refers to the same sample
+    along both axes.
 
     Args:
-        ds (string): path to GCT(X)
-        real_sets (dict): keys are set names, values are sets (i.e. unique
-            lists) of sample ids in GCT(X)
-        null_dict (dict): keys are set sizes, values are
-            arrays of aggregated similarities
-        aggregation_method (string): how to aggregate the self sims
-        sets_per_chunk (integer): number of sets to evaluate at a time in low-
-            memory mode
+        data_df (pandas df): square similarity matrix
 
     Returns:
-        results_df (pandas df): index is set names, columns are the following:
-            agg_sim: aggregated similarity
-            set_size: number of samples in this set
-            pval: p-value for this set
-            qval: q-value for this set
+        sim_matrix (2-D numpy array)
 
     """
-    # Create chunks of set_names and their corresponding elements
-    chunks_of_set_names = chunkify(real_sets.keys(), sets_per_chunk)
-    chunks_of_sets = chunkify(real_sets.values(), sets_per_chunk)
-    chunks = zip(chunks_of_set_names, chunks_of_sets)
+    col_positions = data_df.columns.get_indexer(data_df.index)
+    assert (col_positions >= 0).all(), (
+        "Row and column ids of the similarity matrix must be the same.")
 
-    list_of_dfs = []
-
-    # Return aggregated similarities for sets in a single chunk
-    # A chunk consists of tuples of set names and sets
-    for chunk_num, chunk in enumerate(chunks):
+    sim_matrix = data_df.values.astype(float)
+    if not np.array_equal(col_positions, np.arange(len(col_positions))):
+        sim_matrix = sim_matrix[:, col_positions]
 
-        # Unpack
-        set_names = chunk[0]
-        list_of_sets = chunk[1]
+    return sim_matrix
 
-        # Initialize output for this chunk
-        this_df = pd.DataFrame(np.nan, index=set_names,
-                               columns=[AGG_SIM_COLUMN_NAME, SET_SIZE_COLUMN_NAME, PVAL_COLUMN_NAME])
 
-        logger.info("For real sets, evaluating chunk {} of {}.".format(
-            chunk_num+1, len(chunks)))
+def evaluate_real_sets_from_gctx(ds, real_sets, null_dict, aggregation_method,
+                                 sims_per_pass):
+    """ Low-memory version of evaluate_real_sets. Real sets are grouped by
+    size and evaluated with evaluate_index_sets_from_gctx.
 
-        # Read in slice of GCT(X) corresponding to this chunk
-        chunk_ids = get_chunk_ids(list_of_sets)
-        g = cpp.parse(ds, rid=chunk_ids, cid=chunk_ids)
-
-        for this_set_tuple in zip(*chunk):
-
-            # Unpack tuple to get set name and set elements
-            set_name = this_set_tuple[0]
-            set_elements = this_set_tuple[1]
-
-            (this_agg_sim, this_n, this_pval) = evaluate_one_set(
-                g.data_df, set_elements, null_dict, aggregation_method)
-
-            # Insert into output df
-            this_df.loc[set_name, :] = [this_agg_sim, this_n, this_pval]
+    Args:
+        ds (string): path to GCTX
+        real_sets (SetIndex): sample ids must be in ds
+        null_dict (dict): keys are set sizes, values are
+            arrays of aggregated similarities
+        aggregation_method (string): how to aggregate the self sims
+        sims_per_pass (integer)
 
-        # Append results for this chunk
-        list_of_dfs.append(this_df)
+    Returns:
+        results_df (pandas df): see evaluate_all_sets
 
-    # Concatenate chunk results
-    results_df = pd.concat(list_of_dfs, axis=0)
+    """
+    set_size_to_sets = real_sets.index_sets_by_size()
+    set_size_to_index_sets = {}
+    for set_size, (_, index_sets) in set_size_to_sets.iteritems():
+        set_size_to_index_sets[set_size] = index_sets
 
-    # Compute q-values
-    results_df[QVAL_COLUMN_NAME] = convert_to_qvals(results_df[PVAL_COLUMN_NAME].values)
+    logger.info("Evaluating {} real sets...".format(len(real_sets)))
+    set_size_to_agg_sims = evaluate_index_sets_from_gctx(
+        ds, real_sets.sample_ids, set_size_to_index_sets, aggregation_method,
+        sims_per_pass)
 
-    # Sort
-    results_df.sort_index(axis=0, inplace=True)
+    return make_results_df(set_size_to_sets, set_size_to_agg_sims, null_dict)
 
-    return results_df
 
+def evaluate_index_sets_from_gctx(ds, sample_ids, set_size_to_index_sets,
+                                  aggregation_method, sims_per_pass):
+    """ Low-memory version of evaluate_null_set_indices. Rather than reading
+    the whole similarity matrix, the similarities needed by the sets are
+    gathered in passes over the GCTX file. Sets of all sizes are packed into
+    passes of at most sims_per_pass similarities, and each pass reads the
+    blocks it needs once (see gather_sims_from_gctx).
 
-def evaluate_chunks_of_null_sets(ds, null_sets, aggregation_method, sets_per_chunk):
-    """ Return aggregated similarity for null sets in a dictionary, where keys
-    are unique set sizes and values are arrays of aggregated sims. This is the
-    version to use in low-memory mode.
+    Blocks are read once per pass, not once overall: all of the similarities
+    of a set are needed at the same time to aggregate it, and random null
+    sets touch nearly every block, so nearly all of the needed part of the
+    matrix is read in every pass. I/O is therefore about (# of passes) x
+    (size of the needed part of the matrix); a larger sims_per_pass means
+    fewer passes, at the cost of memory.
 
     Args:
-        ds (string): path to GCT(X)
-        null_sets (dict): keys are set sizes, values are lists of sets (i.e.
-            unique lists) containing sample ids
-        aggregation_method (string): how to aggregated extracted similarities
-        sets_per_chunk (integer): number of sets to evaluate at a time in low-
-            memory mode
+        ds (string): path to GCTX
+        sample_ids (pandas Index): ids of the (possibly subsetted) similarity
+            matrix; positions in index sets refer to these ids
+        set_size_to_index_sets (dict): keys are set sizes, values are integer
+            arrays of positions in sample_ids, one row per set
+        aggregation_method (string)
+        sims_per_pass (integer)
 
     Returns:
         set_size_to_agg_sim_dict (dict): keys are set sizes, values are
             arrays of aggregated similarities
 
     """
+    # Positions of sample_ids in the rows and columns of the GCTX
+    row_positions = cpp.parse(ds, row_meta_only=True).index.get_indexer(sample_ids)
+    col_positions = cpp.parse(ds, col_meta_only=True).index.get_indexer(sample_ids)
+    assert (row_positions >= 0).all() and (col_positions >= 0).all(), (
+        "All sample ids must be in both the rows and the columns of {}".format(ds))
+
+    # Pack (set size, first set, last set) pieces into passes
+    passes = []
+    this_pass = []
+    this_pass_num_sims = 0
+    for set_size in sorted(set_size_to_index_sets.keys()):
+        num_sets = len(set_size_to_index_sets[set_size])
+        sims_per_set = get_num_sims_per_set(set_size, aggregation_method)
+
+        start = 0
+        while start < num_sets:
+            if this_pass and this_pass_num_sims + sims_per_set > sims_per_pass:
+                passes.append(this_pass)
+                this_pass = []
+                this_pass_num_sims = 0
+
+            sets_in_piece = max(1, (sims_per_pass - this_pass_num_sims) // sims_per_set)
+            stop = min(num_sets, start + sets_in_piece)
+            this_pass.append((set_size, start, stop))
+            this_pass_num_sims += (stop - start) * sims_per_set
+            start = stop
+
+    if this_pass:
+        passes.append(this_pass)
+
     # Initialize output
     set_size_to_agg_sim_dict = {}
+    for set_size, index_sets in set_size_to_index_sets.iteritems():
+        set_size_to_agg_sim_dict[set_size] = np.full(len(index_sets), np.nan)
 
-    # Loop over set sizes
-    for set_size, list_of_sets in null_sets.iteritems():
-
-        # Initialize output for this set_size
-        agg_sims_for_this_set_size = []
-
-        # Create chunks of sets
-        chunks_of_sets = chunkify(list_of_sets, sets_per_chunk)
-
-        # Return aggregated similarities for sets in a single chunk
-        # A chunk is a (smaller) list of sets
-        for chunk_num, chunk in enumerate(chunks_of_sets):
-
-            logger.info("For set size {}, evaluating chunk {} of {}.".format(
-                set_size, chunk_num+1, len(chunks_of_sets)))
+    for pass_num, this_pass in enumerate(passes):
+        logger.info("Gathering similarities, pass {} of {}.".format(
+            pass_num + 1, len(passes)))
 
-            # Read in slice of GCT(X) corresponding to this chunk
-            chunk_ids = get_chunk_ids(chunk)
-            g = cpp.parse(ds, rid=chunk_ids, cid=chunk_ids)
+        gather_rows_list = []
+        gather_cols_list = []
+        for set_size, start, stop in this_pass:
+            (gather_rows, gather_cols) = get_gather_positions(
+                set_size_to_index_sets[set_size][start:stop], aggregation_method)
+            gather_rows_list.append(row_positions[gather_rows])
+            gather_cols_list.append(col_positions[gather_cols])
 
-            # Get aggregated similarities
-            these_sims = [get_agg_sim(g.data_df, s, aggregation_method) for s in chunk]
-            agg_sims_for_this_set_size.extend(these_sims)
+        gathered_list = gather_sims_from_gctx(
+            ds, gather_rows_list, gather_cols_list, sims_per_pass)
 
-        assert len(agg_sims_for_this_set_size) == len(list_of_sets)
-        set_size_to_agg_sim_dict[set_size] = np.array(agg_sims_for_this_set_size)
+        for (set_size, start, stop), gathered in zip(this_pass, gathered_list):
+            set_size_to_agg_sim_dict[set_size][start:stop] = aggregate_gathered_sims(
+                gathered, aggregation_method)
 
     return set_size_to_agg_sim_dict
 
 
-def chunkify(my_list, items_per_chunk):
-    """ Split a list up into chunks with n=items_per_chunk. If items_per_chunk
-    is greater than the length of the list, return the list.
+def gather_sims_from_gctx(ds, gather_rows_list, gather_cols_list, max_block_elements):
+    """ Read the similarities at the requested positions of a GCTX file.
+
+    The data matrix of a GCTX is stored column by column, so the needed
+    columns are read in blocks of contiguous storage, each block once per
+    call. Requests are sorted by column up front so that the requests served
+    by each block are found with a binary search.
 
     Args:
-        my_list (list)
-        items_per_chunk (integer)
+        ds (string): path to GCTX
+        gather_rows_list (list of integer arrays): row positions in ds
+        gather_cols_list (list of integer arrays): column positions in ds;
+            same shapes as the arrays in gather_rows_list
+        max_block_elements (integer): maximum number of elements to read
+            from ds at once
 
     Returns:
-        chunks (list of lists)
+        gathered_list (list of float arrays): same shapes as the arrays in
+            gather_rows_list
 
     """
-    if items_per_chunk > len(my_list):
-        return [my_list]
-
-    else:
-        chunks = [my_list[ii:ii + items_per_chunk] for ii in xrange(
-            0, len(my_list), items_per_chunk)]
-        return chunks
+    flat_rows = np.concatenate([rows.ravel() for rows in gather_rows_list])
+    flat_cols = np.concatenate([cols.ravel() for cols in gather_cols_list])
 
+    # Only read rows and columns that are needed
+    needed_rows = np.unique(flat_rows)
+    needed_cols = np.unique(flat_cols)
+    local_rows = np.searchsorted(needed_rows, flat_rows)
 
-def get_chunk_ids(list_of_sets):
-    """ Extract all ids from list_of_sets.
+    order = np.argsort(flat_cols, kind="mergesort")
+    sorted_cols = flat_cols[order]
 
-    Args:
-        list_of_sets (list): each set contains sample ids
+    flat_sims = np.empty(len(flat_rows))
+    cols_per_block = max(1, max_block_elements // len(needed_rows))
+    for start in xrange(0, len(needed_cols), cols_per_block):
+        block_cols = needed_cols[start:start + cols_per_block]
+        block = cpp.parse(ds, ridx=needed_rows.tolist(),
+                          cidx=block_cols.tolist()).data_df.values
 
-    Returns:
-        all_ids (list): all unique ids in list_of_sets
+        first = np.searchsorted(sorted_cols, block_cols[0], side="left")
+        last = np.searchsorted(sorted_cols, block_cols[-1], side="right")
+        requests = order[first:last]
+        flat_sims[requests] = block[local_rows[requests],
+                                    np.searchsorted(block_cols, flat_cols[requests])]
 
-    """
-    all_ids = []
-    for s in list_of_sets:
-        all_ids.extend(s)
+    # Split back into the requested shapes
+    gathered_list = []
+    offset = 0
+    for rows in gather_rows_list:
+        gathered_list.append(flat_sims[offset:offset + rows.size].reshape(rows.shape))
+        offset += rows.size
 
-    return list(set(all_ids))
+    return gathered_list
 
 
 def get_agg_sim(df, set_ids, aggregation_method):
@@ -1194,6 +1835,172 @@ def get_agg_sim(df, set_ids, aggregation_method):
     return aggregated
 
 
+def get_agg_sims_of_index_sets(sim_matrix, index_sets, aggregation_method):
+    """ Batched version of get_agg_sim. Return the aggregated self-similarity
+    for every set in index_sets, where all sets have the same size.
+
+    Similarities are gathered with fancy indexing (see get_gather_positions)
+    and then aggregated along the trailing axes. Sets are processed in batches
+    so that the gathered array has at most NULL_BATCH_MAX_ELEMENTS elements.
+
+    Args:
+        sim_matrix (2-D numpy array): rows and columns in the same order
+        index_sets (2-D numpy array of integers): one row of positions in
+            sim_matrix per set
+        aggregation_method (string)
+
+    Returns:
+        agg_sims (numpy array): one aggregated similarity per set
+
+    """
+    num_sets, set_size = index_sets.shape
+
+    agg_sims = np.full(num_sets, np.nan)
+    sets_per_batch = max(1, NULL_BATCH_MAX_ELEMENTS // (set_size ** 2))
+
+    for start in xrange(0, num_sets, sets_per_batch):
+        batch = index_sets[start:start + sets_per_batch, :]
+        (gather_rows, gather_cols) = get_gather_positions(batch, aggregation_method)
+        agg_sims[start:start + len(batch)] = aggregate_gathered_sims(
+            sim_matrix[gather_rows, gather_cols], aggregation_method)
+
+    return agg_sims
+
+
+def get_sims_per_pass_from_sets_per_chunk(sets_per_chunk, max_set_size, aggregation_method):
+    """ Convert the deprecated sets_per_chunk to sims_per_pass: a pass holds
+    as many similarities as sets_per_chunk sets of the largest allowed size.
+
+    Args:
+        sets_per_chunk (integer)
+        max_set_size (integer)
+        aggregation_method (string)
+
+    Returns:
+        sims_per_pass (integer)
+
+    """
+    sims_per_pass = sets_per_chunk * max(1, get_num_sims_per_set(max_set_size, aggregation_method))
+    logger.warning(("sets_per_chunk is deprecated; use sims_per_pass instead. " +
+                    "sets_per_chunk: {}, sims_per_pass: {}").format(sets_per_chunk, sims_per_pass))
+
+    return sims_per_pass
+
+
+def get_num_sims_per_set(set_size, aggregation_method):
+    """ Return the number of similarities gathered for a set of size set_size
+    (see get_gather_positions).
+
+    Args:
+        set_size (integer)
+        aggregation_method (string)
+
+    Returns:
+        num_sims (integer)
+
+    """
+    if aggregation_method == "median_of_medians":
+        return set_size ** 2
+    else:
+        return set_size * (set_size - 1) // 2
+
+
+def get_gather_positions(index_sets, aggregation_method):
+    """ Return the positions in the similarity matrix of the similarities
+    needed to aggregate each set: the upper triangle of each set (shape
+    (# sets, # pairs)) or, for median_of_medians, the whole submatrix of each
+    set (shape (# sets, set_size, set_size)).
+
+    Args:
+        index_sets (2-D numpy array of integers): one row of positions per set
+        aggregation_method (string)
+
+    Returns:
+        gather_rows (numpy array of integers)
+        gather_cols (numpy array of integers): same shape as gather_rows
+
+    """
+    if aggregation_method == "median_of_medians":
+        (gather_rows, gather_cols) = np.broadcast_arrays(
+            index_sets[:, :, np.newaxis], index_sets[:, np.newaxis, :])
+    else:
+        (triu_rows, triu_cols) = np.triu_indices(index_sets.shape[1], k=1)
+        gather_rows = index_sets[:, triu_rows]
+        gather_cols = index_sets[:, triu_cols]
+
+    return gather_rows, gather_cols
+
+
+def aggregate_gathered_sims(gathered, aggregation_method):
+    """ Aggregate similarities gathered at the positions returned by
+    get_gather_positions into one value per set.
+
+    Args:
+        gathered (numpy array): first axis corresponds to sets
+        aggregation_method (string)
+
+    Returns:
+        agg_sims (numpy array): one aggregated similarity per set
+
+    """
+    if aggregation_method == "q75":
+        agg_sims = nanpercentile_of_rows(gathered, 75)
+
+    elif aggregation_method == "median":
+        agg_sims = nanpercentile_of_rows(gathered, 50)
+
+    elif aggregation_method == "median_of_medians":
+        set_size = gathered.shape[1]
+        diagonal = np.arange(set_size)
+        (triu_rows, triu_cols) = np.triu_indices(set_size, k=1)
+
+        sub_matrices = np.array(gathered, dtype=float)
+        sub_matrices[:, diagonal, diagonal] = np.nan
+        row_medians = nanpercentile_of_rows(
+            sub_matrices.reshape(-1, set_size), 50).reshape(-1, set_size)
+        agg_sims = nanpercentile_of_rows(row_medians, 50)
+
+        # Match get_agg_sim, which returns NaN if the upper triangle is all NaN
+        agg_sims[np.isnan(sub_matrices[:, triu_rows, triu_cols]).all(axis=1)] = np.nan
+
+    else:
+        raise Exception("aggregation_method not recognized: {}".format(
+            aggregation_method))
+
+    return agg_sims
+
+
+def nanpercentile_of_rows(vals, percentile):
+    """ Compute a percentile of each row of vals, ignoring NaNs and using
+    linear interpolation (as np.nanpercentile does), but without looping
+    over rows. Rows that are all NaN yield NaN.
+
+    Args:
+        vals (2-D numpy array)
+        percentile (float): between 0 and 100
+
+    Returns:
+        out (numpy array): one value per row
+
+    """
+    # NaNs are sorted to the end of each row
+    sorted_vals = np.sort(vals, axis=1)
+    num_valid = (~np.isnan(vals)).sum(axis=1)
+
+    position = (num_valid - 1) * (percentile / 100.)
+    lower = np.floor(position).astype(int).clip(min=0)
+    upper = np.ceil(position).astype(int).clip(min=0)
+    fraction = position - np.floor(position)
+
+    rows = np.arange(vals.shape[0])
+    lower_vals = sorted_vals[rows, lower]
+    upper_vals = sorted_vals[rows, upper]
+    out = lower_vals + (upper_vals - lower_vals) * fraction
+    out[num_valid == 0] = np.nan
+
+    return out
+
+
 def compute_pval(this_agg_sim, null_sims):
     """ Compute p-value by seeing how many similarities in the null are
      greater than the observed similarity.
@@ -1210,6 +2017,33 @@ def compute_pval(this_agg_sim, null_sims):
     return pval
 
 
+def compute_pval_bounds(pvals, null_size, alpha):
+    """ Compute Clopper-Pearson confidence bounds on p-values computed with
+    compute_pval from null distributions of size null_size.
+
+    Args:
+        pvals (numpy array)
+        null_size (integer)
+        alpha (float): 1 - confidence level
+
+    Returns:
+        pval_lower (numpy array)
+        pval_upper (numpy array)
+
+    """
+    pval_lower = np.full(pvals.shape, np.nan)
+    pval_upper = np.full(pvals.shape, np.nan)
+
+    # Create mask to exclude missing values
+    mask = np.isfinite(pvals)
+    if mask.any():
+        counts = np.round(pvals[mask] * null_size)
+        (pval_lower[mask], pval_upper[mask]) = proportion.proportion_confint(
+            counts, null_size, alpha=alpha, method="beta")
+
+    return pval_lower, pval_upper
+
+
 def convert_to_qvals(pvals):
     """ Convert p-values to q-values using the Bonferroni-Hochberg approach.
 
@@ -1259,6 +2093,86 @@ def null_dict_to_gctoo(set_size_to_agg_sim_dict):
     return nulls_gct
 
 
+def get_null_cache_path(null_cache_dir, ds, sample_ids, aggregation_method,
+                        random_seed):
+    """ Return the path of the null cache file for a particular similarity
+    matrix and settings. The file name contains a hash of everything that the
+    null distributions depend on; the similarity matrix is identified by its
+    absolute path, size, and modification time. null_size is not part of it,
+    because seeded nulls of a smaller null_size are the first nulls of a
+    larger one (see make_null_set_indices).
+
+    Args:
+        null_cache_dir (string)
+        ds (string): path to GCT(X)
+        sample_ids (list of strings): ids of (possibly subsetted) similarity matrix
+        aggregation_method (string)
+        random_seed (integer)
+
+    Returns:
+        null_cache_path (string)
+
+    """
+    ds_stat = os.stat(ds)
+    key_items = [os.path.abspath(ds), ds_stat.st_size, ds_stat.st_mtime,
+                 sorted([str(sample_id) for sample_id in sample_ids]),
+                 aggregation_method, int(random_seed)]
+    key = hashlib.md5(json.dumps(key_items)).hexdigest()
+
+    return os.path.join(null_cache_dir, NULL_CACHE_FILE_NAME.format(key=key))
+
+
+def read_null_cache(null_cache_path):
+    """ Read cached null distributions, if the cache file exists.
+
+    Args:
+        null_cache_path (string)
+
+    Returns:
+        set_size_to_agg_sim_dict (dict): keys are set sizes, values are
+            arrays of aggregated similarities; empty if there is no cache
+
+    """
+    if not os.path.exists(null_cache_path):
+        logger.info("No null cache found at {}.".format(null_cache_path))
+        return {}
+
+    nulls_gct = cpp.parse(null_cache_path)
+    set_size_to_agg_sim_dict = {}
+    for set_size in nulls_gct.data_df.columns:
+        set_size_to_agg_sim_dict[int(set_size)] = nulls_gct.data_df[set_size].values
+
+    logger.info("Read null distributions for {} set sizes from {}.".format(
+        len(set_size_to_agg_sim_dict), null_cache_path))
+
+    return set_size_to_agg_sim_dict
+
+
+def write_null_cache(null_cache_path, set_size_to_agg_sim_dict):
+    """ Write null distributions to the cache. The file is written under a
+    temporary name and then moved into place so that an interrupted write
+    does not leave a corrupt cache behind.
+
+    Args:
+        null_cache_path (string)
+        set_size_to_agg_sim_dict (dict)
+
+    Returns:
+        None
+
+    """
+    null_cache_dir = os.path.dirname(null_cache_path)
+    if null_cache_dir and not os.path.isdir(null_cache_dir):
+        os.makedirs(null_cache_dir)
+
+    tmp_path = "{}.{}.tmp.gctx".format(os.path.splitext(null_cache_path)[0], os.getpid())
+    wgx.write(null_dict_to_gctoo(set_size_to_agg_sim_dict), tmp_path)
+    os.rename(tmp_path, null_cache_path)
+
+    logger.info("Wrote null distributions for {} set sizes to {}.".format(
+        len(set_size_to_agg_sim_dict), null_cache_path))
+
+
 def collate_results_dfs(sim_mat_result_record_list, subset_fields):
     """ Concatenate results dfs and annotate additional columns to specify
     how each result was subsetted.
@@ -0,0 +1,52 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import broadinstitute_psp.utils.setup_logger as setup_logger
+import broadinstitute_psp.tools.compile_gmt as compile_gmt
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+class TestCompileGmt(unittest.TestCase):
+
+    def test_compile_gmt(self):
+        this_gmt = [{"head": "set1", "desc": "", "entry": ["A", "B", "C"]},
+                    {"head": "set2", "desc": "", "entry": ["C", "D"]}]
+        compiled_gmt = compile_gmt.compile_gmt(this_gmt)
+
+        self.assertEqual(len(compiled_gmt), 2)
+        self.assertEqual(list(compiled_gmt.members), ["A", "B", "C", "D"])
+        np.testing.assert_array_equal(compiled_gmt.offsets, [0, 3, 5])
+        np.testing.assert_array_equal(compiled_gmt.member_codes, [0, 1, 2, 2, 3])
+
+    def test_write_and_read(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            gmt_path = os.path.join(tmp_dir, "sets.gmt")
+            with open(gmt_path, "w") as f:
+                f.write("set1\tdesc\tA\tB\tC\n")
+                f.write("set2\tdesc\tC\tD\n")
+            out_name = os.path.join(tmp_dir, "sets.npz")
+            compile_gmt.main(compile_gmt.build_parser().parse_args(
+                ["-i", gmt_path, "-o", out_name]))
+
+            compiled_gmt = compile_gmt.read(out_name)
+            e_compiled_gmt = compile_gmt.read_set_definitions(gmt_path)
+            self.assertEqual(list(compiled_gmt.set_names), ["set1", "set2"])
+            np.testing.assert_array_equal(compiled_gmt.members, e_compiled_gmt.members)
+            np.testing.assert_array_equal(compiled_gmt.offsets, e_compiled_gmt.offsets)
+            np.testing.assert_array_equal(compiled_gmt.member_codes, e_compiled_gmt.member_codes)
+
+            with self.assertRaises(AssertionError):
+                compile_gmt.write(compiled_gmt, os.path.join(tmp_dir, "sets.gmt"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+    unittest.main()
@@ -0,0 +1,440 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+import numpy as np
+import pandas as pd
+
+import cmapPy.pandasGEXpress.GCToo as GCToo
+import cmapPy.pandasGEXpress.write_gctx as wgx
+import broadinstitute_psp.utils.setup_logger as setup_logger
+import broadinstitute_psp.tools.compile_gmt as compile_gmt
+import broadinstitute_psp.tools.evaluate_sets as es
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+def make_sim_df(num_samples, seed=0):
+    rand_state = np.random.RandomState(seed)
+    vals = rand_state.uniform(-1, 1, size=(num_samples, num_samples))
+    vals = (vals + vals.T) / 2
+    np.fill_diagonal(vals, 1)
+    vals[2, 5] = np.nan
+    vals[5, 2] = np.nan
+    ids = ["s{}".format(ii) for ii in range(num_samples)]
+    return pd.DataFrame(vals, index=ids, columns=ids)
+
+
+class TestEvaluateSets(unittest.TestCase):
+
+    def test_draw_random_index_sets(self):
+        np.random.seed(1)
+
+        # Small sets are drawn with replacement and redrawn
+        small = es.draw_random_index_sets(100, 5, 1000)
+        self.assertEqual(small.shape, (1000, 5))
+        self.assertFalse(es.rows_with_duplicates(small).any())
+        self.assertTrue(((small >= 0) & (small < 100)).all())
+
+        # Large sets are drawn by partitioning random keys
+        large = es.draw_random_index_sets(20, 15, 500)
+        self.assertEqual(large.shape, (500, 15))
+        self.assertFalse(es.rows_with_duplicates(large).any())
+
+        # Whole population
+        whole = es.draw_random_index_sets(6, 6, 3)
+        self.assertItemsEqual(whole[0, :], range(6))
+
+        with self.assertRaises(AssertionError):
+            es.draw_random_index_sets(3, 4, 1)
+
+    def test_nanpercentile_of_rows(self):
+        vals = np.array([[1, 3, 2, np.nan],
+                         [4, 1, 2, 8],
+                         [np.nan, np.nan, np.nan, np.nan]])
+
+        out = es.nanpercentile_of_rows(vals, 75)
+        np.testing.assert_allclose(out[:2], np.nanpercentile(vals[:2, :], 75, axis=1))
+        self.assertTrue(np.isnan(out[2]))
+
+        out = es.nanpercentile_of_rows(vals, 50)
+        np.testing.assert_allclose(out[:2], [2, 3])
+
+    def test_get_agg_sims_of_index_sets(self):
+        sim_df = make_sim_df(12)
+        np.random.seed(2)
+        index_sets = es.draw_random_index_sets(12, 4, 50)
+
+        # Make sure the NaN pair is included
+        index_sets[0, :] = [2, 5, 7, 9]
+
+        for method in ["median", "q75", "median_of_medians"]:
+            e_agg_sims = [es.get_agg_sim(sim_df, list(sim_df.index[s]), method)
+                          for s in index_sets]
+            agg_sims = es.get_agg_sims_of_index_sets(
+                sim_df.values, index_sets, method)
+            np.testing.assert_allclose(agg_sims, e_agg_sims, err_msg=method)
+
+    def test_get_agg_sims_of_index_sets_batched(self):
+        sim_df = make_sim_df(10)
+        index_sets = es.draw_random_index_sets(10, 3, 25)
+        e_agg_sims = es.get_agg_sims_of_index_sets(sim_df.values, index_sets, "median")
+
+        orig_max_elements = es.NULL_BATCH_MAX_ELEMENTS
+        es.NULL_BATCH_MAX_ELEMENTS = 20
+        try:
+            agg_sims = es.get_agg_sims_of_index_sets(sim_df.values, index_sets, "median")
+        finally:
+            es.NULL_BATCH_MAX_ELEMENTS = orig_max_elements
+
+        np.testing.assert_allclose(agg_sims, e_agg_sims)
+
+    def test_evaluate_null_set_indices(self):
+        sim_df = make_sim_df(8)
+
+        # Columns in a different order than rows
+        shuffled_df = sim_df.iloc[:, ::-1]
+        null_sets = {2: np.array([[0, 1], [3, 7]]), 3: np.array([[1, 4, 6]])}
+
+        out = es.evaluate_null_set_indices(shuffled_df, null_sets, "median")
+
+        self.assertItemsEqual(out.keys(), [2, 3])
+        np.testing.assert_allclose(out[2], [sim_df.iloc[0, 1], sim_df.iloc[3, 7]])
+        np.testing.assert_allclose(out[3], [es.get_agg_sim(sim_df, ["s1", "s4", "s6"], "median")])
+
+    def test_evaluate_all_sets(self):
+        sim_df = make_sim_df(20)
+        real_sets = es.make_set_index_from_dict(
+            {"a": {"s0", "s1", "s3"}, "b": {"s4", "s8"}}, sim_df.index)
+        np.random.seed(3)
+        null_sets = es.make_null_set_indices(20, [2, 3], 100)
+
+        (results_df, nulls) = es.evaluate_all_sets(sim_df, real_sets, null_sets, "median")
+
+        self.assertEqual(list(results_df.index), ["a", "b"])
+        self.assertEqual(list(results_df[es.SET_SIZE_COLUMN_NAME]), [3, 2])
+        self.assertEqual(nulls[3].shape, (100,))
+        self.assertAlmostEqual(
+            results_df.loc["b", es.PVAL_COLUMN_NAME],
+            es.compute_pval(sim_df.loc["s4", "s8"], nulls[2]))
+
+    def test_make_sets_from_meta_df(self):
+        meta_df = pd.DataFrame({"pert_id": ["x", "y", "x", np.nan, "z", "x", "y"]},
+                               index=["s{}".format(ii) for ii in range(7)])
+        set_index = es.make_sets_from_meta_df(meta_df, "pert_id")
+
+        self.assertEqual(set_index.to_dict(), {"x": {"s0", "s2", "s5"}, "y": {"s1", "s6"}})
+        self.assertEqual(list(set_index.set_sizes()), [3, 2])
+
+        set_size_to_sets = set_index.index_sets_by_size()
+        self.assertEqual(list(set_size_to_sets[3][0]), ["x"])
+        np.testing.assert_array_equal(set_size_to_sets[3][1], [[0, 2, 5]])
+
+        small_sets = es.remove_big_sets(set_index, 2)
+        self.assertEqual(small_sets.to_dict(), {"y": {"s1", "s6"}})
+
+    def test_make_sets_from_gmt(self):
+        meta_df = pd.DataFrame({"pert_iname": ["A", "B", "A", "C", "D", "E"]},
+                               index=["s{}".format(ii) for ii in range(6)])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            gmt_path = os.path.join(tmp_dir, "sets.gmt")
+            with open(gmt_path, "w") as f:
+                f.write("set1\tdesc\tA\tC\tF\n")
+                f.write("set2\tdesc\tB\tD\tE\n")
+                f.write("set3\tdesc\tF\tC\n")
+            set_index = es.make_sets_from_gmt(gmt_path, meta_df, "pert_iname")
+
+            # Both samples with "A" belong to set1; set3 only has 1 sample
+            self.assertEqual(set_index.to_dict(), {
+                "set1": {"s0", "s2", "s3"}, "set2": {"s1", "s4", "s5"}})
+
+            compiled_path = os.path.join(tmp_dir, "sets.npz")
+            compile_gmt.main(compile_gmt.build_parser().parse_args(
+                ["-i", gmt_path, "-o", compiled_path]))
+            compiled_set_index = es.make_sets_from_gmt(compiled_path, meta_df, "pert_iname")
+            self.assertEqual(compiled_set_index.to_dict(), set_index.to_dict())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_make_null_set_indices_seeded(self):
+        out1 = es.make_null_set_indices(50, [2, 4], 10, random_seed=7)
+        out2 = es.make_null_set_indices(50, [4, 9], 10, random_seed=7)
+
+        # Nulls for a set size do not depend on the other set sizes
+        np.testing.assert_array_equal(out1[4], out2[4])
+        self.assertFalse(np.array_equal(
+            es.make_null_set_indices(50, [4], 10, random_seed=8)[4], out1[4]))
+
+        # The first nulls don't depend on null_size, so nulls can be extended
+        with mock.patch.object(es, "NULL_SEED_BLOCK_SIZE", 4):
+            all_nulls = es.make_null_set_indices(50, [4], 10, random_seed=7)[4]
+            np.testing.assert_array_equal(
+                es.make_null_set_indices(50, [4], 6, random_seed=7)[4], all_nulls[:6])
+            np.testing.assert_array_equal(
+                es.make_null_set_indices(50, [4], 10, random_seed=7, first_null=6)[4], all_nulls[6:])
+
+    def test_null_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            ds = os.path.join(cache_dir, "sims.txt")
+            with open(ds, "w") as f:
+                f.write("placeholder")
+
+            path = es.get_null_cache_path(cache_dir, ds, ["b", "a"], "median", 1)
+            self.assertEqual(path, es.get_null_cache_path(cache_dir, ds, ["a", "b"], "median", 1))
+            self.assertNotEqual(path, es.get_null_cache_path(cache_dir, ds, ["a", "b"], "q75", 1))
+            self.assertNotEqual(path, es.get_null_cache_path(cache_dir, ds, ["a", "b"], "median", 2))
+            self.assertNotEqual(path, es.get_null_cache_path(cache_dir, ds, ["a"], "median", 1))
+
+            self.assertEqual(es.read_null_cache(path), {})
+
+            nulls = {2: np.array([0.5, 0.25, -1, 0, 0.125]), 10: np.arange(5) / 8.}
+            es.write_null_cache(path, nulls)
+            out = es.read_null_cache(path)
+
+            self.assertItemsEqual(out.keys(), [2, 10])
+            np.testing.assert_array_equal(out[2], nulls[2])
+            np.testing.assert_array_equal(out[10], nulls[10])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_null_cache_reused_and_extended(self):
+        sim_df = make_sim_df(30)
+        meta_df = pd.DataFrame({"pert_id": ["p{}".format(ii % 7) for ii in range(30)]},
+                               index=sim_df.index)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ds = os.path.join(tmp_dir, "sims.gctx")
+            wgx.write(GCToo.GCToo(sim_df, row_metadata_df=meta_df,
+                                  col_metadata_df=meta_df), ds)
+
+            def evaluate(null_size, cache_dir):
+                with mock.patch.object(es, "evaluate_null_set_indices",
+                                       wraps=es.evaluate_null_set_indices) as evaluate_nulls:
+                    records = es.evaluate_sets_on_all_sim_mats(
+                        ds, None, None, None, ["pert_id"], [], "median", null_size,
+                        random_seed=4, null_cache_dir=os.path.join(tmp_dir, cache_dir))
+                null_sets = evaluate_nulls.call_args[0][1] if evaluate_nulls.called else {}
+                num_nulls_drawn = {size: len(sets) for (size, sets) in null_sets.items()}
+                return records[0].results_df, num_nulls_drawn
+
+            def read_cache(cache_dir):
+                (cache_path,) = [os.path.join(tmp_dir, cache_dir, name)
+                                 for name in os.listdir(os.path.join(tmp_dir, cache_dir))]
+                return es.read_null_cache(cache_path)
+
+            (first_results, first_drawn) = evaluate(40, "cache")
+            self.assertEqual(first_drawn, {4: 40, 5: 40})
+
+            # Same settings: nothing is drawn, and p-values are the same
+            (second_results, second_drawn) = evaluate(40, "cache")
+            self.assertEqual(second_drawn, {})
+            pd.util.testing.assert_frame_equal(second_results, first_results)
+
+            # Larger null_size: only the missing nulls are drawn, and they
+            # are added to the same cache file
+            first_cache = read_cache("cache")
+            (_, extended_drawn) = evaluate(70, "cache")
+            self.assertEqual(extended_drawn, {4: 30, 5: 30})
+
+            extended_cache = read_cache("cache")
+            for set_size in [4, 5]:
+                self.assertEqual(len(extended_cache[set_size]), 70)
+                np.testing.assert_array_equal(extended_cache[set_size][:40], first_cache[set_size])
+
+            # Same nulls as if the larger null_size had been used from the start
+            evaluate(70, "fresh_cache")
+            fresh_cache = read_cache("fresh_cache")
+            for set_size in [4, 5]:
+                np.testing.assert_array_equal(extended_cache[set_size], fresh_cache[set_size])
+
+            # Smaller null_size uses the start of the cache
+            (smaller_results, smaller_drawn) = evaluate(40, "cache")
+            self.assertEqual(smaller_drawn, {})
+            pd.util.testing.assert_frame_equal(smaller_results, first_results)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_evaluate_sets_on_all_sim_mats_n_jobs(self):
+        sim_df = make_sim_df(40)
+        meta_df = pd.DataFrame({
+            "pert_id": ["p{}".format(ii % 9) for ii in range(40)],
+            "cell_id": ["A375" if ii % 2 else "A549" for ii in range(40)]},
+            index=sim_df.index)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ds = os.path.join(tmp_dir, "sims.gctx")
+            wgx.write(GCToo.GCToo(sim_df, row_metadata_df=meta_df,
+                                  col_metadata_df=meta_df), ds)
+
+            results = []
+            for n_jobs in [1, 2]:
+                records = es.evaluate_sets_on_all_sim_mats(
+                    ds, None, None, None, ["pert_id"], ["cell_id"], "median",
+                    100, 100, False, 200, random_seed=4, n_jobs=n_jobs)
+                results.append(es.collate_results_dfs(records, ["cell_id"]))
+
+            self.assertEqual(len(records), 2)
+            self.assertItemsEqual(results[1]["cell_id"].unique(), ["A375", "A549"])
+            pd.util.testing.assert_frame_equal(results[0], results[1])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_sets_per_chunk_alias(self):
+        # Deprecated option is still accepted, and converted to sims_per_pass
+        args = es.build_parser().parse_args(["-i", "sims.gctx", "-spc", "3"])
+        self.assertEqual(args.sets_per_chunk, 3)
+        self.assertEqual(es.get_sims_per_pass_from_sets_per_chunk(3, 200, "median"), 3 * 19900)
+        self.assertEqual(es.get_sims_per_pass_from_sets_per_chunk(3, 200, "median_of_medians"), 3 * 40000)
+
+        sim_df = make_sim_df(30)
+        meta_df = pd.DataFrame({"pert_id": ["p{}".format(ii % 7) for ii in range(30)]},
+                               index=sim_df.index)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ds = os.path.join(tmp_dir, "sims.gctx")
+            wgx.write(GCToo.GCToo(sim_df, row_metadata_df=meta_df,
+                                  col_metadata_df=meta_df), ds)
+
+            old_records = es.evaluate_sets_on_all_sim_mats(
+                ds, None, None, None, ["pert_id"], [], "median", 50,
+                low_memory_mode=True, max_set_size=4, random_seed=4, sets_per_chunk=2)
+            new_records = es.evaluate_sets_on_all_sim_mats(
+                ds, None, None, None, ["pert_id"], [], "median", 50,
+                sims_per_pass=12, low_memory_mode=True, max_set_size=4, random_seed=4)
+            pd.util.testing.assert_frame_equal(old_records[0].results_df, new_records[0].results_df)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_evaluate_index_sets_from_gctx(self):
+        sim_df = make_sim_df(30)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ds = os.path.join(tmp_dir, "sims.gctx")
+            wgx.write(GCToo.GCToo(sim_df), ds)
+            sim_df = sim_df.astype(np.float32)
+
+            # Subsetted and shuffled sample ids
+            np.random.seed(5)
+            sample_ids = pd.Index(np.random.permutation(sim_df.index)[:20])
+            index_sets = {2: es.draw_random_index_sets(20, 2, 40),
+                          5: es.draw_random_index_sets(20, 5, 30)}
+            index_sets[2][0, :] = sample_ids.get_indexer(["s2", "s5"])
+
+            for method in ["median", "q75", "median_of_medians"]:
+                e_out = es.evaluate_null_set_indices(
+                    sim_df.loc[sample_ids, sample_ids], index_sets, method)
+
+                # Small passes and blocks
+                out = es.evaluate_index_sets_from_gctx(ds, sample_ids, index_sets, method, 50)
+                np.testing.assert_allclose(out[2], e_out[2], err_msg=method)
+                np.testing.assert_allclose(out[5], e_out[5], err_msg=method)
+
+            real_sets = es.make_set_index_from_dict(
+                {"a": {"s0", "s1", "s3"}, "b": {"s4", "s8"}, "c": {"s9", "s11"}},
+                sim_df.index)
+            null_dict = {2: np.arange(10) / 10., 3: np.arange(10) / 10.}
+            e_results_df = es.evaluate_real_sets(sim_df, real_sets, null_dict, "median")
+            results_df = es.evaluate_real_sets_from_gctx(
+                ds, real_sets, null_dict, "median", 4)
+            pd.util.testing.assert_frame_equal(results_df, e_results_df)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_update_reservoir(self):
+        rand_state = np.random.RandomState(6)
+
+        # Values are kept until the reservoir is full
+        reservoir = np.empty(5)
+        num_seen = es.update_reservoir(reservoir, 0, np.arange(3.), rand_state)
+        self.assertEqual(num_seen, 3)
+        np.testing.assert_array_equal(reservoir[:3], [0, 1, 2])
+
+        num_seen = es.update_reservoir(reservoir, num_seen, np.arange(3., 1000), rand_state)
+        self.assertEqual(num_seen, 1000)
+        self.assertEqual(len(np.unique(reservoir)), 5)
+
+        # Each value is equally likely to end up in the reservoir
+        counts = np.zeros(20)
+        for _ in range(2000):
+            reservoir = np.empty(4)
+            num_seen = es.update_reservoir(reservoir, 0, np.arange(6.), rand_state)
+            es.update_reservoir(reservoir, num_seen, np.arange(6., 20), rand_state)
+            counts[reservoir.astype(int)] += 1
+        np.testing.assert_allclose(counts / 2000., 0.2, atol=0.04)
+
+    def test_build_sim_reservoir(self):
+        sim_df = make_sim_df(12)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ds = os.path.join(tmp_dir, "sims.gctx")
+            wgx.write(GCToo.GCToo(sim_df.iloc[::-1, :]), ds)
+
+            sample_ids = sim_df.index[:9]
+            out = es.build_sim_reservoir(ds, sample_ids, 100, 20, np.random.RandomState(0))
+
+            # All non-NaN values of the upper triangle, and only those
+            sub_vals = sim_df.loc[sample_ids, sample_ids].values.astype(np.float32)
+            e_vals = sub_vals[np.triu_indices(9, k=1)]
+            e_vals = e_vals[~np.isnan(e_vals)]
+            np.testing.assert_array_equal(np.sort(out), np.sort(e_vals))
+
+            out = es.build_sim_reservoir(ds, sample_ids, 10, 20, np.random.RandomState(0))
+            self.assertEqual(len(out), 10)
+            self.assertTrue(np.in1d(out, e_vals).all())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_model_null_from_reservoir(self):
+        reservoir = np.array([0.1, 0.2, 0.3])
+
+        out = es.model_null_from_reservoir(reservoir, 2, 50, "median", np.random.RandomState(0))
+        self.assertEqual(out.shape, (50,))
+        self.assertTrue(np.in1d(out, reservoir).all())
+
+        out = es.model_null_from_reservoir(np.array([0.5]), 4, 5, "median_of_medians",
+                                           np.random.RandomState(0))
+        np.testing.assert_allclose(out, 0.5)
+
+    def test_compute_pval_bounds(self):
+        pvals = np.array([0, 0.05, np.nan, 1])
+        (lower, upper) = es.compute_pval_bounds(pvals, 100, 0.05)
+
+        self.assertTrue(np.isnan(lower[2]) and np.isnan(upper[2]))
+        self.assertEqual(lower[0], 0)
+        self.assertEqual(upper[3], 1)
+        self.assertTrue(lower[1] < 0.05 < upper[1])
+
+    def test_evaluate_sets_approximately(self):
+        sim_df = make_sim_df(40)
+        meta_df = pd.DataFrame({"pert_id": ["p{}".format(ii % 9) for ii in range(40)]},
+                               index=sim_df.index)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            ds = os.path.join(tmp_dir, "sims.gctx")
+            wgx.write(GCToo.GCToo(sim_df, row_metadata_df=meta_df,
+                                  col_metadata_df=meta_df), ds)
+
+            records = es.evaluate_sets_on_all_sim_mats(
+                ds, None, None, None, ["pert_id"], [], "median", 200, 100,
+                False, 200, random_seed=4, approximate=True, reservoir_size=100)
+            results_df = records[0].results_df
+
+            self.assertEqual(list(results_df.columns), [
+                es.AGG_SIM_COLUMN_NAME, es.SET_SIZE_COLUMN_NAME, es.PVAL_COLUMN_NAME,
+                es.PVAL_LOWER_COLUMN_NAME, es.PVAL_UPPER_COLUMN_NAME, es.QVAL_COLUMN_NAME])
+            self.assertTrue((results_df[es.PVAL_LOWER_COLUMN_NAME] <= results_df[es.PVAL_COLUMN_NAME]).all())
+            self.assertTrue((results_df[es.PVAL_UPPER_COLUMN_NAME] >= results_df[es.PVAL_COLUMN_NAME]).all())
+            self.assertItemsEqual(records[0].nulls_gct.data_df.columns, [4, 5])
+            self.assertEqual(records[0].nulls_gct.data_df.shape[0], 200)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+    unittest.main()
@@ -17,6 +17,7 @@ the "from_field" header in the mapping tsv file is not used.
 import logging
 import sys
 import argparse
+import numpy as np
 import pandas as pd
 
 import broadinstitute_psp.utils.setup_logger as setup_logger
@@ -72,15 +73,11 @@ def main(args):
         "ids in mapping file must be unique. duplicated ids in mapping:\n{}".format(
         mapping.index[duplicated_bool_array]))
 
-    for col in mapping.columns:
-
-        if args.row_and_or_col == "both":
-            annotate_meta_df(gct.row_metadata_df, mapping.loc[:, col], args.gct_from_field, args.missing_entry)
-            annotate_meta_df(gct.col_metadata_df, mapping.loc[:, col], args.gct_from_field, args.missing_entry)
-        elif args.row_and_or_col == "row":
-            annotate_meta_df(gct.row_metadata_df, mapping.loc[:, col], args.gct_from_field, args.missing_entry)
-        elif args.row_and_or_col == "col":
-            annotate_meta_df(gct.col_metadata_df, mapping.loc[:, col], args.gct_from_field, args.missing_entry)
+    # All mapping columns are added at once
+    if args.row_and_or_col in ["row", "both"]:
+        annotate_meta_df(gct.row_metadata_df, mapping, args.gct_from_field, args.missing_entry)
+    if args.row_and_or_col in ["col", "both"]:
+        annotate_meta_df(gct.col_metadata_df, mapping, args.gct_from_field, args.missing_entry)
 
     wg.write(gct, args.out_name, filler_null="NA", data_null="NaN", metadata_null="NA")
 
@@ -88,9 +85,13 @@ def main(args):
 def annotate_meta_df(meta_df, to_entries, gct_from_field, missing_entry):
     """ meta_df is modified in-place.
 
+    Entries are looked up with a single hash join against the index of
+    to_entries, rather than one at a time.
+
     Args:
         meta_df (pandas df)
-        to_entries (pandas series)
+        to_entries (pandas series or df): index must be unique; each
+            series (or column of the df) is added as a metadata field
         gct_from_field (string): name of field in gct that has the source entries
         missing_entry (string)
 
@@ -109,11 +110,28 @@ def annotate_meta_df(meta_df, to_entries, gct_from_field, missing_entry):
 
         entries_from_gct = meta_df.loc[:, gct_from_field]
 
-    # Create mapped_metadata as an array
-    mapped_metadata = [to_entries.loc[entry_in_gct] if entry_in_gct in to_entries.index else missing_entry for entry_in_gct in entries_from_gct]
+    if isinstance(to_entries, pd.Series):
+        to_entries = to_entries.to_frame()
+
+    # Position of each gct entry in the mapping; -1 if it isn't there
+    positions = to_entries.index.get_indexer(entries_from_gct)
+    is_missing = (positions == -1)
+
+    # All mapping columns are looked up at once
+    mapped_df = to_entries.take(positions[~is_missing])
+
+    for field in to_entries.columns:
+
+        # Keeps the dtype of the mapping column unless an entry is missing;
+        # then the column is object, so that ints don't become floats
+        if is_missing.any():
+            mapped_metadata = np.full(len(positions), missing_entry, dtype=object)
+            mapped_metadata[~is_missing] = mapped_df[field].values
+        else:
+            mapped_metadata = mapped_df[field].values
 
-    # Insert destination_metadata into row and col metadata
-    meta_df[to_entries.name] = mapped_metadata
+        # Insert mapped_metadata into row or col metadata
+        meta_df[field] = mapped_metadata
 
     return None
 
@@ -35,15 +35,6 @@ def build_parser():
     return parser
 
 
-def find_psp_production_config():
-    current_location = os.getcwd()
-    for root, dirs, files in os.walk(current_location):
-        if "psp_production.cfg" in files:
-            return os.path.join(root, "psp_production.cfg")
-
-DEFAULT_CONFIG_PATH = find_psp_production_config()
-
-
 def main(args):
     if args.config2json:
         if os.path.exists(args.input_path):
@@ -94,6 +85,23 @@ def convert_gct_to_config(assay_type, gct_path, output_path):
     """
     gct = parse.parse(gct_path)
 
+    return convert_parsed_gct_to_config(assay_type, gct, output_path)
+
+
+def convert_parsed_gct_to_config(assay_type, gct, output_path, search_dirs=()):
+    """
+    Same as convert_gct_to_config, but for a GCT that has already been parsed
+    (e.g. so that dry_handler parses the GCT only once)
+
+    Args -
+        assay_type (string) - assay used to specify parameters in config
+        gct (GCToo object) - GCT with custom parameters
+        output_path - where to write output config
+        search_dirs (list of strings) - where to look for the production config
+            first (see psp_utils.get_psp_production_config_path)
+    Returns -
+        differential_parameters (dictionary) - None if there are no custom parameters
+    """
     # All rows have same parameters embedded, choose any
     try :
         custom_params = gct.row_metadata_df.loc[:,"pr_processing_params"].any()
@@ -106,9 +114,10 @@ def convert_gct_to_config(assay_type, gct_path, output_path):
         return None
 
     custom_params = create_dict_from_pseudojson(custom_params)
-    differential_parameters = check_custom_parameters_against_defaults(assay_type, custom_params, json=True)
+    differential_parameters = check_custom_parameters_against_defaults(
+        assay_type, custom_params, json=True, search_dirs=search_dirs)
     if differential_parameters is not None:
-        write_config(differential_parameters, output_path)
+        write_config(differential_parameters, output_path, search_dirs)
 
     return differential_parameters
 
@@ -156,16 +165,16 @@ def create_dict_from_pseudojson(pseudoJSONString):
     return dict
 
 
-def populate_background_parameters(json_parameters_dict):
+def populate_background_parameters(json_parameters_dict, search_dirs=()):
 
-    (_, _, default_config_parameters) = psp_utils.read_config_file(DEFAULT_CONFIG_PATH)
+    (_, _, default_config_parameters) = psp_utils.read_psp_production_config_file(search_dirs)
     for param in default_config_parameters:
         if param not in json_parameters_dict:
             json_parameters_dict[param] = default_config_parameters[param]
     return json_parameters_dict
 
 
-def check_custom_parameters_against_defaults(assay_type, custom_config_parameters, json=False):
+def check_custom_parameters_against_defaults(assay_type, custom_config_parameters, json=False, search_dirs=()):
     """
     Converts and evaluates set of custom parameters against default config. If json, maps parameters and
     populates background (default) parameters for non-specified parameters.
@@ -176,6 +185,8 @@ def check_custom_parameters_against_defaults(assay_type, custom_config_parameter
         assay (string) - config specifies assay in arguments, thus must assay type must be prepended to name
         custom_config_parameters (dictionary) - custom parameters to check against default config
         json (boolean) - whether or not to populate background parameters
+        search_dirs (list of strings) - where to look for the production config
+            first (see psp_utils.get_psp_production_config_path)
 
     Returns -
         differential_parameters (dictionary) - parameter that differ from default, None if all custom parameters
@@ -185,9 +196,9 @@ def check_custom_parameters_against_defaults(assay_type, custom_config_parameter
 
     if json:
         custom_config_parameters = map_R_params(assay_type, custom_config_parameters)
-        custom_config_parameters = populate_background_parameters(custom_config_parameters)
+        custom_config_parameters = populate_background_parameters(custom_config_parameters, search_dirs)
 
-    (_, _, default_config_parameters) = psp_utils.read_config_file(DEFAULT_CONFIG_PATH)
+    (_, _, default_config_parameters) = psp_utils.read_psp_production_config_file(search_dirs)
 
     # Checks both keys and values for deep equality
     if custom_config_parameters == default_config_parameters:
@@ -258,9 +269,9 @@ def map_R_params(assay_type, parameters):
     return output_params
 
 
-def write_config(custom_config_parameters, output_path):
+def write_config(custom_config_parameters, output_path, search_dirs=()):
     config_parser = ConfigParser.RawConfigParser()
-    config_parser.read(os.path.expanduser(DEFAULT_CONFIG_PATH))
+    config_parser.read(os.path.expanduser(psp_utils.get_psp_production_config_path(search_dirs)))
 
     for param in custom_config_parameters:
         config_parser.set("parameters", param, custom_config_parameters[param])
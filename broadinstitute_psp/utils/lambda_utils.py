@@ -1,5 +1,18 @@
 import os
-import requests
+import broadinstitute_psp.utils.status_client as status_client
+
+# Shared by all updates; created on first use so that the API environment
+# variables are only needed then
+client = None
+
+
+def get_status_client():
+    """ Return the shared StatusClient, creating it if needed. """
+    global client
+    if client is None:
+        client = status_client.StatusClient(os.environ["API_URL"], os.environ["API_KEY"])
+    return client
+
 
 def post_update_to_proteomics_clue(url_suffix, id, payload):
     """ Posts update to CLUE API /psp
@@ -10,17 +23,11 @@ def post_update_to_proteomics_clue(url_suffix, id, payload):
         payload (JSON) update to put to API
 
     """
-    api_key = os.environ["API_KEY"]
-    base_api_url = os.environ["API_URL"]
-
-    api_url = base_api_url + "/" + id  + url_suffix
+    return get_status_client().post_update(url_suffix, id, payload)
 
-    headers = {'user_key': api_key}
 
-    r = requests.put(api_url,json=payload,headers=headers)
-    print r.text
-    if r.ok:
-        print "successfully updated API at: {}".format(api_url)
-    else:
-        print "failed to update API at: {} with response: {}".format(api_url, r.text)
-    return r
\ No newline at end of file
+def background_status_updates():
+    """ Context manager in which updates to CLUE API /psp are sent from a
+    background thread (see status_client.StatusClient.in_background).
+    """
+    return get_status_client().in_background()
@@ -1,12 +1,91 @@
+import ast
+import collections
+import copy
+import io
 import logging
 import ConfigParser
 import os
-import numpy as np
+import tempfile
 import pandas as pd
 
 import cmapPy.pandasGEXpress.parse as parse
+import cmapPy.pandasGEXpress.write_gct as wg
 
-def read_gct_and_config_file(gct_path, config_path):
+IN_MEMORY_GCT_SRC = "<in-memory gct>"
+
+# The production config is looked for in (in order): any directories given by
+# the caller, the path in this environment variable, the working directory, the directory containing the broadinstitute_psp package files,
+# and the home directory
+PSP_PRODUCTION_CONFIG_NAME = "psp_production.cfg"
+PSP_PRODUCTION_CONFIG_ENV_VAR = "PSP_PRODUCTION_CONFIG"
+PSP_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cache for where the production config was found; maps (directories, working
+# directory) to the path
+psp_production_config_paths = {}
+
+# Cache for parsed configs; maps absolute path to PspConfig
+configs = {}
+
+
+class ConfigSection(collections.Mapping):
+    """
+    Read-only dictionary of the fields in one section of a config file.
+    Use dict(section) to get a copy that can be changed.
+    """
+    def __init__(self, items):
+        self.fields = dict(items)
+
+    def __getitem__(self, field):
+        return self.fields[field]
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return "ConfigSection({})".format(self.fields)
+
+
+class PspConfig():
+    """
+    Parsed config file. Read configs with read_config, which only parses a
+    file again if it has changed; PspConfig objects are shared between
+    callers, so they must not be modified.
+
+    Instance Variables:
+        path (string): absolute path to the config file
+        file_stamp (tuple): (mtime, size) of the file when it was parsed
+        sections (dict): maps section name to ConfigSection
+        typed_values (dict): maps (section, field) to the evaluated value of
+            each field that has been read with get_typed
+    """
+    def __init__(self, path, file_stamp, sections):
+        self.path = path
+        self.file_stamp = file_stamp
+        self.sections = {name: ConfigSection(items) for (name, items) in sections.items()}
+        self.typed_values = {}
+
+    def section(self, name):
+        assert name in self.sections, (
+            "Config file has no {} section. path: {}".format(name, self.path))
+        return self.sections[name]
+
+    def get_typed(self, section, field):
+        """ Get the value of a field as a Python literal (e.g. a list)
+        rather than as a string. Each field is only evaluated the first time
+        it is asked for.
+        """
+        if (section, field) not in self.typed_values:
+            self.typed_values[(section, field)] = ast.literal_eval(self.section(section)[field])
+
+        # Copy so that callers can't change the shared value
+        return copy.deepcopy(self.typed_values[(section, field)])
+
+
+def read_gct_and_config_file(gct_path, config_path, gct=None):
     """Read gct and config file.
 
     The config file has three sections: io, metadata, and parameters.
@@ -15,6 +94,8 @@ def read_gct_and_config_file(gct_path, config_path):
     Args:
         gct_path (string): filepath to gct file
         config_path (string): filepath to config file
+        gct (GCToo object or None): if provided, used instead of parsing
+            gct_path (e.g. if it was already parsed from memory)
 
     Returns:
         gct (GCToo object)
@@ -25,28 +106,198 @@ def read_gct_and_config_file(gct_path, config_path):
     (config_io, config_metadata, config_parameters) = read_config_file(config_path)
 
     # Parse the gct file and return GCToo object
-    gct = parse.parse(gct_path)
+    if gct is None:
+        gct = parse.parse(gct_path)
 
     return gct, config_io, config_metadata, config_parameters
 
-def read_config_file(config_path):
-    assert os.path.exists(os.path.expanduser(config_path))
 
-    # Read config file
-    config_parser = ConfigParser.RawConfigParser()
-    config_parser.read(os.path.expanduser(config_path))
+def parse_gct_from_bytes(content, src=IN_MEMORY_GCT_SRC):
+    """Parse a gct that has already been read into memory (e.g. from s3) with
+    cmapPy's parse. parse only accepts a path, so content is written to a
+    temporary file that is removed afterwards.
+
+    Args:
+        content (string): contents of a GCT1.2 or GCT1.3 file
+        src (string): recorded as the src of the GCToo object
+
+    Returns:
+        gct (GCToo object)
+    """
+    (fd, temp_path) = tempfile.mkstemp(suffix=".gct")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        gct = parse.parse(temp_path)
+    finally:
+        os.remove(temp_path)
+
+    gct.src = src
+    return gct
+
+
+def write_gct_to_buffer(gct, data_null, filler_null):
+    """Write a gct to an in-memory buffer instead of to a file, e.g. for
+    uploading it to s3. Output is the same as that of write_gct.write with
+    data_float_format=None.
+
+    Args:
+        gct (GCToo object)
+        data_null (string): how to represent missing values in the data
+        filler_null (string): what value to fill the top-left filler block with
+
+    Returns:
+        buf (io.BytesIO): positioned at the start
+    """
+    buf = io.BytesIO()
+
+    dims = [str(gct.data_df.shape[0]), str(gct.data_df.shape[1]),
+            str(gct.row_metadata_df.shape[1]), str(gct.col_metadata_df.shape[1])]
+    wg.write_version_and_dims(wg.VERSION, dims, buf)
+    wg.write_top_half(buf, gct.row_metadata_df, gct.col_metadata_df,
+                      "-666", filler_null)
+    wg.write_bottom_half(buf, gct.row_metadata_df, gct.data_df,
+                         data_null, None, "-666")
+
+    buf.seek(0)
+    return buf
+
+def read_config_file(config_path):
+    config = read_config(config_path)
 
     # Return config fields as dictionarires
-    config_io = dict(config_parser.items("io"))
-    config_metadata = dict(config_parser.items("metadata"))
-    config_parameters = dict(config_parser.items("parameters"))
+    config_io = dict(config.section("io"))
+    config_metadata = dict(config.section("metadata"))
+    config_parameters = dict(config.section("parameters"))
 
     return config_io, config_metadata, config_parameters
 
+
+def read_config(config_path):
+    """Read a config file, parsing it only if it hasn't been parsed before or
+    if it has changed since (according to its mtime and size).
+
+    Args:
+        config_path (string)
+
+    Returns:
+        config (PspConfig): shared, so must not be modified
+    """
+    path = os.path.abspath(os.path.expanduser(config_path))
+    assert os.path.exists(path), (
+        "Config file cannot be found. config_path: {}".format(config_path))
+
+    file_stat = os.stat(path)
+    file_stamp = (file_stat.st_mtime, file_stat.st_size)
+
+    if path not in configs or configs[path].file_stamp != file_stamp:
+        config_parser = ConfigParser.RawConfigParser()
+        config_parser.read(path)
+
+        sections = {name: config_parser.items(name) for name in config_parser.sections()}
+        configs[path] = PspConfig(path, file_stamp, sections)
+
+    return configs[path]
+
+
+def get_psp_production_config_path(search_dirs=()):
+    """Find psp_production.cfg without walking the file system: only a fixed
+    list of locations is checked (see PSP_PRODUCTION_CONFIG_ENV_VAR), and the
+    result is cached.
+
+    Args:
+        search_dirs (list of strings): directories to check before the
+            environment variable and the default directories
+
+    Returns:
+        config_path (string)
+    """
+    search_dirs_path = find_psp_production_config(search_dirs)
+    if search_dirs_path is not None:
+        return search_dirs_path
+
+    env_path = os.environ.get(PSP_PRODUCTION_CONFIG_ENV_VAR)
+    if env_path:
+        assert os.path.isfile(os.path.expanduser(env_path)), (
+            "{} does not point to a file. {}: {}").format(
+            PSP_PRODUCTION_CONFIG_ENV_VAR, PSP_PRODUCTION_CONFIG_ENV_VAR, env_path)
+        return env_path
+
+    default_dirs = [os.getcwd(), PSP_PACKAGE_DIR, os.path.expanduser("~")]
+    default_path = find_psp_production_config(default_dirs)
+
+    assert default_path is not None, (
+        "{} cannot be found. Set {} or put it in one of these directories: {}").format(
+        PSP_PRODUCTION_CONFIG_NAME, PSP_PRODUCTION_CONFIG_ENV_VAR, list(search_dirs) + default_dirs)
+
+    return default_path
+
+
+def find_psp_production_config(dirs):
+    """Return the path of psp_production.cfg in the first of dirs that has
+    it, or None if none of them do. Only a found path is cached, so that a
+    config that is created later is still found.
+
+    Args:
+        dirs (list of strings)
+
+    Returns:
+        config_path (string or None)
+    """
+    # The working directory is part of the key because relative paths
+    # (including the working directory itself) depend on it
+    key = (tuple(dirs), os.getcwd())
+    if key not in psp_production_config_paths:
+        candidate_paths = [os.path.join(d, PSP_PRODUCTION_CONFIG_NAME) for d in dirs]
+        found_paths = [path for path in candidate_paths if os.path.isfile(path)]
+        if len(found_paths) == 0:
+            return None
+
+        psp_production_config_paths[key] = found_paths[0]
+
+    return psp_production_config_paths[key]
+
+
+def read_psp_production_config_file(search_dirs=()):
+    """Read psp_production.cfg, parsing it only the first time.
+
+    Args:
+        search_dirs (list of strings): see get_psp_production_config_path
+
+    Returns:
+        config_io (dictionary)
+        config_metadata (dictionary)
+        config_parameters (dictionary)
+    """
+    return read_config_file(get_psp_production_config_path(search_dirs))
+
+
+class ProvenanceCode(list):
+    """
+    Provenance code entries, in the order in which they were added. A list,
+    so stages can check for entries with `in` and add them with `+` or
+    append; adding entries keeps the delimiter, so the string that goes back
+    into the metadata is only built once, by to_string.
+
+    Instance Variables:
+        delimiter (string): what string to use as delimiter in to_string
+    """
+    def __init__(self, entries=(), delimiter="+"):
+        super(ProvenanceCode, self).__init__(entries)
+        self.delimiter = delimiter
+
+    def __add__(self, entries):
+        return ProvenanceCode(list(self) + list(entries), self.delimiter)
+
+    def to_string(self):
+        return self.delimiter.join(self)
+
+
 def extract_prov_code(col_meta_df, prov_code_field, prov_code_delim):
     """Extract the provenance code from the column metadata.
 
-    It must be non-empty and the same for all samples.
+    It must be non-empty and the same for all samples. Only the unique
+    provenance code strings are compared, so the code is split just once.
 
     Args:
         col_meta_df (pandas df): contains provenance code metadata
@@ -54,26 +305,17 @@ def extract_prov_code(col_meta_df, prov_code_field, prov_code_delim):
         prov_code_delim (string): string delimiter in prov code
 
     Returns:
-        prov_code (list of strings)
+        prov_code (ProvenanceCode): list of strings
     """
-    # Create pandas series of all provenance codes
-    prov_code_series = col_meta_df.loc[:, prov_code_field]
-
-    # Split each provenance code string along the delimiter
-    prov_code_list_series = prov_code_series.apply(lambda x: x.split(prov_code_delim))
+    unique_prov_codes = col_meta_df.loc[:, prov_code_field].unique()
 
-    # Verify that all provenance codes are the same
-    # (i.e. verify that all elements equal the first)
-    all_same = True
-    for prov_code_list in prov_code_list_series:
-        all_same = (all_same and prov_code_list == prov_code_list_series[0])
+    if len(unique_prov_codes) != 1:
+        err_msg = ("All columns should have the same provenance code, " +
+                   "but actually the unique provenance codes are {}")
+        raise(Exception(err_msg.format(unique_prov_codes)))
 
-    if all_same:
-        prov_code = prov_code_list_series.iloc[0]
-        assert prov_code != [""], "Provenance code is empty!"
-        return prov_code
+    prov_code_str = unique_prov_codes[0]
+    assert isinstance(prov_code_str, basestring) and prov_code_str != "", (
+        "Provenance code is empty!")
 
-    else:
-        err_msg = ("All columns should have the same provenance code, " +
-                   "but actually np.unique(prov_code_list_series.values) = {}")
-        raise(Exception(err_msg.format(np.unique(prov_code_list_series.values))))
\ No newline at end of file
+    return ProvenanceCode(prov_code_str.split(prov_code_delim), prov_code_delim)
\ No newline at end of file
@@ -5,12 +5,16 @@ be used easily with Plato.
 Divides each value by the maximum value of its row, and then computes the
 median, mean, MAD, and SD for each column.
 
-Input is a gct file. Output is a pw file.
+Input is one or more gct files (e.g. one per plate). Output is a single pw
+file with one row per well of every input gct, in the order of the inputs.
+Gcts are processed one at a time, or n_jobs at a time in parallel.
 """
 
 import logging
 import sys
 import argparse
+import multiprocessing
+import warnings
 import numpy as np
 import pandas as pd
 
@@ -37,25 +41,75 @@ def build_parser():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     # Required args
-    parser.add_argument("gct_file_path", type=str, help="filepath to gct file")
+    parser.add_argument("gct_file_paths", type=str, nargs="+",
+                        help="filepaths to gct files (e.g. one per plate)")
     parser.add_argument("out_pw_file_path", type=str,
                         help="filepath to output pw file")
-    
+
     # Optional args
     parser.add_argument("-plate_field", type=str, default="det_plate",
                         help="metadata field name specifying the plate")
     parser.add_argument("-well_field", type=str, default="det_well",
                         help="metadata field name specifying the well")
+    parser.add_argument("-n_jobs", "-nj", type=int, default=1,
+                        help="number of gcts to process at a time, each in its own process")
     return parser
 
 
 def main(args):
-    # Import gct
-    gct = parse.parse(args.gct_file_path)
+    pw_args = [(gct_file_path, args.plate_field, args.well_field)
+               for gct_file_path in args.gct_file_paths]
+
+    if args.n_jobs > 1:
+        pool = multiprocessing.Pool(args.n_jobs)
+        try:
+            pw_dfs = pool.map(make_pw_df_from_args, pw_args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        pw_dfs = [make_pw_df_from_args(one_pw_args) for one_pw_args in pw_args]
+
+    # Consolidate into one pw file
+    out_df = pd.concat(pw_dfs, ignore_index=True)
+
+    # Write to pw file
+    out_df.to_csv(args.out_pw_file_path, sep="\t", na_rep="NaN", index=False)
+    logger.info("PW file with {} wells from {} gcts written to {}".format(
+        out_df.shape[0], len(pw_dfs), args.out_pw_file_path))
+
+
+def make_pw_df_from_args(pw_args):
+    """ Parse a gct and make its pw df. Takes a tuple so that it can be used
+    with multiprocessing.Pool.map.
+
+    Args:
+        pw_args (tuple): (gct_file_path, plate_field, well_field)
 
+    Returns:
+        out_df (pandas df)
+
+    """
+    (gct_file_path, plate_field, well_field) = pw_args
+    gct = parse.parse(gct_file_path)
+    return make_pw_df(gct, plate_field, well_field)
+
+
+def make_pw_df(gct, plate_field, well_field):
+    """ Compute QC metrics for each sample of gct.
+
+    Args:
+        gct (GCToo object)
+        plate_field (string): metadata field name specifying the plate
+        well_field (string): metadata field name specifying the well
+
+    Returns:
+        out_df (pandas df): one row per sample
+
+    """
     # Get plate and well names
     (plate_names, well_names) = extract_plate_and_well_names(
-        gct.col_metadata_df, args.plate_field, args.well_field)
+        gct.col_metadata_df, plate_field, well_field)
 
     # Extract provenance code
     prov_code = utils.extract_prov_code(
@@ -64,25 +118,59 @@ def main(args):
     # If data has been log-transformed, undo it
     unlogged_df = undo_log_transform_if_needed(gct.data_df, prov_code)
 
-    # Divide by the maximum value for the row
-    max_row_values = unlogged_df.max(axis='columns')
-    divided_df = unlogged_df.div(max_row_values, axis="rows")
+    # Divide by the maximum value for the row (fmax skips NaNs)
+    divided_values = unlogged_df.values.astype(float)
+    max_row_values = np.fmax.reduce(divided_values, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        divided_values /= max_row_values[:, np.newaxis]
 
     # Calculate metrics for each sample
-    medium_over_heavy_medians = divided_df.median(axis=0).values
-    medium_over_heavy_means = divided_df.mean(axis=0).values
-    medium_over_heavy_mads = divided_df.mad(axis=0).values
-    medium_over_heavy_sds = divided_df.std(axis=0).values
+    column_stats = compute_column_stats(divided_values)
 
     # Assemble plate_names, well_names, and metrics into a dataframe
     out_df = assemble_output_df(
         plate_names, well_names,
-        {"medium_over_heavy_median": medium_over_heavy_medians,
-        "medium_over_heavy_mad": medium_over_heavy_mads})
+        {"medium_over_heavy_median": column_stats["median"],
+        "medium_over_heavy_mad": column_stats["mad"]})
 
-    # Write to pw file
-    out_df.to_csv(args.out_pw_file_path, sep="\t", na_rep="NaN", index=False)
-    logger.info("PW file written to {}".format(args.out_pw_file_path))
+    return out_df
+
+
+def compute_column_stats(values):
+    """ Compute the median, mean, MAD (mean absolute deviation from the mean),
+    and SD (with 1 degree of freedom) of each column, ignoring NaNs, from one
+    pass over values for the mean and one over the deviations from it.
+
+    Columns without any values get NaN for every statistic, as do columns
+    with a single value for the SD.
+
+    Args:
+        values (numpy array of floats)
+
+    Returns:
+        column_stats (dict): keys are "median", "mean", "mad", and "sd";
+            values are numpy arrays with one entry per column
+
+    """
+    is_measured = ~np.isnan(values)
+    counts = is_measured.sum(axis=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(is_measured, values, 0).sum(axis=0) / counts
+
+        # Deviations are 0 where values is NaN, so they don't add to the sums
+        deviations = np.where(is_measured, values - means, 0)
+        mads = np.abs(deviations).sum(axis=0) / counts
+        sds = np.sqrt((deviations ** 2).sum(axis=0) / (counts - 1))
+
+    sds[counts < 2] = np.nan
+
+    # nanmedian warns about columns without any values
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        medians = np.nanmedian(values, axis=0)
+
+    return {"median": medians, "mean": means, "mad": mads, "sd": sds}
 
 def extract_plate_and_well_names(col_meta, plate_field=PLATE_FIELD, well_field=WELL_FIELD):
     """
@@ -2,22 +2,37 @@
 Replace NaNs in the data df of a GCT with either...
 
 0) zero,
-1) the probe median, or
-2) the probe mean.
+1) the probe median,
+2) the probe mean,
+3) the probe median within each normalization subset (the subsets that tear
+   uses for subset normalization), or
+4) the mean of the probe in the k nearest samples (k-nearest-neighbor
+   imputation; samples are compared using the probes measured in both).
+
+Probes that are NaN in every sample are removed first.
 """
 
 import logging
 import argparse
 import os
 import sys
+import numpy as np
+import pandas as pd
 
 import broadinstitute_psp.utils.setup_logger as setup_logger
+import broadinstitute_psp.tear.tear as tear
 import cmapPy.pandasGEXpress.subset_gctoo as sg
 import cmapPy.pandasGEXpress.parse as parse
 import cmapPy.pandasGEXpress.write_gct as wg
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
+REPLACE_WITH_CHOICES = ["zero", "median", "mean", "subset_median", "knn"]
+
+# Same as in psp_production.cfg
+DEFAULT_ROW_SUBSET_FIELD = "pr_probe_normalization_group"
+DEFAULT_COL_SUBSET_FIELD = "det_normalization_group_vector"
+
 
 def build_parser():
     parser = argparse.ArgumentParser(description=__doc__,
@@ -28,9 +43,18 @@ def build_parser():
                         help="path to input gct")
     parser.add_argument("out_name", type=str,
                         help="what to name the output gct")
-    parser.add_argument("-replace_with", "-rw", choices=["zero", "median", "mean"],
+    parser.add_argument("-replace_with", "-rw", choices=REPLACE_WITH_CHOICES,
                         help="what to replace NaN with", default="mean")
-    
+    parser.add_argument("-row_subset_field", type=str, default=DEFAULT_ROW_SUBSET_FIELD,
+                        help="for subset_median, row metadata field indicating the row subset group")
+    parser.add_argument("-col_subset_field", type=str, default=DEFAULT_COL_SUBSET_FIELD,
+                        help="for subset_median, col metadata field indicating the col subset group")
+    parser.add_argument("-num_neighbors", "-k", type=int, default=5,
+                        help="for knn, number of neighboring samples to average")
+    parser.add_argument("-block_size", type=int, default=1000,
+                        help=("for knn, number of samples for which to compute " +
+                              "distances at a time; bounds memory use"))
+
     return parser
 
 
@@ -49,24 +73,183 @@ def main(args):
     if args.replace_with == "zero":
         in_gct.data_df.fillna(0, inplace=True)
 
-    elif args.replace_with == "median":
-        probe_medians = in_gct.data_df.median(axis=1)
-
-        for row_idx, row in enumerate(in_gct.data_df.values):
-            this_row = in_gct.data_df.iloc[row_idx, :]
-            this_row[this_row.isnull()] = probe_medians[row_idx]
-            in_gct.data_df.iloc[row_idx, :] = this_row
+    elif args.replace_with in ["median", "mean"]:
+        in_gct.data_df = impute_with_row_statistic(in_gct.data_df, args.replace_with)
 
-    elif args.replace_with == "mean":
-        probe_means = in_gct.data_df.mean(axis=1)
+    elif args.replace_with == "subset_median":
+        in_gct.data_df = impute_with_subset_median(
+            in_gct.data_df, in_gct.row_metadata_df, in_gct.col_metadata_df,
+            args.row_subset_field, args.col_subset_field)
 
-        for row_idx, row in enumerate(in_gct.data_df.values):
-            this_row = in_gct.data_df.iloc[row_idx, :]
-            this_row[this_row.isnull()] = probe_means[row_idx]
-            in_gct.data_df.iloc[row_idx, :] = this_row
+    elif args.replace_with == "knn":
+        in_gct.data_df = impute_with_knn(in_gct.data_df, args.num_neighbors, args.block_size)
 
     wg.write(in_gct, args.out_name, filler_null="NA")
 
+
+def impute_with_row_statistic(data_df, statistic):
+    """ Replace NaNs with the median or mean of their row.
+
+    Args:
+        data_df (pandas df): no row may be entirely NaN
+        statistic (string): "median" or "mean"
+
+    Returns:
+        out_df (pandas df)
+
+    """
+    assert statistic in ["median", "mean"], (
+        "statistic must be median or mean. statistic: {}".format(statistic))
+
+    values = data_df.values.astype(float)
+    if statistic == "median":
+        row_stats = np.nanmedian(values, axis=1)
+    else:
+        row_stats = np.nanmean(values, axis=1)
+
+    out_values = np.where(np.isnan(values), row_stats[:, np.newaxis], values)
+
+    return pd.DataFrame(out_values, index=data_df.index, columns=data_df.columns)
+
+
+def impute_with_subset_median(data_df, row_metadata_df, col_metadata_df,
+                              row_subset_field, col_subset_field):
+    """ Replace NaNs with the median of their row, computed only over the
+    samples in the same normalization subset. Subsets are defined the same
+    way as in tear's subset normalization (see tear.make_norm_ndarray).
+    If a probe is NaN for its whole subset, its overall median is used.
+
+    Args:
+        data_df (pandas df): no row may be entirely NaN
+        row_metadata_df (pandas df)
+        col_metadata_df (pandas df)
+        row_subset_field (string): row metadata field indicating the row subset group
+        col_subset_field (string): col metadata field indicating the col subset group
+
+    Returns:
+        out_df (pandas df)
+
+    """
+    norm_ndarray = tear.make_norm_ndarray(
+        row_metadata_df.loc[data_df.index, :], col_metadata_df.loc[data_df.columns, :],
+        row_subset_field, col_subset_field)
+
+    values = data_df.values.astype(float)
+    is_nan = np.isnan(values)
+
+    # Start from the overall row medians, then overwrite with subset medians
+    fill_values = np.broadcast_to(np.nanmedian(values, axis=1)[:, np.newaxis], values.shape).copy()
+
+    # Loop over subsets (there are only a few), not over rows
+    for subset in np.unique(norm_ndarray):
+        in_subset = (norm_ndarray == subset)
+        subset_values = np.where(in_subset, values, np.nan)
+
+        # Rows with no measurements in this subset keep the overall median
+        has_values = (in_subset & ~is_nan).any(axis=1)
+        subset_medians = np.full(values.shape[0], np.nan)
+        subset_medians[has_values] = np.nanmedian(subset_values[has_values, :], axis=1)
+
+        use_subset_median = in_subset & has_values[:, np.newaxis]
+        fill_values = np.where(use_subset_median, subset_medians[:, np.newaxis], fill_values)
+
+    out_values = np.where(is_nan, fill_values, values)
+
+    return pd.DataFrame(out_values, index=data_df.index, columns=data_df.columns)
+
+
+def impute_with_knn(data_df, num_neighbors, block_size):
+    """ Replace NaNs with the mean of the probe in the num_neighbors most
+    similar samples in which the probe was measured.
+
+    Similarity between samples is the euclidean distance over the probes
+    measured in both, scaled by the number of such probes. Distances are
+    computed for block_size samples at a time with matrix products, so memory
+    use is O(block_size x # of samples). If no other sample measured a
+    probe, the probe median is used.
+
+    Args:
+        data_df (pandas df): no row may be entirely NaN
+        num_neighbors (int)
+        block_size (int)
+
+    Returns:
+        out_df (pandas df)
+
+    """
+    assert num_neighbors > 0, "num_neighbors must be positive. num_neighbors: {}".format(num_neighbors)
+    assert block_size > 0, "block_size must be positive. block_size: {}".format(block_size)
+
+    # Samples are rows from here on
+    values = data_df.values.T.astype(float)
+    is_measured = ~np.isnan(values)
+    zeroed_values = np.where(is_measured, values, 0)
+
+    out_values = values.copy()
+    probe_medians = np.nanmedian(values, axis=0)
+    samples_with_nans = np.where(~is_measured.all(axis=1))[0]
+
+    for block_start in range(0, len(samples_with_nans), block_size):
+        block = samples_with_nans[block_start:block_start + block_size]
+        dists = compute_nan_euclidean_distances(
+            zeroed_values[block, :], is_measured[block, :], zeroed_values, is_measured)
+
+        # A sample is not its own neighbor
+        dists[np.arange(len(block)), block] = np.inf
+
+        for (block_idx, sample_idx) in enumerate(block):
+            missing_probes = np.where(~is_measured[sample_idx, :])[0]
+            neighbor_order = np.argsort(dists[block_idx, :], kind="mergesort")
+            neighbor_order = neighbor_order[np.isfinite(dists[block_idx, neighbor_order])]
+
+            # For each missing probe, take the closest samples that measured it
+            neighbor_is_measured = is_measured[neighbor_order][:, missing_probes]
+            use_neighbor = neighbor_is_measured & (
+                np.cumsum(neighbor_is_measured, axis=0) <= num_neighbors)
+            num_used = use_neighbor.sum(axis=0)
+            neighbor_sums = (zeroed_values[neighbor_order][:, missing_probes] * use_neighbor).sum(axis=0)
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                neighbor_means = neighbor_sums / num_used
+            out_values[sample_idx, missing_probes] = np.where(
+                num_used > 0, neighbor_means, probe_medians[missing_probes])
+
+    return pd.DataFrame(out_values.T, index=data_df.index, columns=data_df.columns)
+
+
+def compute_nan_euclidean_distances(block_values, block_is_measured, values, is_measured):
+    """ Compute the distance between each row of block_values and each row of
+    values, using only the columns measured in both: the root of the mean
+    squared difference over those columns. Pairs with no columns in common
+    are infinitely far apart.
+
+    Args:
+        block_values (numpy array): NaNs replaced by 0
+        block_is_measured (numpy array of bools): False where block_values was NaN
+        values (numpy array): NaNs replaced by 0
+        is_measured (numpy array of bools): False where values was NaN
+
+    Returns:
+        dists (numpy array): size = (# of rows in block_values, # of rows in values)
+
+    """
+    block_is_measured = block_is_measured.astype(float)
+    is_measured = is_measured.astype(float)
+
+    # sum over shared columns of (x - y)^2 = x^2 + y^2 - 2xy, with each term
+    # restricted to the columns measured in both
+    sq_diff_sums = (np.dot(block_values ** 2, is_measured.T) +
+                    np.dot(block_is_measured, (values ** 2).T) -
+                    2 * np.dot(block_values, values.T))
+    num_shared = np.dot(block_is_measured, is_measured.T)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        dists = np.sqrt(np.maximum(sq_diff_sums, 0) / num_shared)
+    dists[num_shared == 0] = np.inf
+
+    return dists
+
+
 if __name__ == "__main__":
     args = build_parser().parse_args(sys.argv[1:])
     setup_logger.setup(verbose=args.verbose)
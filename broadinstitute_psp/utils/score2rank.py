@@ -4,17 +4,23 @@ For each file within in_dir that matches file_wildcard, the score file will
 be converted to a rank file. If the input name is INPUT_SEPARATOR_SCORE.gct,
 the output name for that file will be INPUT_RANK.gct.
 
+Files are converted one at a time, or n_jobs at a time in parallel, so that
+only the files being converted are in memory.
+
 """
 
 import sys
 import argparse
 import glob
+import multiprocessing
 import os
 import numpy as np
+import pandas as pd
 
 import cmapPy.pandasGEXpress.GCToo as GCToo
 import cmapPy.pandasGEXpress.parse as parse
 import cmapPy.pandasGEXpress.write_gct as wg
+import cmapPy.pandasGEXpress.write_gctx as wgx
 
 
 def build_parser():
@@ -40,7 +46,12 @@ def build_parser():
                               "and use as prefix for output filename"))
     parser.add_argument("--output_suffix", "-s", default="_RANK.gct",
                         help=("separator for spltting the file name in order " +
-                              "to create a sensible output file name"))
+                              "to create a sensible output file name; " +
+                              "end in .gctx to write GCTX"))
+    parser.add_argument("--n_jobs", "-nj", type=int, default=1,
+                        help="number of files to convert at a time, each in its own process")
+    parser.add_argument("--block_size", "-bs", type=int, default=1000,
+                        help="number of columns to rank at a time; bounds extra memory")
 
     return parser
 
@@ -51,7 +62,7 @@ def main(args):
     full_path_wildcard = args.in_dir + args.file_wildcard
     gct_paths = glob.glob(full_path_wildcard)
 
-    assert len(gct_paths) > 1, "full_path_wildcard: {}".format(full_path_wildcard)
+    assert len(gct_paths) > 0, "full_path_wildcard: {}".format(full_path_wildcard)
 
     # Extract prefixes in order to use them later for saving
     prefixes = [(os.path.basename(path)).split(args.prefix_separator)[0] for path in gct_paths]
@@ -60,39 +71,140 @@ def main(args):
         print "path: {}".format(path)
         print "prefix: {}".format(prefix)
 
-    # Import gcts
-    gctoos = [parse(x) for x in gct_paths]
+    # Each gct is read, ranked, and written before the next one is read (per
+    # process), so only n_jobs gcts are in memory at a time
+    convert_args_list = [(path, args.out_dir + prefix + args.output_suffix,
+                          args.do_percentile_rank, args.block_size)
+                         for (path, prefix) in zip(gct_paths, prefixes)]
+
+    if args.n_jobs > 1:
+        pool = multiprocessing.Pool(min(args.n_jobs, len(convert_args_list)))
+        try:
+            pool.map(convert_score_file_to_rank_file_from_args, convert_args_list, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for convert_args in convert_args_list:
+            convert_score_file_to_rank_file_from_args(convert_args)
+
+
+def convert_score_file_to_rank_file_from_args(convert_args):
+    """ Takes a tuple so that it can be used with multiprocessing.Pool.map.
+
+    Args:
+        convert_args (tuple): in_path, out_name, do_percentile_rank, block_size
+
+    Returns:
+        out_name (string)
+
+    """
+    (in_path, out_name, do_percentile_rank, block_size) = convert_args
 
-    assert len(gctoos) > 1, "gct_paths: {}".format(gct_paths)
+    return convert_score_file_to_rank_file(in_path, out_name, do_percentile_rank, block_size)
 
-    # Compute & save ranks
-    for g, prefix in zip(gctoos, prefixes):
 
-        # Extract data_df
-        score_df = g.data_df
+def convert_score_file_to_rank_file(in_path, out_name, do_percentile_rank, block_size):
+    """ Read a square score matrix, rank each column in descending order
+    (ignoring the diagonal), and save the result as a GCT or GCTX depending on
+    the extension of out_name.
 
-        # Must be square
-        assert score_df.shape[0] == score_df.shape[1], "Input dataframe must be square."
+    Args:
+        in_path (string): path to GCT or GCTX
+        out_name (string): must end in .gct or .gctx
+        do_percentile_rank (bool)
+        block_size (int): see rank_columns_in_place
 
-        # Set diagonal to NaN
-        np.fill_diagonal(score_df.values, np.nan)
+    Returns:
+        out_name (string)
 
-        # Rank the matrix (percentile score or not)
-        if args.do_percentile_rank:
-            rank_df = score_df.rank(ascending=False, pct=True) * 100
-        else:
-            rank_df = score_df.rank(ascending=False)
+    """
+    g = parse.parse(in_path)
 
-        # Make a GCToo
-        rank_gctoo = GCToo.GCToo(
-            data_df=rank_df,
-            row_metadata_df=g.row_metadata_df,
-            col_metadata_df=g.col_metadata_df)
+    # Extract data_df
+    score_df = g.data_df
 
-        # Save the rank_df to file
-        out_name = args.out_dir + prefix + args.output_suffix
+    # Must be square
+    assert score_df.shape[0] == score_df.shape[1], "Input dataframe must be square."
+
+    # Rank in place, with the diagonal set to NaN (astype only copies if not
+    # already float, so score_df may be changed too)
+    score_values = score_df.values.astype(float, copy=False)
+    np.fill_diagonal(score_values, np.nan)
+    rank_columns_in_place(score_values, do_percentile_rank, block_size)
+
+    # Make a GCToo
+    rank_df = pd.DataFrame(score_values, index=score_df.index, columns=score_df.columns)
+    rank_gctoo = GCToo.GCToo(
+        data_df=rank_df,
+        row_metadata_df=g.row_metadata_df,
+        col_metadata_df=g.col_metadata_df)
+
+    # Save the rank_df to file
+    if out_name.lower().endswith(".gctx"):
+        wgx.write(rank_gctoo, out_name)
+    else:
         wg.write(rank_gctoo, out_name, filler_null="NaN", data_null="NaN", metadata_null="NaN")
 
+    return out_name
+
+
+def rank_columns_in_place(values, do_percentile_rank, block_size):
+    """ Replace each column of values by its descending ranks, the same as
+    DataFrame.rank(ascending=False) (or with pct=True, times 100): ties get
+    their average rank and NaNs stay NaN.
+
+    Ranks come from a stable argsort; block_size columns are ranked at a
+    time, so extra memory is O(# of rows x block_size).
+
+    Args:
+        values (numpy array of floats): modified in place
+        do_percentile_rank (bool)
+        block_size (int)
+
+    Returns:
+        values (numpy array of floats)
+
+    """
+    assert block_size > 0, "block_size must be positive. block_size: {}".format(block_size)
+
+    num_rows = values.shape[0]
+    positions = np.arange(num_rows)[:, np.newaxis]
+
+    for block_start in range(0, values.shape[1], block_size):
+        block = values[:, block_start:block_start + block_size]
+        is_nan = np.isnan(block)
+
+        # Descending, with NaNs last
+        order = np.argsort(-block, axis=0, kind="mergesort")
+        columns = np.arange(block.shape[1])
+        sorted_block = block[order, columns]
+
+        # Ties are runs of equal values in sorted_block; each tie gets the
+        # average of the first and last positions of its run. NaN != NaN, so
+        # each NaN is its own run
+        is_run_start = np.ones(sorted_block.shape, dtype=bool)
+        is_run_start[1:] = sorted_block[1:] != sorted_block[:-1]
+        is_run_end = np.ones(sorted_block.shape, dtype=bool)
+        is_run_end[:-1] = is_run_start[1:]
+
+        run_starts = np.maximum.accumulate(np.where(is_run_start, positions, 0), axis=0)
+        run_ends = np.minimum.accumulate(
+            np.where(is_run_end, positions, num_rows - 1)[::-1], axis=0)[::-1]
+        sorted_ranks = (run_starts + run_ends) / 2.0 + 1
+
+        # Put ranks back in the original order
+        block[order, columns] = sorted_ranks
+        block[is_nan] = np.nan
+
+        # Columns that are all NaN stay NaN
+        if do_percentile_rank:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                block *= 100.0 / (~is_nan).sum(axis=0)
+
+    return values
+
+
 if __name__ == "__main__":
     args = build_parser().parse_args(sys.argv[1:])
     main(args)
\ No newline at end of file
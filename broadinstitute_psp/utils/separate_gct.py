@@ -8,9 +8,12 @@ import logging
 import sys
 import os
 import argparse
+import multiprocessing
+import numpy as np
+import pandas as pd
 
 import broadinstitute_psp.utils.setup_logger as setup_logger
-import cmapPy.pandasGEXpress.subset_gctoo as sg
+import cmapPy.pandasGEXpress.GCToo as GCToo
 import cmapPy.pandasGEXpress.parse as parse
 import cmapPy.pandasGEXpress.write_gct as wg
 import cmapPy.pandasGEXpress.write_gctx as wgx
@@ -39,6 +42,8 @@ def build_parser():
     parser.add_argument("--out_dir", "-od", default=".", help="directory in which to save output gcts")
     parser.add_argument("--out_name_prefix", "-op", default="", help="prefix for output file names")
     parser.add_argument("--out_name_suffix", "-os", default=".gct", help="suffix for output file names")
+    parser.add_argument("--n_jobs", "-nj", type=int, default=1,
+                        help="number of processes with which to write output gcts")
     parser.add_argument("--verbose", "-v", action="store_true", default=False,
                         help="whether to increase the # of messages reported")
 
@@ -51,74 +56,181 @@ def main(args):
     # Import gct
     in_gct = parse.parse(args.in_gct_path)
 
-    # Create the separated gcts
-    (out_gcts, out_gct_prefixes) = separate(in_gct, args.separate_field, args.row_or_col)
+    # Create the separated gcts and save them
+    write_separated_gcts(in_gct, args.separate_field, args.row_or_col, args.out_dir,
+                         args.out_name_prefix, args.out_name_suffix, args.n_jobs)
 
-    # Save the returned gcts
-    for gct, name in zip(out_gcts, out_gct_prefixes):
-        full_out_name = os.path.join(args.out_dir, args.out_name_prefix + str(name) + args.out_name_suffix)
 
-        # Write to GCT or GCTX depending on extension
-        if str.lower(os.path.splitext(full_out_name)[1]) == ".gct":
-            wg.write(gct, full_out_name, data_null="NaN", metadata_null="NA", filler_null="NA")
-        elif str.lower(os.path.splitext(full_out_name)[1]) == ".gctx":
-            wgx.write(gct, full_out_name)
-	else:
-	    raise(Exception("out_name_suffix must end in either .gct or .gctx. out_name_suffix: {}".format(
-	         (args.out_name_suffix))))
-
-
-def separate(in_gct, separate_field, row_or_col):
+def separate(in_gct, separate_field, row_or_col, drop_nan=False):
     """ Create a new GCT object for each unique value in separate_field.
 
     Args:
         in_gct (GCToo object)
         separate_field (string)
         row_or_col (string)
+        drop_nan (bool): see iter_separate
 
     Returns:
         gcts (list of GCToo objects)
         unique_values_in_field (list of strings)
 
     """
-    if row_or_col == "row":
-        assert separate_field in in_gct.row_metadata_df.columns, (
-            ("separate_field must be in in_gct.row_metadata_df.columns. " +
-             "separate_field: {}, in_gct.row_metadata_df.columns: {}").format(
-                separate_field, in_gct.row_metadata_df.columns.values))
+    gcts = []
+    unique_values_in_field = []
+    for (val, gct) in iter_separate(in_gct, separate_field, row_or_col, drop_nan):
+        unique_values_in_field.append(val)
+        gcts.append(gct)
+
+    # Make sure each gct is associated with a value from separate_field
+    assert len(gcts) == len(unique_values_in_field), (
+        "len(gcts): {}, len(unique_values_in_field): {}".format(
+            len(gcts), len(unique_values_in_field)))
 
-        unique_values_in_field = list(in_gct.row_metadata_df.loc[:, separate_field].unique())
+    return gcts, unique_values_in_field
 
-        gcts = []
-        for val in unique_values_in_field:
-            bool_array = in_gct.row_metadata_df.loc[:, separate_field].values == val
 
-            new_gct = sg.subset_gctoo(in_gct, row_bool=bool_array)
-            gcts.append(new_gct)
+def iter_separate(in_gct, separate_field, row_or_col, drop_nan=False):
+    """ Yield a new GCT object for each unique value in separate_field, in
+    order of first appearance.
 
-    elif row_or_col == "col":
-        assert separate_field in in_gct.col_metadata_df.columns, (
-            ("separate_field must be in in_gct.col_metadata_df.columns. " +
-             "separate_field: {}, in_gct.col_metadata_df.columns: {}").format(
-                separate_field, in_gct.col_metadata_df.columns.values))
+    The rows (or columns) are grouped in a single pass, and each GCT is made
+    with one take of its rows (or columns). The metadata of the other
+    dimension is shared between all of the GCTs rather than copied, so it
+    should not be modified in place.
 
-        unique_values_in_field = list(in_gct.col_metadata_df.loc[:, separate_field].unique())
+    Args:
+        in_gct (GCToo object)
+        separate_field (string)
+        row_or_col (string)
+        drop_nan (bool): if True, rows (or columns) for which separate_field
+            is NaN are left out of every GCT, with a warning; otherwise, NaN
+            in separate_field is an error
 
-        gcts = []
-        for val in unique_values_in_field:
-            bool_array = in_gct.col_metadata_df.loc[:, separate_field].values == val
-            new_gct = sg.subset_gctoo(in_gct, col_bool=bool_array)
-            gcts.append(new_gct)
+    Yields:
+        val (string): value of separate_field
+        gct (GCToo object)
 
+    """
+    if row_or_col == "row":
+        meta_df = in_gct.row_metadata_df
+    elif row_or_col == "col":
+        meta_df = in_gct.col_metadata_df
     else:
         raise(Exception("row or col must be 'row' or 'col'."))
 
-    # Make sure each gct is associated with a value from separate_field
-    assert len(gcts) == len(unique_values_in_field), (
-        "len(gcts): {}, len(unique_values_in_field): {}".format(
-            len(gcts), len(unique_values_in_field)))
+    assert separate_field in meta_df.columns, (
+        ("separate_field must be in in_gct.{}_metadata_df.columns. " +
+         "separate_field: {}, in_gct.{}_metadata_df.columns: {}").format(
+            row_or_col, separate_field, row_or_col, meta_df.columns.values))
+
+    values = meta_df.loc[:, separate_field].values
+    num_nans = pd.isnull(values).sum()
+    assert drop_nan or num_nans == 0, (
+        "separate_field must not be NaN. separate_field: {}, # of NaN {}s: {}").format(
+        separate_field, row_or_col, num_nans)
+    if num_nans > 0:
+        logger.warning("{} {}s have no value for {}, so they are not in any of the separated gcts.".format(
+            num_nans, row_or_col, separate_field))
+
+    for (val, positions) in group_positions(values):
+        if row_or_col == "row":
+            gct = GCToo.GCToo(data_df=in_gct.data_df.iloc[positions, :],
+                              row_metadata_df=in_gct.row_metadata_df.iloc[positions, :],
+                              col_metadata_df=in_gct.col_metadata_df)
+        else:
+            gct = GCToo.GCToo(data_df=in_gct.data_df.iloc[:, positions],
+                              row_metadata_df=in_gct.row_metadata_df,
+                              col_metadata_df=in_gct.col_metadata_df.iloc[positions, :])
+        yield val, gct
+
+
+def group_positions(values):
+    """ Group the positions of values by value, with one stable sort.
 
-    return gcts, unique_values_in_field
+    Args:
+        values (numpy array)
+
+    Returns:
+        groups (list of tuples): (value, numpy array of positions), in order
+            of first appearance of each value; positions are in increasing
+            order; NaN values are left out
+
+    """
+    (codes, uniques) = pd.factorize(values)
+
+    # NaN is coded as -1, so it ends up first and is skipped
+    order = np.argsort(codes, kind="mergesort")
+    num_nans = np.sum(codes == -1)
+    boundaries = num_nans + np.concatenate([[0], np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)))])
+
+    return [(uniques[ii], order[boundaries[ii]:boundaries[ii + 1]]) for ii in range(len(uniques))]
+
+
+def write_separated_gcts(in_gct, separate_field, row_or_col, out_dir,
+                         out_name_prefix, out_name_suffix, n_jobs=1):
+    """ Separate in_gct and write each GCT to <out_dir>/<out_name_prefix><value><out_name_suffix>,
+    as a GCT or GCTX depending on out_name_suffix. GCTs are written by n_jobs processes.
+    Rows (or columns) for which separate_field is NaN are not written.
+
+    Args:
+        in_gct (GCToo object)
+        separate_field (string)
+        row_or_col (string)
+        out_dir (string)
+        out_name_prefix (string)
+        out_name_suffix (string): must end in .gct or .gctx
+        n_jobs (int)
+
+    Returns:
+        out_names (list of strings)
+
+    """
+    assert str.lower(out_name_suffix).endswith((".gct", ".gctx")), (
+        "out_name_suffix must end in either .gct or .gctx. out_name_suffix: {}".format(
+            out_name_suffix))
+
+    # GCToo objects can't be pickled (they hold a logger), so pass their dfs;
+    # imap takes each GCT from the generator as it is handed out
+    write_args = ((gct.data_df, gct.row_metadata_df, gct.col_metadata_df,
+                   os.path.join(out_dir, out_name_prefix + str(val) + out_name_suffix))
+                  for (val, gct) in iter_separate(in_gct, separate_field, row_or_col, drop_nan=True))
+
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            out_names = list(pool.imap(write_gct_from_args, write_args, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        out_names = [write_gct_from_args(one_write_args) for one_write_args in write_args]
+
+    logger.info("Wrote {} gcts to {}.".format(len(out_names), out_dir))
+
+    return out_names
+
+
+def write_gct_from_args(write_args):
+    """ Write one GCT to GCT or GCTX depending on extension. Takes a tuple so
+    that it can be used with multiprocessing.Pool.imap.
+
+    Args:
+        write_args (tuple): data_df, row_metadata_df, col_metadata_df, full_out_name
+
+    Returns:
+        full_out_name (string)
+
+    """
+    (data_df, row_metadata_df, col_metadata_df, full_out_name) = write_args
+    gct = GCToo.GCToo(data_df=data_df, row_metadata_df=row_metadata_df,
+                      col_metadata_df=col_metadata_df)
+
+    if str.lower(full_out_name).endswith(".gct"):
+        wg.write(gct, full_out_name, data_null="NaN", metadata_null="NA", filler_null="NA")
+    else:
+        wgx.write(gct, full_out_name)
+
+    return full_out_name
 
 
 if __name__ == "__main__":
@@ -1,34 +1,52 @@
 """
 sim2dist.py
 
-Convert a similarity matrix to a distance matrix.
+Convert a similarity matrix to a distance matrix using one of these transforms:
 
-d = 1 - s
+one_minus:          d = 1 - s
+sqrt_two_one_minus: d = sqrt(2 * (1 - s))
+angular:            d = arccos(s) / pi
 
 d = distance
-s = similarity
+s = similarity (e.g. a correlation, so between -1 and 1)
+
+The distance matrix is computed in place in float32. If both the input and
+the output are GCTX files, the matrix is streamed block_size rows at a time,
+so the whole matrix is never in memory.
 
 """
 
 import logging
 import argparse
 import sys
+import h5py
+import numpy as np
+import pandas as pd
 
 import broadinstitute_psp.utils.setup_logger as setup_logger
 import cmapPy.pandasGEXpress.GCToo as GCToo
 import cmapPy.pandasGEXpress.parse as parse
 import cmapPy.pandasGEXpress.write_gct as wg
+import cmapPy.pandasGEXpress.write_gctx as wgx
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
+TRANSFORM_CHOICES = ["one_minus", "sqrt_two_one_minus", "angular"]
+GCTX_SUFFIX = ".gctx"
+META_GROUP_NODE = "/0/META"
+
 
 def build_parser():
     parser = argparse.ArgumentParser(description=__doc__,
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("--in_gct_path", "-i", required=True,
-                        help="path to input gct")
+                        help="path to input gct or gctx")
     parser.add_argument("--out_name", "-o", default="out_dist.gct",
-                        help="what to name the output gct")
+                        help="what to name the output gct; end in .gctx to write GCTX")
+    parser.add_argument("--transform", "-t", choices=TRANSFORM_CHOICES, default="one_minus",
+                        help="how to convert similarity to distance")
+    parser.add_argument("--block_size", "-bs", type=int, default=1000,
+                        help="for GCTX to GCTX, number of rows of the matrix to convert at a time")
     parser.add_argument("--verbose", "-v", action="store_true", default=False,
                         help="Whether to print a bunch of output.")
 
@@ -37,17 +55,100 @@ def build_parser():
 
 def main(args):
 
+    if args.in_gct_path.endswith(GCTX_SUFFIX) and args.out_name.endswith(GCTX_SUFFIX):
+        stream_gctx_to_gctx(args.in_gct_path, args.out_name, args.transform, args.block_size)
+        return
+
     # Import data
     in_gct = parse.parse(args.in_gct_path)
 
-    # Compute distance df
-    dist_df = 1 - in_gct.data_df
+    # Compute distances in place (astype only copies if not already float32)
+    values = in_gct.data_df.values.astype(np.float32, copy=False)
+    transform_in_place(values, args.transform)
+    dist_df = pd.DataFrame(values, index=in_gct.data_df.index,
+                           columns=in_gct.data_df.columns, copy=False)
 
     # Create distance gct
     dist_gct = GCToo.GCToo(dist_df, in_gct.row_metadata_df, in_gct.col_metadata_df)
 
     # Write dist_gct to file
-    wg.write(dist_gct, args.out_name, filler_null="NA")
+    if args.out_name.endswith(GCTX_SUFFIX):
+        wgx.write(dist_gct, args.out_name)
+    else:
+        wg.write(dist_gct, args.out_name, filler_null="NA")
+
+
+def transform_in_place(values, transform):
+    """ Convert similarities to distances, overwriting values.
+
+    Args:
+        values (numpy array of floats)
+        transform (string): one of TRANSFORM_CHOICES
+
+    Returns:
+        None
+
+    """
+    assert transform in TRANSFORM_CHOICES, (
+        "transform must be one of {}. transform: {}").format(TRANSFORM_CHOICES, transform)
+
+    # NaNs stay NaN, so the comparisons in clip shouldn't warn about them
+    with np.errstate(invalid="ignore"):
+        if transform == "one_minus":
+            np.subtract(1, values, out=values)
+
+        elif transform == "sqrt_two_one_minus":
+            np.subtract(1, values, out=values)
+            np.multiply(values, 2, out=values)
+
+            # Round-off can make 1 - s slightly negative
+            np.maximum(values, 0, out=values)
+            np.sqrt(values, out=values)
+
+        elif transform == "angular":
+            np.clip(values, -1, 1, out=values)
+            np.arccos(values, out=values)
+            np.divide(values, np.pi, out=values)
+
+
+def stream_gctx_to_gctx(in_path, out_name, transform, block_size):
+    """ Convert the matrix of a GCTX to distances without reading the whole
+    matrix into memory. Metadata is copied over unchanged.
+
+    Args:
+        in_path (string): path to input gctx
+        out_name (string): what to name the output gctx
+        transform (string): one of TRANSFORM_CHOICES
+        block_size (int): number of rows of the stored matrix to convert at a time
+
+    Returns:
+        None
+
+    """
+    assert block_size > 0, "block_size must be positive. block_size: {}".format(block_size)
+
+    with h5py.File(in_path, "r") as in_file, h5py.File(out_name, "w") as out_file:
+        for (attr_name, attr_value) in in_file.attrs.items():
+            out_file.attrs[attr_name] = attr_value
+        out_file.attrs[wgx.src_attr] = out_name
+
+        out_file.copy(in_file[META_GROUP_NODE], META_GROUP_NODE)
+
+        in_matrix = in_file[wgx.data_matrix_node]
+        out_matrix = out_file.create_dataset(
+            wgx.data_matrix_node, shape=in_matrix.shape, dtype=np.float32,
+            chunks=in_matrix.chunks, compression=in_matrix.compression,
+            compression_opts=in_matrix.compression_opts)
+
+        num_rows = in_matrix.shape[0]
+        for block_start in range(0, num_rows, block_size):
+            block_end = min(block_start + block_size, num_rows)
+            block = np.asarray(in_matrix[block_start:block_end], dtype=np.float32)
+            transform_in_place(block, transform)
+            out_matrix[block_start:block_end] = block
+
+        logger.info("Converted {} rows of {} in blocks of {}.".format(
+            num_rows, in_path, block_size))
 
 
 if __name__ == "__main__":
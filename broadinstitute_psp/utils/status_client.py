@@ -0,0 +1,253 @@
+"""
+status_client.py
+
+Client for posting status updates to the proteomics clue API (/psp).
+
+All requests go through one pooled requests.Session, with timeouts and
+retries with exponential backoff. Optionally, updates can be sent from a
+background thread so that a slow API doesn't stall the caller; consecutive
+updates to the same URL that pile up while the API is busy are coalesced into
+a single PUT, so updates to different URLs are still sent in order.
+
+This module only depends on requests, so that it can be zipped alongside the
+Lambda functions (harvest_lambda, pour) without the rest of psp.
+
+"""
+
+import contextlib
+import copy
+import os
+import Queue
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds
+TIMEOUT_SECONDS = (5, 30)
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_METHODS = frozenset(["GET", "PUT"])
+
+
+class StatusClient():
+    """
+    Sends status updates to the /psp API.
+
+    Instance Variables:
+        api_url (string): base url of the /psp API
+        timeout (tuple of floats): (connect, read) timeouts in seconds
+        session (requests.Session): pooled session with retries
+        queue (Queue.Queue or None): pending updates; only set while sending
+            updates in the background
+        thread (threading.Thread or None): thread sending updates in the
+            background
+    """
+    def __init__(self, api_url=None, api_key=None, timeout=TIMEOUT_SECONDS,
+                 max_retries=MAX_RETRIES):
+        self.api_url = api_url if api_url is not None else os.environ["API_URL"]
+        self.timeout = timeout
+
+        self.session = make_session(max_retries)
+        self.session.headers.update(
+            {"user_key": api_key if api_key is not None else os.environ["API_KEY"]})
+
+        self.queue = None
+        self.thread = None
+
+    def make_url(self, id, url_suffix=""):
+        return self.api_url + "/" + id + url_suffix
+
+    def get(self, id):
+        """ Get the API entry with the given id.
+
+        Args:
+            id (string) API entry id
+
+        Returns:
+            r (requests.Response)
+
+        """
+        return self.session.get(self.make_url(id), timeout=self.timeout)
+
+    def put(self, url_suffix, id, payload, raise_errors=True):
+        """ Put update to the API right away. A response that isn't ok is
+        reported and returned.
+
+        Args:
+            url_suffix (string) must include leading "/"
+            id (string) API entry id
+            payload (JSON) update to put to API
+            raise_errors (bool): if False, a request that fails (e.g. because
+                the API can't be reached) is reported rather than raised
+
+        Returns:
+            r (requests.Response or None): None if the request failed and
+                raise_errors is False
+
+        """
+        api_url = self.make_url(id, url_suffix)
+
+        try:
+            r = self.session.put(api_url, json=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException as error:
+            print "failed to update API at: {} with error: {}".format(api_url, error)
+            if raise_errors:
+                raise
+            return None
+
+        print r.text
+        if r.ok:
+            print "successfully updated API at: {}".format(api_url)
+        else:
+            print "failed to update API at: {} with response: {}".format(api_url, r.text)
+        return r
+
+    def post_update(self, url_suffix, id, payload):
+        """ Put update to the API, or queue it if updates are being sent in
+        the background.
+
+        Args:
+            url_suffix (string) must include leading "/"
+            id (string) API entry id
+            payload (JSON) update to put to API
+
+        Returns:
+            r (requests.Response or None): None if the update was queued
+
+        """
+        if self.queue is None:
+            return self.put(url_suffix, id, payload)
+
+        self.queue.put((url_suffix, id, payload))
+
+    def start_background(self):
+        """ Start sending updates from a background thread. """
+        if self.thread is not None:
+            return
+
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.send_queued_updates)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop_background(self):
+        """ Send all queued updates, then go back to sending updates right away. """
+        if self.thread is None:
+            return
+
+        # None tells the thread to stop once everything before it is sent
+        self.queue.put(None)
+        self.thread.join()
+
+        self.queue = None
+        self.thread = None
+
+    @contextlib.contextmanager
+    def in_background(self):
+        """ Context manager that sends updates in the background while inside
+        of it. All updates are sent before leaving it, even if there was an
+        error, so that error messages still make it to the API.
+        """
+        self.start_background()
+        try:
+            yield self
+        finally:
+            self.stop_background()
+
+    def send_queued_updates(self):
+        """ Run by the background thread. Takes everything that's queued,
+        coalesces it, and sends it, until told to stop.
+        """
+        is_stopping = False
+        while not is_stopping:
+
+            # Wait for an update, then take whatever else is pending
+            updates = [self.queue.get()]
+            while True:
+                try:
+                    updates.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            is_stopping = None in updates
+            updates = [update for update in updates if update is not None]
+
+            # There's no caller to raise to, so failures are only reported
+            for (url_suffix, id, payload) in coalesce_updates(updates):
+                self.put(url_suffix, id, payload, raise_errors=False)
+
+
+def make_session(max_retries):
+    """ Make a session that reuses connections and retries failed requests
+    with exponential backoff.
+
+    Args:
+        max_retries (int)
+
+    Returns:
+        session (requests.Session)
+
+    """
+    retry_kwargs = {"total": max_retries, "backoff_factor": BACKOFF_FACTOR,
+                    "status_forcelist": RETRY_STATUS_CODES, "raise_on_status": False}
+
+    # urllib3 1.26 renamed method_whitelist to allowed_methods, and 2.0
+    # removed method_whitelist; the Docker image pins urllib3 1.25
+    try:
+        retry = Retry(allowed_methods=RETRY_METHODS, **retry_kwargs)
+    except TypeError:
+        retry = Retry(method_whitelist=RETRY_METHODS, **retry_kwargs)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def coalesce_updates(updates):
+    """ Combine consecutive updates to the same url into one update. Payloads
+    are merged in order, so later values win. Updates to different urls are
+    never reordered, so the API always ends up with the last update sent.
+
+    Args:
+        updates (list of tuples): (url_suffix, id, payload)
+
+    Returns:
+        coalesced_updates (list of tuples): (url_suffix, id, payload)
+
+    """
+    coalesced_updates = []
+    for (url_suffix, id, payload) in updates:
+        if len(coalesced_updates) > 0 and coalesced_updates[-1][:2] == (url_suffix, id):
+            merged_payload = merge_payloads(coalesced_updates[-1][2], payload)
+            coalesced_updates[-1] = (url_suffix, id, merged_payload)
+        else:
+            coalesced_updates.append((url_suffix, id, copy.deepcopy(payload)))
+
+    return coalesced_updates
+
+
+def merge_payloads(old_payload, new_payload):
+    """ Recursively merge new_payload into old_payload.
+
+    Args:
+        old_payload (dict)
+        new_payload (dict)
+
+    Returns:
+        merged_payload (dict)
+
+    """
+    merged_payload = copy.deepcopy(old_payload)
+    for key, value in new_payload.items():
+        if isinstance(value, dict) and isinstance(merged_payload.get(key), dict):
+            merged_payload[key] = merge_payloads(merged_payload[key], value)
+        else:
+            merged_payload[key] = copy.deepcopy(value)
+
+    return merged_payload
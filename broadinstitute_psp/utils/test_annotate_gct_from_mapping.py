@@ -1,6 +1,7 @@
 import logging
 import unittest
 import os
+import numpy as np
 import pandas as pd
 
 import broadinstitute_psp.utils.setup_logger as setup_logger
@@ -72,6 +73,32 @@ class TestAnnotate(unittest.TestCase):
         agfm.annotate_meta_df(meta_df2, different_to_entries, None, "NA")
         pd.util.testing.assert_frame_equal(meta_df2, e_meta_df2)
 
+    def test_annotate_meta_df_with_df(self):
+        meta_df = pd.DataFrame(
+            [["a", 1], ["b", 2], ["c", 3]], index=["A", "B", "C"], columns=["pert_iname", "dose"])
+
+        to_entries = pd.DataFrame(
+            [["inhibitor", 10], ["activator", 20], ["killer", 30]],
+            index=["c", "b", "d"], columns=["moa", "num_targets"])
+
+        e_meta_df = pd.DataFrame(
+            [["a", 1, "NA", "NA"], ["b", 2, "activator", 20], ["c", 3, "inhibitor", 10]],
+            index=["A", "B", "C"], columns=["pert_iname", "dose", "moa", "num_targets"])
+
+        agfm.annotate_meta_df(meta_df, to_entries, "pert_iname", "NA")
+        pd.util.testing.assert_frame_equal(meta_df, e_meta_df)
+
+        # Types are kept when nothing is missing
+        meta_df = pd.DataFrame([["b"], ["c"]], index=["B", "C"], columns=["pert_iname"])
+        agfm.annotate_meta_df(meta_df, to_entries, "pert_iname", "NA")
+        self.assertEqual(meta_df["num_targets"].dtype, to_entries["num_targets"].dtype)
+
+        # Ints stay ints next to missing entries
+        meta_df = pd.DataFrame([["a"], ["b"]], index=["A", "B"], columns=["pert_iname"])
+        agfm.annotate_meta_df(meta_df, to_entries, "pert_iname", "NA")
+        self.assertEqual(list(meta_df["num_targets"]), ["NA", 20])
+        self.assertIsInstance(meta_df.loc["B", "num_targets"], (int, np.integer))
+
 
 if __name__ == '__main__':
     setup_logger.setup(verbose=True)
@@ -1,7 +1,9 @@
 import unittest
 import logging
 import os
+import shutil
 import tempfile
+import cmapPy.pandasGEXpress.parse as parse
 import broadinstitute_psp.utils.setup_logger as setup_logger
 import broadinstitute_psp.utils.psp_utils as psp_utils
 import broadinstitute_psp.utils.config_converter as config_converter
@@ -60,6 +62,11 @@ class TestConfigConverter(unittest.TestCase):
         expected_params = {"p100_dist_sd_cutoff": "6"}
         self.assertEqual(differential_params, expected_params)
 
+        # Same result from an already parsed GCT
+        gct = parse.parse(gct_path)
+        parsed_diff_params = config_converter.convert_parsed_gct_to_config(assay, gct, save_file_path)
+        self.assertEqual(parsed_diff_params, diff_params)
+
         # No differential params, pr_processing_params empty {}
         gct_path = os.path.join(FUNCTIONAL_TESTS_DIR, "test_pr_processing_params_empty.gct")
         diff_params = config_converter.convert_gct_to_config(assay, gct_path, save_file_path)
@@ -103,6 +110,27 @@ class TestConfigConverter(unittest.TestCase):
         }
         self.assertEqual(returned_full_dict, full_dict)
 
+    def test_check_custom_parameters_against_defaults_with_search_dirs(self):
+        # A production config in search_dirs is the one compared against
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with open(psp_utils.PSP_PRODUCTION_CONFIG_NAME) as f:
+                production_config = f.read()
+            with open(os.path.join(temp_dir, psp_utils.PSP_PRODUCTION_CONFIG_NAME), "w") as f:
+                f.write(production_config.replace("p100_sample_frac_cutoff = 0.8", "p100_sample_frac_cutoff = 0.7"))
+
+            pseudoJSON = '""{""samplePctCutoff"":0.7,""probePctCutoff"":0.9}""'
+            custom_dict = config_converter.create_dict_from_pseudojson(pseudoJSON)
+            differential_parameters = config_converter.check_custom_parameters_against_defaults(
+                "p100", custom_dict, json=True, search_dirs=[temp_dir])
+            self.assertIsNone(differential_parameters)
+
+            differential_parameters = config_converter.check_custom_parameters_against_defaults(
+                "p100", custom_dict, json=True)
+            self.assertEqual(differential_parameters, {"p100_sample_frac_cutoff": "0.7"})
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_check_custom_parameters_against_defaults(self):
         # No differential params from pseudoJSON
         assay = "p100"
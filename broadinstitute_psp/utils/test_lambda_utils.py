@@ -8,7 +8,6 @@ logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
 API_BASE_URL = "http://API_URL"
 
-OG_requests = lambda_utils.requests.put
 OG_os_environ = lambda_utils.os.environ
 
 class TestLambdaUtils(unittest.TestCase):
@@ -24,12 +23,13 @@ class TestLambdaUtils(unittest.TestCase):
         lambda_utils.os.environ.__getitem__.side_effect = get_environ_item
 
         # mock setup requests
-        lambda_utils.requests.put = mock.Mock()
-        lambda_utils.requests.put.return_value.ok.return_value = True
+        lambda_utils.client = None
+        lambda_utils.get_status_client().session.put = mock.Mock()
+        lambda_utils.get_status_client().session.put.return_value.ok.return_value = True
 
     @classmethod
     def tearDownClass(cls):
-        lambda_utils.requests.put = OG_requests
+        lambda_utils.client = None
         lambda_utils.os.environ = OG_os_environ
 
     # @mock.patch("broadinstitute.lambda_utils.requests.put")
@@ -41,10 +41,10 @@ class TestLambdaUtils(unittest.TestCase):
 
 
         #todo: NoneType is not iterable
-        args, kwargs = lambda_utils.requests.put.call_args
+        args, kwargs = lambda_utils.get_status_client().session.put.call_args
         self.assertEqual(args[0], API_BASE_URL + "/" + test_id + "/suffix")
         self.assertEqual(kwargs["json"], {"payload":"this"})
-        self.assertEqual(kwargs["headers"], {"user_key":"API_KEY"})
+        self.assertEqual(lambda_utils.get_status_client().session.headers["user_key"], "API_KEY")
 
         # Does not test response object
         # lambda_utils.requests.put = for_resetting
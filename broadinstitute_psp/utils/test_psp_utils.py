@@ -1,8 +1,14 @@
 import unittest
 import logging
 import os
+import tempfile
+import shutil
+import mock
 import pandas as pd
 
+import cmapPy.pandasGEXpress.parse as parse
+import cmapPy.pandasGEXpress.write_gct as wg
+
 import broadinstitute_psp.utils.setup_logger as setup_logger
 import broadinstitute_psp.utils.psp_utils as utils
 
@@ -48,6 +54,174 @@ class TestPspUtils(unittest.TestCase):
         self.assertEqual(e_prov_code, prov_code, (
             "prov_code is incorrect: {}").format(prov_code))
 
+        # Provenance codes differ
+        col_meta_df.loc[1, "prov_field"] = "PRM+L2X+GCP"
+        with self.assertRaises(Exception) as e:
+            utils.extract_prov_code(col_meta_df, "prov_field", "+")
+        self.assertIn("same provenance code", str(e.exception))
+
+        # Provenance code is empty
+        col_meta_df.loc[:, "prov_field"] = ""
+        with self.assertRaises(AssertionError) as e:
+            utils.extract_prov_code(col_meta_df, "prov_field", "+")
+        self.assertIn("Provenance code is empty", str(e.exception))
+
+    def test_provenance_code(self):
+        prov_code = utils.ProvenanceCode(["PRM", "L2X"], "|")
+
+        # Adding entries keeps the delimiter and doesn't change the original
+        updated_prov_code = prov_code + ["GCP"]
+        self.assertEqual(updated_prov_code, ["PRM", "L2X", "GCP"])
+        self.assertEqual(prov_code, ["PRM", "L2X"])
+        self.assertEqual(updated_prov_code.to_string(), "PRM|L2X|GCP")
+
+        updated_prov_code.append("RMD")
+        self.assertIn("RMD", updated_prov_code)
+        self.assertEqual(updated_prov_code.to_string(), "PRM|L2X|GCP|RMD")
+
+    def test_parse_gct_from_bytes(self):
+        in_gct = "utils/functional_tests/test_p100.gct"
+        e_gct = parse.parse(in_gct)
+
+        with open(in_gct, "rb") as f:
+            out_gct = utils.parse_gct_from_bytes(f.read(), "s3://bucket/test_p100.gct")
+
+        pd.util.testing.assert_frame_equal(out_gct.data_df, e_gct.data_df)
+        pd.util.testing.assert_frame_equal(out_gct.row_metadata_df, e_gct.row_metadata_df)
+        pd.util.testing.assert_frame_equal(out_gct.col_metadata_df, e_gct.col_metadata_df)
+        self.assertEqual(out_gct.src, "s3://bucket/test_p100.gct")
+
+        # Windows line endings
+        with open(in_gct, "rb") as f:
+            out_gct = utils.parse_gct_from_bytes(f.read().replace("\n", "\r\n"))
+        pd.util.testing.assert_frame_equal(out_gct.data_df, e_gct.data_df)
+        pd.util.testing.assert_frame_equal(out_gct.col_metadata_df, e_gct.col_metadata_df)
+
+        # Unsupported version
+        with self.assertRaises(Exception) as e:
+            utils.parse_gct_from_bytes("#1.1\n1\t1\n")
+        self.assertIn("Only GCT1.2 and 1.3", str(e.exception))
+
+    def test_write_gct_to_buffer(self):
+        gct = parse.parse("utils/functional_tests/test_p100.gct")
+
+        # Same output as writing to file
+        temp_dir = tempfile.mkdtemp()
+        try:
+            out_path = os.path.join(temp_dir, "out.gct")
+            wg.write(gct, out_path, data_null="NaN", filler_null="NA", data_float_format=None)
+            with open(out_path, "rb") as f:
+                e_content = f.read()
+        finally:
+            shutil.rmtree(temp_dir)
+
+        buf = utils.write_gct_to_buffer(gct, "NaN", "NA")
+        self.assertEqual(buf.read(), e_content)
+
+    def test_get_psp_production_config_path(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(temp_dir, utils.PSP_PRODUCTION_CONFIG_NAME)
+            shutil.copy("psp_production.cfg", config_path)
+
+            with mock.patch.dict(utils.psp_production_config_paths, clear=True):
+
+                # Search dirs come first
+                self.assertEqual(utils.get_psp_production_config_path([temp_dir]), config_path)
+
+                # Otherwise found in the working directory (broadinstitute_psp)
+                self.assertEqual(utils.get_psp_production_config_path(),
+                                 os.path.join(os.getcwd(), utils.PSP_PRODUCTION_CONFIG_NAME))
+
+                # Cached, so not looked for again
+                with mock.patch("broadinstitute_psp.utils.psp_utils.os.path.isfile") as isfile:
+                    utils.get_psp_production_config_path([temp_dir])
+                    isfile.assert_not_called()
+
+            # Not finding the config isn't cached, so a config made later is found
+            later_dir = tempfile.mkdtemp(dir=temp_dir)
+            with mock.patch.dict(utils.psp_production_config_paths, clear=True):
+                self.assertEqual(utils.get_psp_production_config_path([later_dir]),
+                                 os.path.join(os.getcwd(), utils.PSP_PRODUCTION_CONFIG_NAME))
+                later_config_path = os.path.join(later_dir, utils.PSP_PRODUCTION_CONFIG_NAME)
+                shutil.copy("psp_production.cfg", later_config_path)
+                self.assertEqual(utils.get_psp_production_config_path([later_dir]), later_config_path)
+
+            # Environment variable overrides the default directories, but not
+            # directories given by the caller
+            with mock.patch.dict(os.environ, {utils.PSP_PRODUCTION_CONFIG_ENV_VAR: config_path}):
+                self.assertEqual(utils.get_psp_production_config_path(), config_path)
+                self.assertEqual(utils.get_psp_production_config_path([os.getcwd()]),
+                                 os.path.join(os.getcwd(), utils.PSP_PRODUCTION_CONFIG_NAME))
+
+            with mock.patch.dict(os.environ, {utils.PSP_PRODUCTION_CONFIG_ENV_VAR: temp_dir + "/nope.cfg"}):
+                with self.assertRaises(AssertionError) as e:
+                    utils.get_psp_production_config_path()
+                self.assertIn("does not point to a file", str(e.exception))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_read_psp_production_config_file(self):
+        with mock.patch.dict(utils.configs, clear=True):
+            (config_io, _, config_params) = utils.read_psp_production_config_file()
+            self.assertEqual(config_params["p100_probe_sd_cutoff"], "3")
+
+            # Changing the returned config doesn't change the cached one
+            config_params["p100_probe_sd_cutoff"] = "6"
+            with mock.patch("broadinstitute_psp.utils.psp_utils.ConfigParser.RawConfigParser") as config_parser:
+                (_, _, config_params) = utils.read_psp_production_config_file()
+                config_parser.assert_not_called()
+            self.assertEqual(config_params["p100_probe_sd_cutoff"], "3")
+
+    def test_read_config(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            config_path = os.path.join(temp_dir, "test.cfg")
+            shutil.copy("psp_production.cfg", config_path)
+
+            with mock.patch.dict(utils.configs, clear=True):
+                config = utils.read_config(config_path)
+
+                # Typed fields
+                self.assertEqual(config.get_typed("parameters", "offset_bounds"), (-7, 7))
+                self.assertEqual(config.get_typed("metadata", "gcp_assays"), ["GCP", "GR1", "GR2", "EPI"])
+                self.assertEqual(config.get_typed("parameters", "p100_probe_sd_cutoff"), 3)
+                self.assertEqual(config.section("io")["data_null"], "NaN")
+
+                # Neither sections nor typed values can be changed
+                with self.assertRaises(TypeError):
+                    config.section("io")["data_null"] = "foo"
+                config.get_typed("metadata", "gcp_assays").append("foo")
+                self.assertEqual(config.get_typed("metadata", "gcp_assays"), ["GCP", "GR1", "GR2", "EPI"])
+
+                # A field that isn't a literal only fails when it's asked for
+                extra_config_path = os.path.join(temp_dir, "extra.cfg")
+                shutil.copy(config_path, extra_config_path)
+                with open(extra_config_path, "a") as f:
+                    f.write("\n[extra]\nnot_a_literal = foo bar\n")
+                extra_config = utils.read_config(extra_config_path)
+                self.assertEqual(extra_config.get_typed("parameters", "offset_bounds"), (-7, 7))
+                with self.assertRaises(SyntaxError):
+                    extra_config.get_typed("extra", "not_a_literal")
+
+                # Same object while the file is unchanged, even via another path
+                self.assertIs(utils.read_config(config_path), config)
+                self.assertIs(utils.read_config(os.path.join(temp_dir, ".", "test.cfg")), config)
+
+                # Parsed again once the file changes
+                with open(config_path, "a") as f:
+                    f.write("p100_dist_sd_cutoff = 6\n")
+                os.utime(config_path, (0, 0))
+                new_config = utils.read_config(config_path)
+                self.assertIsNot(new_config, config)
+                self.assertEqual(new_config.section("parameters")["p100_dist_sd_cutoff"], "6")
+
+                with self.assertRaises(AssertionError) as e:
+                    config.section("foo")
+                self.assertIn("no foo section", str(e.exception))
+        finally:
+            shutil.rmtree(temp_dir)
+
 if __name__ == "__main__":
     setup_logger.setup(verbose=True)
     unittest.main()
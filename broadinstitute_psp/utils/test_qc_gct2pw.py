@@ -45,6 +45,21 @@ class TestQCGct2Pw(unittest.TestCase):
         self.assertTrue(np.allclose(out_df, e_out_df),
                         "out_df is incorrect: {}".format(out_df))
 
+    def test_compute_column_stats(self):
+        np.random.seed(7)
+        values = np.random.rand(30, 6)
+        values[np.random.rand(30, 6) < 0.2] = np.nan
+        values[:, 4] = np.nan
+        values[1:, 5] = np.nan
+        df = pd.DataFrame(values)
+
+        column_stats = qc_gct2pw.compute_column_stats(values)
+
+        np.testing.assert_allclose(column_stats["median"], df.median(axis=0).values)
+        np.testing.assert_allclose(column_stats["mean"], df.mean(axis=0).values)
+        np.testing.assert_allclose(column_stats["mad"], df.mad(axis=0).values)
+        np.testing.assert_allclose(column_stats["sd"], df.std(axis=0).values)
+
     def test_main(self):
         in_gct = "utils/functional_tests/test_qc.gct"
         out_pw = "utils/functional_tests/test_qc_gct2pw_output.pw"
@@ -59,6 +74,28 @@ class TestQCGct2Pw(unittest.TestCase):
         # Remove pw file
         os.remove(out_pw)
 
+    def test_main_multiple_plates(self):
+        in_gct = "utils/functional_tests/test_qc.gct"
+        single_pw = "utils/functional_tests/test_qc_gct2pw_single_output.pw"
+        multi_pw = "utils/functional_tests/test_qc_gct2pw_multi_output.pw"
+
+        try:
+            qc_gct2pw.main(qc_gct2pw.build_parser().parse_args([in_gct, single_pw]))
+            qc_gct2pw.main(qc_gct2pw.build_parser().parse_args(
+                [in_gct, in_gct, multi_pw, "-n_jobs", "2"]))
+
+            single_df = pd.read_csv(single_pw, sep="\t")
+            multi_df = pd.read_csv(multi_pw, sep="\t")
+
+            # One row per well of each gct, in the order of the gcts
+            e_multi_df = pd.concat([single_df, single_df], ignore_index=True)
+            pd.util.testing.assert_frame_equal(multi_df, e_multi_df)
+
+        finally:
+            for out_pw in [single_pw, multi_pw]:
+                if os.path.exists(out_pw):
+                    os.remove(out_pw)
+
 if __name__ == "__main__":
     setup_logger.setup(verbose=True)
     unittest.main()
@@ -0,0 +1,102 @@
+import logging
+import unittest
+import numpy as np
+import pandas as pd
+
+import broadinstitute_psp.utils.replace_nans as replace_nans
+import broadinstitute_psp.utils.setup_logger as setup_logger
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+class TestReplaceNans(unittest.TestCase):
+    def test_impute_with_row_statistic(self):
+        data_df = pd.DataFrame([[1, np.nan, 3, 10], [np.nan, 2, 4, np.nan]],
+                               index=["r1", "r2"], columns=["c1", "c2", "c3", "c4"])
+
+        e_median_df = pd.DataFrame([[1, 3, 3, 10], [3, 2, 4, 3]],
+                                   index=["r1", "r2"], columns=["c1", "c2", "c3", "c4"], dtype=float)
+        median_df = replace_nans.impute_with_row_statistic(data_df, "median")
+        pd.util.testing.assert_frame_equal(median_df, e_median_df)
+
+        e_mean_df = pd.DataFrame([[1, 14 / 3., 3, 10], [3, 2, 4, 3]],
+                                 index=["r1", "r2"], columns=["c1", "c2", "c3", "c4"], dtype=float)
+        mean_df = replace_nans.impute_with_row_statistic(data_df, "mean")
+        pd.util.testing.assert_frame_equal(mean_df, e_mean_df)
+
+        # Input is unchanged
+        self.assertTrue(np.isnan(data_df.loc["r1", "c2"]))
+
+    def test_impute_with_subset_median(self):
+        data_df = pd.DataFrame([[1, np.nan, 10, 30, np.nan], [np.nan, np.nan, 5, 7, 9]],
+                               index=["r1", "r2"], columns=["c1", "c2", "c3", "c4", "c5"])
+        row_meta_df = pd.DataFrame({"grp": ["1", "1"]}, index=["r1", "r2"])
+        col_meta_df = pd.DataFrame({"grp_vector": ["1", "1", "2", "2", "2"]},
+                                   index=["c1", "c2", "c3", "c4", "c5"])
+
+        # r1: c2 gets the median of subset 1, c5 that of subset 2;
+        # r2: nothing measured in subset 1, so the overall median is used
+        e_df = pd.DataFrame([[1, 1, 10, 30, 20], [7, 7, 5, 7, 9]],
+                            index=["r1", "r2"], columns=["c1", "c2", "c3", "c4", "c5"], dtype=float)
+
+        out_df = replace_nans.impute_with_subset_median(
+            data_df, row_meta_df, col_meta_df, "grp", "grp_vector")
+        pd.util.testing.assert_frame_equal(out_df, e_df)
+
+    def test_impute_with_knn(self):
+        # Rows are probes, cols are samples
+        data_df = pd.DataFrame({"s1": [1, 1, 1], "s2": [1.1, 1.1, np.nan],
+                                "s3": [5, 5, 5], "s4": [5.1, 5.1, 9]},
+                               index=["p1", "p2", "p3"], columns=["s1", "s2", "s3", "s4"])
+
+        out_df = replace_nans.impute_with_knn(data_df, 1, 10)
+        self.assertAlmostEqual(out_df.loc["p3", "s2"], 1)
+
+        # s1 and s3 are the 2 nearest samples to s2
+        out_df = replace_nans.impute_with_knn(data_df, 2, 10)
+        self.assertAlmostEqual(out_df.loc["p3", "s2"], 3)
+        pd.util.testing.assert_frame_equal(out_df.drop("s2", axis=1), data_df.drop("s2", axis=1), check_dtype=False)
+
+        # Neighbors that did not measure the probe are skipped
+        data_df.loc["p3", "s1"] = np.nan
+        out_df = replace_nans.impute_with_knn(data_df, 1, 10)
+        self.assertAlmostEqual(out_df.loc["p3", "s2"], 5)
+        self.assertAlmostEqual(out_df.loc["p3", "s1"], 5)
+
+        # Block size doesn't change the result
+        np.random.seed(1)
+        values = np.random.randn(20, 30)
+        values[np.random.rand(20, 30) < 0.2] = np.nan
+        random_df = pd.DataFrame(values)
+        pd.util.testing.assert_frame_equal(
+            replace_nans.impute_with_knn(random_df, 3, 7),
+            replace_nans.impute_with_knn(random_df, 3, 1000))
+        self.assertFalse(replace_nans.impute_with_knn(random_df, 3, 7).isnull().values.any())
+
+    def test_compute_nan_euclidean_distances(self):
+        np.random.seed(2)
+        values = np.random.randn(6, 10)
+        values[np.random.rand(6, 10) < 0.3] = np.nan
+        values[5, :] = np.nan
+        values[5, 0] = 1
+        values[4, 0] = np.nan
+        is_measured = ~np.isnan(values)
+        zeroed_values = np.where(is_measured, values, 0)
+
+        dists = replace_nans.compute_nan_euclidean_distances(
+            zeroed_values[:3, :], is_measured[:3, :], zeroed_values, is_measured)
+        self.assertEqual(dists.shape, (3, 6))
+
+        for ii in range(3):
+            for jj in range(6):
+                shared = is_measured[ii, :] & is_measured[jj, :]
+                if shared.any():
+                    e_dist = np.sqrt(np.mean((values[ii, shared] - values[jj, shared]) ** 2))
+                    self.assertAlmostEqual(dists[ii, jj], e_dist)
+                else:
+                    self.assertEqual(dists[ii, jj], np.inf)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+    unittest.main()
@@ -0,0 +1,71 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+import cmapPy.pandasGEXpress.GCToo as GCToo
+import cmapPy.pandasGEXpress.parse as parse
+import cmapPy.pandasGEXpress.write_gct as wg
+import broadinstitute_psp.utils.score2rank as score2rank
+import broadinstitute_psp.utils.setup_logger as setup_logger
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+class TestScore2Rank(unittest.TestCase):
+    def test_rank_columns_in_place(self):
+        np.random.seed(3)
+
+        # Few distinct values, so that there are many ties
+        values = np.random.randint(0, 5, size=(40, 25)).astype(float)
+        values[np.random.rand(40, 25) < 0.1] = np.nan
+        values[:, 3] = np.nan
+        score_df = pd.DataFrame(values)
+
+        e_rank_df = score_df.rank(ascending=False)
+        e_pct_rank_df = score_df.rank(ascending=False, pct=True) * 100
+
+        for block_size in [1, 7, 1000]:
+            rank_values = score2rank.rank_columns_in_place(values.copy(), False, block_size)
+            np.testing.assert_allclose(rank_values, e_rank_df.values)
+
+            pct_rank_values = score2rank.rank_columns_in_place(values.copy(), True, block_size)
+            np.testing.assert_allclose(pct_rank_values, e_pct_rank_df.values)
+
+        # Ranked in place
+        values_to_rank = values.copy()
+        score2rank.rank_columns_in_place(values_to_rank, False, 10)
+        np.testing.assert_allclose(values_to_rank, e_rank_df.values)
+
+    def test_main(self):
+        in_dir = tempfile.mkdtemp()
+        out_dir = tempfile.mkdtemp()
+        try:
+            ids = ["a", "b", "c", "d"]
+            for (prefix, seed) in [("A375", 1), ("PC3", 2)]:
+                np.random.seed(seed)
+                data_df = pd.DataFrame(np.random.randn(4, 4), index=ids, columns=ids)
+                meta_df = pd.DataFrame({"cell_id": [prefix] * 4}, index=ids)
+                wg.write(GCToo.GCToo(data_df=data_df, row_metadata_df=meta_df, col_metadata_df=meta_df),
+                         os.path.join(in_dir, prefix + "_SIM_SCORE.gct"))
+
+            args = score2rank.build_parser().parse_args(
+                ["-i", in_dir + "/", "-o", out_dir + "/", "-w", "*_SIM_*.gct",
+                 "-s", "_RANK.gctx", "-nj", "2"])
+            score2rank.main(args)
+
+            rank_gct = parse.parse(os.path.join(out_dir, "A375_RANK.gctx"))
+            self.assertTrue(np.isnan(np.diag(rank_gct.data_df.values)).all())
+            self.assertEqual(sorted(rank_gct.data_df.loc[:, "a"].dropna()), [1, 2, 3])
+            self.assertTrue(os.path.exists(os.path.join(out_dir, "PC3_RANK.gctx")))
+        finally:
+            shutil.rmtree(in_dir)
+            shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+    unittest.main()
@@ -1,5 +1,9 @@
 import logging
 import os
+import shutil
+import tempfile
+import mock
+import numpy as np
 import pandas as pd
 import unittest
 
@@ -84,6 +88,49 @@ class TestSeparateGct(unittest.TestCase):
         os.remove(os.path.join(functional_tests_dir, out_prefix + "HT29.gct"))
         os.remove(os.path.join(functional_tests_dir, out_prefix + "A549.gct"))
 
+    def test_group_positions(self):
+        groups = sg.group_positions(np.array(["b", "a", np.nan, "b", "c", "a"], dtype=object))
+
+        self.assertEqual([val for (val, _) in groups], ["b", "a", "c"])
+        self.assertEqual([list(positions) for (_, positions) in groups], [[0, 3], [1, 5], [4]])
+
+    def test_separate_with_nan(self):
+        nan_gct = parse.parse(in_gct_path)
+        nan_gct.col_metadata_df.loc[nan_gct.col_metadata_df.index[0], "cell_id"] = np.nan
+
+        with self.assertRaises(AssertionError) as e:
+            sg.separate(nan_gct, "cell_id", "col")
+        self.assertIn("separate_field must not be NaN", str(e.exception))
+
+        # Only left out if asked for
+        with mock.patch.object(sg.logger, "warning") as warning:
+            (gcts, cell_ids) = sg.separate(nan_gct, "cell_id", "col", drop_nan=True)
+
+        warning.assert_called_once()
+        self.assertIn("1 cols have no value for cell_id", warning.call_args[0][0])
+        self.assertEqual(sum(gct.data_df.shape[1] for gct in gcts), in_gct.data_df.shape[1] - 1)
+
+        # No warning without NaNs
+        with mock.patch.object(sg.logger, "warning") as warning:
+            sg.separate(in_gct, "cell_id", "col", drop_nan=True)
+        warning.assert_not_called()
+
+    def test_write_separated_gcts(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            out_names = sg.write_separated_gcts(in_gct, "cell_id", "col", out_dir, "sep_", ".gctx", n_jobs=2)
+
+            self.assertEqual(out_names, [os.path.join(out_dir, "sep_" + cell + ".gctx")
+                                         for cell in ["A375", "HT29", "A549"]])
+            a549_out_gct = parse.parse(out_names[2])
+            pd.util.testing.assert_frame_equal(a549_out_gct.data_df, a549_gct.data_df, check_names=False)
+
+            with self.assertRaises(AssertionError) as e:
+                sg.write_separated_gcts(in_gct, "cell_id", "col", out_dir, "sep_", ".txt")
+            self.assertIn("must end in either .gct or .gctx", str(e.exception))
+        finally:
+            shutil.rmtree(out_dir)
+
 
 if __name__ == "__main__":
     setup_logger.setup(verbose=True)
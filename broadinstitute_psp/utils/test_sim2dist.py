@@ -0,0 +1,96 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+import cmapPy.pandasGEXpress.GCToo as GCToo
+import cmapPy.pandasGEXpress.parse as parse
+import cmapPy.pandasGEXpress.write_gct as wg
+import cmapPy.pandasGEXpress.write_gctx as wgx
+import broadinstitute_psp.utils.sim2dist as sim2dist
+import broadinstitute_psp.utils.setup_logger as setup_logger
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+class TestSim2Dist(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(5)
+        values = np.corrcoef(np.random.randn(9, 20)).astype(np.float32)
+        values[2, 4] = np.nan
+        ids = ["s{}".format(ii) for ii in range(9)]
+        meta_df = pd.DataFrame({"cell": ["A"] * 5 + ["B"] * 4}, index=ids)
+        cls.sim_gct = GCToo.GCToo(pd.DataFrame(values, index=ids, columns=ids),
+                                  meta_df, meta_df.copy())
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_transform_in_place(self):
+        values = np.array([[1, 0.5, 0], [-1, np.nan, 1.0000001]], dtype=np.float32)
+
+        one_minus = values.copy()
+        sim2dist.transform_in_place(one_minus, "one_minus")
+        np.testing.assert_allclose(one_minus, 1 - values)
+        self.assertEqual(one_minus.dtype, np.float32)
+
+        sqrt_two_one_minus = values.copy()
+        sim2dist.transform_in_place(sqrt_two_one_minus, "sqrt_two_one_minus")
+        np.testing.assert_allclose(
+            sqrt_two_one_minus, [[0, 1, np.sqrt(2)], [2, np.nan, 0]], rtol=1e-6)
+
+        angular = values.copy()
+        sim2dist.transform_in_place(angular, "angular")
+        np.testing.assert_allclose(angular, [[0, 1. / 3, 0.5], [1, np.nan, 0]], rtol=1e-6)
+
+        with self.assertRaises(AssertionError) as e:
+            sim2dist.transform_in_place(values, "euclidean")
+        self.assertIn("transform must be one of", str(e.exception))
+
+    def test_main_gct(self):
+        in_path = os.path.join(self.tmp_dir, "sim.gct")
+        out_path = os.path.join(self.tmp_dir, "dist.gct")
+        wg.write(self.sim_gct, in_path, filler_null="NA")
+
+        args = sim2dist.build_parser().parse_args(["-i", in_path, "-o", out_path])
+        sim2dist.main(args)
+
+        out_gct = parse.parse(out_path)
+        e_dist_df = 1 - parse.parse(in_path).data_df
+        pd.util.testing.assert_frame_equal(out_gct.data_df, e_dist_df,
+                                           check_dtype=False, check_less_precise=True)
+
+    def test_main_gctx_streaming(self):
+        in_path = os.path.join(self.tmp_dir, "sim.gctx")
+        wgx.write(self.sim_gct, in_path)
+
+        for transform in sim2dist.TRANSFORM_CHOICES:
+            e_values = self.sim_gct.data_df.values.copy()
+            sim2dist.transform_in_place(e_values, transform)
+
+            # Streaming gives the same result no matter the block size
+            for block_size in [1, 4, 1000]:
+                out_path = os.path.join(self.tmp_dir, "dist_{}_{}.gctx".format(transform, block_size))
+                args = sim2dist.build_parser().parse_args(
+                    ["-i", in_path, "-o", out_path, "-t", transform, "-bs", str(block_size)])
+                sim2dist.main(args)
+
+                out_gct = parse.parse(out_path)
+                np.testing.assert_allclose(out_gct.data_df.values, e_values, rtol=1e-6)
+                self.assertEqual(out_gct.data_df.values.dtype, np.float32)
+                self.assertEqual(list(out_gct.data_df.index), list(self.sim_gct.data_df.index))
+                self.assertEqual(list(out_gct.data_df.columns), list(self.sim_gct.data_df.columns))
+                pd.util.testing.assert_frame_equal(
+                    out_gct.row_metadata_df, self.sim_gct.row_metadata_df, check_names=False)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+    unittest.main()
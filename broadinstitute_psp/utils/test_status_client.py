@@ -0,0 +1,87 @@
+import unittest
+import mock
+import logging
+import time
+import requests
+import broadinstitute_psp.utils.setup_logger as setup_logger
+import broadinstitute_psp.utils.status_client as status_client
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+API_BASE_URL = "http://API_URL"
+
+
+class TestStatusClient(unittest.TestCase):
+
+    def test_put(self):
+        client = status_client.StatusClient(API_BASE_URL, "API_KEY")
+        client.session.put = mock.Mock()
+
+        client.post_update("/level3", "test_id", {"status": "done"})
+
+        args, kwargs = client.session.put.call_args
+        self.assertEqual(args[0], API_BASE_URL + "/test_id/level3")
+        self.assertEqual(kwargs["json"], {"status": "done"})
+        self.assertEqual(kwargs["timeout"], status_client.TIMEOUT_SECONDS)
+        self.assertEqual(client.session.headers["user_key"], "API_KEY")
+
+        # Failed request is raised, unless asked not to
+        client.session.put = mock.Mock(side_effect=requests.exceptions.ConnectionError("down"))
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.post_update("", "test_id", {"status": "done"})
+        self.assertIsNone(client.put("", "test_id", {"status": "done"}, raise_errors=False))
+
+        # Failures in the background are reported, not raised
+        with client.in_background():
+            client.post_update("", "test_id", {"status": "done"})
+        self.assertEqual(client.session.put.call_count, 3)
+
+    def test_in_background(self):
+        client = status_client.StatusClient(API_BASE_URL, "API_KEY")
+
+        # Slow API, so that updates pile up behind the first one
+        def slow_put(*args, **kwargs):
+            time.sleep(0.2)
+            return mock.Mock(ok=True, text="")
+        client.session.put = mock.Mock(side_effect=slow_put)
+
+        with client.in_background():
+            start_time = time.time()
+            client.post_update("/level3", "test_id", {"s3": {"url": "s3://a"}})
+            time.sleep(0.05)
+            client.post_update("", "test_id", {"status": "started"})
+            client.post_update("", "test_id", {"status": "created LVL 3 GCT"})
+            client.post_update("/level3", "test_id", {"s3": {"message": "hi"}})
+
+            # Caller wasn't stalled by the slow API
+            self.assertLess(time.time() - start_time, 0.15)
+
+        # Everything was sent by the time the context manager exited
+        self.assertIsNone(client.thread)
+        calls = [(args[0], kwargs["json"]) for args, kwargs in client.session.put.call_args_list]
+        self.assertEqual(calls, [
+            (API_BASE_URL + "/test_id/level3", {"s3": {"url": "s3://a"}}),
+            (API_BASE_URL + "/test_id", {"status": "created LVL 3 GCT"}),
+            (API_BASE_URL + "/test_id/level3", {"s3": {"message": "hi"}})])
+
+    def test_coalesce_updates(self):
+        updates = [("", "a", {"status": "1", "s3": {"url": "x"}}),
+                   ("", "a", {"s3": {"message": "m"}, "status": "2"}),
+                   ("/level3", "a", {"status": "3"}),
+                   ("", "a", {"status": "4"})]
+
+        out = status_client.coalesce_updates(updates)
+
+        # Only consecutive updates to the same url are merged, so order is kept
+        self.assertEqual(out, [("", "a", {"status": "2", "s3": {"url": "x", "message": "m"}}),
+                               ("/level3", "a", {"status": "3"}),
+                               ("", "a", {"status": "4"})])
+
+        # Original payloads are untouched
+        self.assertEqual(updates[0][2], {"status": "1", "s3": {"url": "x"}})
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
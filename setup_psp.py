@@ -7,5 +7,6 @@ setuptools.setup(
     author="Lev Litichevskiy",
     author_email="lev@broadinstitute.org",
     url="https://github.com/cmap/proteomics-signature-pipeline.git",
-    packages=["broadinstitute_psp"]
+    packages=["broadinstitute_psp"],
+    tests_require=["moto"]
 )